@@ -1,10 +1,13 @@
 from django.contrib import admin
-from .models import APIRequest, API
+from .models import APIRequest, API, RouteJob
 
 
 class APIAdmin(admin.ModelAdmin):
-    fields = ('name', 'description', 'api_url', 'api_key', 'request_delay', 'num_request_attempts')
-    list_display = ('name', 'api_url', 'request_delay', 'num_request_attempts')
+    fields = (
+        'name', 'description', 'api_url', 'api_key', 'request_delay', 'num_request_attempts', 'max_concurrent_requests',
+        'connect_timeout', 'read_timeout'
+    )
+    list_display = ('name', 'api_url', 'request_delay', 'num_request_attempts', 'max_concurrent_requests')
 
     def get_actions(self, request):
         actions = super().get_actions(request)
@@ -39,5 +42,13 @@ class APIRequestAdmin(admin.ModelAdmin):
         return actions
 
 
+class RouteJobAdmin(admin.ModelAdmin):
+    fields = ('job_id', 'status', 'progress', 'payload', 'client_key', 'route', 'error')
+    readonly_fields = ('job_id', 'payload', 'client_key', 'route')
+    list_display = ('job_id', 'status', 'progress', 'created_at', 'updated_at')
+    list_filter = ['status']
+
+
 admin.site.register(API, APIAdmin)
 admin.site.register(APIRequest, APIRequestAdmin)
+admin.site.register(RouteJob, RouteJobAdmin)
@@ -0,0 +1,142 @@
+"""
+Async versions of the geocoding functions in api.utils, for the ASGI deployment.
+
+Only the external API call is truly asynchronous. It waits on asyncio and httpx, so one process can hold hundreds of
+requests that are queued for the geolocation API without a thread each. Database and cache access is short, and goes
+through sync_to_async at the boundaries below, reusing the same functions as the sync views.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+
+from api import http_client, metrics, scheduler, utils
+from api.models import API, APIRequest
+from api.single_flight import AsyncSingleFlight
+from exceptions import AddressNotFoundException
+from routing.models import Address, get_cleaned_address_tuple
+
+# Concurrent identical geocoding calls in this event loop share one external API call.
+async_geocode_flight = AsyncSingleFlight(name="async_geocode")
+
+
+def _find_address(address_dict: dict) -> tuple:
+    """
+    Look for a usable address in the cache, then the database. Outdated addresses are refreshed in the background.
+
+    :return: An (address, found_address) tuple. address is None if the address must be geocoded first, in which case
+        found_address is the existing Address to update, or None to create a new one.
+    """
+    address_tuple = get_cleaned_address_tuple(address_dict)
+    found_address = utils.get_cached_address(address_tuple)
+    if found_address is None:
+        # Addresses the geolocation API recently couldn't find fail right away.
+        if utils.negative_cache.get(utils.get_geocode_negative_cache_key(address_tuple)):
+            raise AddressNotFoundException(utils.get_address_not_found_message(address_dict))
+
+        with metrics.stage_seconds.time("address_db_lookup"):
+            found_address = Address.get_if_exists(address_dict)
+        if found_address is None or utils.address_is_past_hard_max_age(found_address):
+            return None, found_address
+        utils.cache_address(found_address)
+
+    if utils.address_is_outdated(found_address):
+        utils.refresh_address_in_background(found_address, address_dict)
+    return found_address, found_address
+
+
+async def aget_or_create_address(address_dict: dict, client_key: str = None) -> Address:
+    """
+    The async version of api.utils.get_or_create_address().
+    """
+    utils.validate_address_dict(address_dict)
+    address, found_address = await sync_to_async(_find_address)(address_dict)
+    if address is not None:
+        return address
+
+    return await async_geocode_flight.do(
+        get_cleaned_address_tuple(address_dict), ageocode_address, address_dict, found_address, client_key
+    )
+
+
+async def aget_or_create_addresses(address_dicts: list, client_key: str = None) -> list:
+    """
+    The async version of api.utils.get_or_create_addresses(). Duplicate addresses are only looked up once.
+    """
+    for address_dict in address_dicts:
+        utils.validate_address_dict(address_dict)
+
+    address_keys = [get_cleaned_address_tuple(x) for x in address_dicts]
+    unique_address_dicts = {}
+    for address_key, address_dict in zip(address_keys, address_dicts):
+        unique_address_dicts.setdefault(address_key, address_dict)
+
+    addresses = await asyncio.gather(*[
+        aget_or_create_address(x, client_key=client_key) for x in unique_address_dicts.values()
+    ])
+    found_addresses = dict(zip(unique_address_dicts.keys(), addresses))
+    return [found_addresses[x] for x in address_keys]
+
+
+async def ageocode_address(address_dict: dict, found_address: Address or None, client_key: str = None) -> Address:
+    """
+    The async version of api.utils.geocode_address().
+    """
+    api_name = "Geolocate"
+    api_geolocate = await sync_to_async(API.objects.filter(name=api_name).first)()
+    if not api_geolocate:
+        raise Exception("The '{}' API does not exist in the database.".format(api_name))
+
+    # Example: {"address": "505 Howard St, San Francisco", "language": "en"}
+    query_dict = {
+        "address": "{}, {}, {}, {} {}".format(
+            address_dict['street'], address_dict['city'], address_dict['state'], address_dict['country'],
+            address_dict['postal_code']
+        ),
+        "language": "en",
+    }
+    headers = {
+        "X-RapidAPI-Key": api_geolocate.api_key,
+        "X-RapidAPI-Host": "trueway-geocoding.p.rapidapi.com"
+    }
+
+    api_request = APIRequest(api=api_geolocate)
+    await sync_to_async(api_request.save)()
+
+    try:
+        async with scheduler.get_async_scheduler(api_geolocate).slot(client_key) as wait_seconds:
+            metrics.api_wait_seconds.observe(wait_seconds, api_name)
+            for _ in range(api_geolocate.num_request_attempts):
+                try:
+                    metrics.api_calls_total.inc(api_name)
+                    with metrics.api_call_seconds.time(api_name):
+                        response = await http_client.get_async_client(api_geolocate).get(
+                            api_geolocate.api_url, headers=headers, params=query_dict
+                        )
+                    response.raise_for_status()
+                    if len(response.json()['results']) == 0:
+                        api_request.status = "finished"
+                        utils.negative_cache.set(
+                            utils.get_geocode_negative_cache_key(get_cleaned_address_tuple(address_dict)), True,
+                            ttl_seconds=utils.CONST_NEGATIVE_CACHE_TTL_SECONDS
+                        )
+                        raise AddressNotFoundException(utils.get_address_not_found_message(address_dict))
+
+                    coordinates = dict(response.json()['results'][0]['location'])
+                    address = await sync_to_async(utils.save_geocoded_address)(address_dict, found_address, coordinates)
+                    api_request.status = "finished"
+                    return address
+                except AddressNotFoundException as ex:
+                    raise ex
+                except Exception:
+                    metrics.api_errors_total.inc(api_name)
+                    await asyncio.sleep(float(api_geolocate.request_delay) * 2)
+                    continue
+            raise Exception("Every request to the geolocation API failed.")
+    except AddressNotFoundException as ex:
+        raise ex
+    except Exception:
+        raise Exception("The external geolocation API could not be reached. Please try again tomorrow.")
+    finally:
+        if api_request.status == "waiting":
+            api_request.status = "error"
+        await sync_to_async(api_request.save)()
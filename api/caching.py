@@ -0,0 +1,335 @@
+"""
+In-memory and host-wide caches used in front of the database and the external APIs.
+
+Each gunicorn worker gets its own LRUCache. The SQLiteStore is a single file on the local disk, so every worker on the
+host shares it. TwoTierCache combines the two: reads check the worker's memory first, then the shared file.
+BloomFilter answers "definitely not" for most keys that aren't in a table, so only possible matches are looked up.
+"""
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+CONST_SHARED_STORE_PURGE_INTERVAL = 500  # Remove expired rows from the shared store after this many writes.
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded cache. Each entry expires after its own time-to-live, and the least recently used
+    entry is evicted when the cache is full.
+    """
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.__entries = OrderedDict()  # key -> (expires_at, value)
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] <= time.monotonic():
+                del self.__entries[key]
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl_seconds: float = None):
+        if ttl_seconds is None:
+            ttl_seconds = self.ttl_seconds
+        if ttl_seconds <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + ttl_seconds, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_entries:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get_stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.__entries),
+        }
+
+
+class SQLiteStore:
+    """
+    A key/value table in a local SQLite file. Values are stored as JSON, so they must be JSON-serializable.
+
+    SQLite errors (such as a locked file) are never raised to the caller. A failed read is reported as a miss and a
+    failed write is skipped, so the store can only ever make requests faster, not break them.
+    """
+    def __init__(self, table_name: str, path: str = None):
+        """
+        :param path: The SQLite file. Defaults to settings.SHARED_CACHE_PATH, which is read when the file is opened
+            rather than now, so the stores created at import time still follow settings overridden later, as in tests.
+        """
+        assert table_name.isidentifier()
+        self.table_name = table_name
+        self.__path = path
+        self.__local = threading.local()
+        self.__num_writes = 0
+        self.errors = 0
+        self.expired = 0
+
+    @property
+    def path(self) -> str:
+        return self.__path or settings.SHARED_CACHE_PATH
+
+    def __get_connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, 'connection', None)
+        path = self.path
+        if connection is not None and self.__local.path != path:
+            connection.close()
+            connection = None
+        if connection is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            connection = sqlite3.connect(path, timeout=2, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} "
+                "(cache_key TEXT PRIMARY KEY, cache_value TEXT NOT NULL, expires_at REAL NOT NULL)".format(
+                    self.table_name
+                )
+            )
+            self.__local.connection = connection
+            self.__local.path = path
+        return connection
+
+    def get(self, key: str, default=None):
+        try:
+            row = self.__get_connection().execute(
+                "SELECT cache_value, expires_at FROM {} WHERE cache_key = ?".format(self.table_name), (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            return default
+        if row is None or row[1] <= time.time():
+            return default
+        return json.loads(row[0])
+
+    def get_with_expiry(self, key: str) -> tuple or None:
+        """
+        :return: A (value, seconds_until_expiry) tuple, or None if the key is missing or expired.
+        """
+        try:
+            row = self.__get_connection().execute(
+                "SELECT cache_value, expires_at FROM {} WHERE cache_key = ?".format(self.table_name), (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+        if row is None:
+            return None
+        remaining_seconds = row[1] - time.time()
+        if remaining_seconds <= 0:
+            return None
+        return json.loads(row[0]), remaining_seconds
+
+    def set(self, key: str, value, ttl_seconds: float):
+        if ttl_seconds <= 0:
+            return
+        try:
+            self.__get_connection().execute(
+                "INSERT OR REPLACE INTO {} (cache_key, cache_value, expires_at) VALUES (?, ?, ?)".format(
+                    self.table_name
+                ),
+                (key, json.dumps(value), time.time() + ttl_seconds)
+            )
+        except sqlite3.Error:
+            self.errors += 1
+            return
+
+        self.__num_writes += 1
+        if self.__num_writes % CONST_SHARED_STORE_PURGE_INTERVAL == 0:
+            self.purge_expired()
+
+    def update(self, key: str, update_fn, ttl_seconds: float):
+        """
+        Replace a value with update_fn(value), where value is None if the key is missing or expired. The read and the
+        write happen in one SQLite transaction, so concurrent updates from any process on the host are never lost.
+
+        :return: The new value, or None if the store could not be updated.
+        """
+        try:
+            connection = self.__get_connection()
+            connection.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error:
+            self.errors += 1
+            return None
+        try:
+            row = connection.execute(
+                "SELECT cache_value, expires_at FROM {} WHERE cache_key = ?".format(self.table_name), (key,)
+            ).fetchone()
+            value = update_fn(json.loads(row[0]) if row is not None and row[1] > time.time() else None)
+            connection.execute(
+                "INSERT OR REPLACE INTO {} (cache_key, cache_value, expires_at) VALUES (?, ?, ?)".format(
+                    self.table_name
+                ),
+                (key, json.dumps(value), time.time() + ttl_seconds)
+            )
+            connection.execute("COMMIT")
+        except sqlite3.Error:
+            connection.execute("ROLLBACK")
+            self.errors += 1
+            return None
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        self.__num_writes += 1
+        if self.__num_writes % CONST_SHARED_STORE_PURGE_INTERVAL == 0:
+            self.purge_expired()
+        return value
+
+    def delete(self, key: str):
+        try:
+            self.__get_connection().execute(
+                "DELETE FROM {} WHERE cache_key = ?".format(self.table_name), (key,)
+            )
+        except sqlite3.Error:
+            self.errors += 1
+
+    def purge_expired(self):
+        try:
+            cursor = self.__get_connection().execute(
+                "DELETE FROM {} WHERE expires_at <= ?".format(self.table_name), (time.time(),)
+            )
+            self.expired += max(cursor.rowcount, 0)
+        except sqlite3.Error:
+            self.errors += 1
+
+    def clear(self):
+        try:
+            self.__get_connection().execute("DELETE FROM {}".format(self.table_name))
+        except sqlite3.Error:
+            self.errors += 1
+
+    def get_stats(self) -> dict:
+        return {
+            'errors': self.errors,
+            'expired': self.expired,
+        }
+
+
+class TwoTierCache:
+    """
+    A read-through cache with a bounded in-process LRU tier in front of a SQLite tier shared by every worker on the
+    host.
+
+    Invalidations delete from both tiers of the current process, but other workers can keep serving their in-memory
+    copy for up to local_ttl_seconds. Keep that value short for data that can change.
+    """
+    def __init__(self, name: str, max_local_entries: int, local_ttl_seconds: float, path: str = None):
+        self.name = name
+        self.local_ttl_seconds = local_ttl_seconds
+        self.local = LRUCache(max_entries=max_local_entries, ttl_seconds=local_ttl_seconds)
+        self.shared = SQLiteStore(table_name="cache_{}".format(name), path=path)
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: str, default=None):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+
+        found = self.shared.get_with_expiry(key)
+        if found is None:
+            self.misses += 1
+            return default
+        value, remaining_seconds = found
+        self.shared_hits += 1
+        self.local.set(key, value, ttl_seconds=min(self.local_ttl_seconds, remaining_seconds))
+        return value
+
+    def set(self, key: str, value, ttl_seconds: float):
+        self.local.set(key, value, ttl_seconds=min(self.local_ttl_seconds, ttl_seconds))
+        self.shared.set(key, value, ttl_seconds=ttl_seconds)
+
+    def delete(self, key: str):
+        self.invalidations += 1
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def get_stats(self) -> dict:
+        local_stats = self.local.get_stats()
+        num_lookups = local_stats['hits'] + self.shared_hits + self.misses
+        return {
+            'local_hits': local_stats['hits'],
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_rate': (local_stats['hits'] + self.shared_hits) / num_lookups if num_lookups else 0.0,
+            'evictions': local_stats['evictions'],
+            'invalidations': self.invalidations,
+            'local_size': local_stats['size'],
+            'shared_expired': self.shared.expired,
+            'shared_errors': self.shared.errors,
+        }
+
+
+class BloomFilter:
+    """
+    A compact set of strings that can only answer "maybe" or "no". Items can't be removed, and about error_rate of the
+    items that were never added are wrongly reported as "maybe", as long as no more than capacity items are added.
+
+    Not thread-safe. Use a lock if items are added while other threads read.
+    """
+    def __init__(self, capacity: int, error_rate: float):
+        assert capacity > 0 and 0 < error_rate < 1
+        self.capacity = capacity
+        self.num_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.num_items = 0
+        self.__bits = bytearray((self.num_bits + 7) // 8)
+
+    def __get_positions(self, item: str) -> list:
+        # Double hashing: the positions are first + i * second, for two halves of one digest.
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item: str):
+        for position in self.__get_positions(item):
+            self.__bits[position >> 3] |= 1 << (position & 7)
+        self.num_items += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.__bits[x >> 3] & (1 << (x & 7)) for x in self.__get_positions(item))
+
+    def is_full(self) -> bool:
+        return self.num_items >= self.capacity
@@ -0,0 +1,137 @@
+"""
+Vectorized distance matrices between sets of GPS coordinates.
+
+Points can be Address models or (latitude, longitude) pairs. Every function returns distances in meters, with one row
+per "from" point and one column per "to" point.
+"""
+import numpy as np
+from geopy import distance
+
+from routing.models import Address
+
+CONST_EARTH_RADIUS_METERS = 6371008.8  # Mean radius, which is what geopy's great_circle uses.
+
+# WGS-84 ellipsoid, which is what geopy.distance.distance uses.
+CONST_WGS84_MAJOR_AXIS_METERS = 6378137.0
+CONST_WGS84_FLATTENING = 1 / 298.257223563
+CONST_WGS84_MINOR_AXIS_METERS = (1 - CONST_WGS84_FLATTENING) * CONST_WGS84_MAJOR_AXIS_METERS
+
+CONST_VINCENTY_TOLERANCE = 1e-12  # Radians. Roughly 0.006 mm on the ground.
+CONST_VINCENTY_MAX_ITERATIONS = 200
+
+CONST_METHOD_HAVERSINE = "haversine"
+CONST_METHOD_GEODESIC = "geodesic"
+
+
+def get_coordinates(points: list) -> np.ndarray:
+    """
+    :return: An n x 2 array of (latitude, longitude) in degrees.
+    """
+    coordinates = np.empty((len(points), 2), dtype=np.float64)
+    for index, point in enumerate(points):
+        if isinstance(point, Address):
+            coordinates[index] = (float(point.latitude), float(point.longitude))
+        else:
+            coordinates[index] = (float(point[0]), float(point[1]))
+    return coordinates
+
+
+def get_haversine_matrix(from_coordinates: np.ndarray, to_coordinates: np.ndarray) -> np.ndarray:
+    """
+    Great-circle distances on a sphere. Fast, and within about 0.5% of the ellipsoidal distance.
+    """
+    from_radians = np.radians(from_coordinates)[:, np.newaxis, :]
+    to_radians = np.radians(to_coordinates)[np.newaxis, :, :]
+    half_delta = (to_radians - from_radians) / 2
+    h = np.sin(half_delta[..., 0]) ** 2 + \
+        np.cos(from_radians[..., 0]) * np.cos(to_radians[..., 0]) * np.sin(half_delta[..., 1]) ** 2
+    return 2 * CONST_EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def get_geodesic_matrix(from_coordinates: np.ndarray, to_coordinates: np.ndarray) -> np.ndarray:
+    """
+    Ellipsoidal distances on WGS-84, using Vincenty's inverse formula on every pair at once.
+
+    Vincenty's formula does not converge for some nearly antipodal pairs. Those pairs are recomputed one at a time with
+    geopy, so every distance in the result is accurate.
+    """
+    a = CONST_WGS84_MAJOR_AXIS_METERS
+    b = CONST_WGS84_MINOR_AXIS_METERS
+    f = CONST_WGS84_FLATTENING
+
+    from_radians = np.radians(from_coordinates)[:, np.newaxis, :]
+    to_radians = np.radians(to_coordinates)[np.newaxis, :, :]
+    shape = (from_radians.shape[0], to_radians.shape[1])
+
+    reduced_from_latitude = np.arctan((1 - f) * np.tan(from_radians[..., 0]))
+    reduced_to_latitude = np.arctan((1 - f) * np.tan(to_radians[..., 0]))
+    sin_u1 = np.broadcast_to(np.sin(reduced_from_latitude), shape)
+    cos_u1 = np.broadcast_to(np.cos(reduced_from_latitude), shape)
+    sin_u2 = np.broadcast_to(np.sin(reduced_to_latitude), shape)
+    cos_u2 = np.broadcast_to(np.cos(reduced_to_latitude), shape)
+
+    longitude_delta = np.broadcast_to(to_radians[..., 1] - from_radians[..., 1], shape)
+    lam = longitude_delta.copy()
+    converged = np.zeros(shape, dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(CONST_VINCENTY_MAX_ITERATIONS):
+            sin_lam = np.sin(lam)
+            cos_lam = np.cos(lam)
+            sin_sigma = np.sqrt((cos_u2 * sin_lam) ** 2 + (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam) ** 2)
+            cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_u1 * cos_u2 * sin_lam / sin_sigma)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # On the equator cos_sq_alpha is 0 and the term below is defined as 0.
+            cos_2sigma_m = np.where(cos_sq_alpha == 0, 0.0, cos_sigma - 2 * sin_u1 * sin_u2 / cos_sq_alpha)
+            c = f / 16 * cos_sq_alpha * (4 + f * (4 - 3 * cos_sq_alpha))
+
+            previous_lam = lam
+            lam = longitude_delta + (1 - c) * f * sin_alpha * (
+                sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+            )
+            converged = np.abs(lam - previous_lam) < CONST_VINCENTY_TOLERANCE
+            if np.all(converged):
+                break
+
+        u_sq = cos_sq_alpha * (a ** 2 - b ** 2) / b ** 2
+        big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+            big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        ))
+        result = b * big_a * (sigma - delta_sigma)
+
+    result = np.where(sin_sigma == 0, 0.0, result)  # The same point.
+    for i, j in zip(*np.nonzero(~converged | ~np.isfinite(result))):
+        result[i, j] = distance.geodesic(from_coordinates[i], to_coordinates[j]).meters
+    return result
+
+
+def get_distance_matrix(from_points: list, to_points: list = None, method: str = CONST_METHOD_HAVERSINE) -> np.ndarray:
+    """
+    Get the distance in meters between every pair of points.
+
+    :param from_points: Address models or (latitude, longitude) pairs.
+    :param to_points: Address models or (latitude, longitude) pairs. Defaults to from_points, for a pairwise matrix.
+    :param method: CONST_METHOD_HAVERSINE for speed, or CONST_METHOD_GEODESIC to match geopy.distance.distance.
+    """
+    from_coordinates = get_coordinates(from_points)
+    to_coordinates = from_coordinates if to_points is None else get_coordinates(to_points)
+    if method == CONST_METHOD_HAVERSINE:
+        return get_haversine_matrix(from_coordinates, to_coordinates)
+    elif method == CONST_METHOD_GEODESIC:
+        return get_geodesic_matrix(from_coordinates, to_coordinates)
+    raise Exception("Unknown distance method '{}'.".format(method))
+
+
+def get_distances_to_point(
+        coordinates: list or tuple,
+        points: list,
+        method: str = CONST_METHOD_HAVERSINE
+) -> np.ndarray:
+    """
+    Get the distance in meters from one (latitude, longitude) pair to each of the points.
+    """
+    return get_distance_matrix([coordinates, ], points, method=method)[0]
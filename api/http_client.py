@@ -0,0 +1,243 @@
+"""
+Pooled, keep-alive HTTP clients for the external APIs.
+
+Each API record gets one APIClient per worker process. Its connections stay open between requests, so only the first
+request to the TrueWay hosts pays for the TCP and TLS handshakes.
+"""
+import asyncio
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from api import metrics
+from api.models import API
+
+CONST_POOL_MAXSIZE = 10  # Connections kept open per host. Should be at least API.max_concurrent_requests.
+
+# Connection set-up time for the request running on the current thread.
+_connection_timing = threading.local()
+
+
+def _add_connect_seconds(seconds: float):
+    _connection_timing.connect_seconds = getattr(_connection_timing, 'connect_seconds', 0.0) + seconds
+    _connection_timing.num_new_connections = getattr(_connection_timing, 'num_new_connections', 0) + 1
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start_time = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _add_connect_seconds(time.perf_counter() - start_time)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start_time = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _add_connect_seconds(time.perf_counter() - start_time)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """
+    The default transport. A pooled HTTPAdapter that records how long each new connection takes to open, including
+    the TLS handshake.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+class APIClient:
+    """
+    A thread-safe HTTP client with a keep-alive connection pool.
+
+    Every request is sent with a (connect, read) timeout, so a hung upstream cannot hold a worker forever.
+    The transport is a requests adapter and can be replaced, for example to send requests to a local stub server in
+    tests.
+    """
+    def __init__(self, connect_timeout: float, read_timeout: float, transport: HTTPAdapter = None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.session = requests.Session()
+        self.set_transport(transport or TimedHTTPAdapter(pool_connections=2, pool_maxsize=CONST_POOL_MAXSIZE))
+
+        self.__stats_lock = threading.Lock()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_new_connections = 0
+        self.total_connect_seconds = 0.0
+        self.total_transfer_seconds = 0.0
+
+    def set_transport(self, transport: HTTPAdapter):
+        self.session.mount("http://", transport)
+        self.session.mount("https://", transport)
+
+    def get(self, url: str, headers: dict = None, params: dict = None) -> requests.Response:
+        _connection_timing.connect_seconds = 0.0
+        _connection_timing.num_new_connections = 0
+        start_time = time.perf_counter()
+        try:
+            response = self.session.get(
+                url, headers=headers, params=params, timeout=(self.connect_timeout, self.read_timeout)
+            )
+        except Exception:
+            with self.__stats_lock:
+                self.num_errors += 1
+            raise
+        finally:
+            total_seconds = time.perf_counter() - start_time
+            connect_seconds = _connection_timing.connect_seconds
+            with self.__stats_lock:
+                self.num_requests += 1
+                self.num_new_connections += _connection_timing.num_new_connections
+                self.total_connect_seconds += connect_seconds
+                self.total_transfer_seconds += total_seconds - connect_seconds
+
+        # Connect time covers opening the connection. Transfer time is everything after that: sending the request,
+        # waiting for the upstream, and reading the body.
+        response.connect_seconds = connect_seconds
+        response.transfer_seconds = total_seconds - connect_seconds
+        return response
+
+    def get_stats(self) -> dict:
+        with self.__stats_lock:
+            return {
+                'num_requests': self.num_requests,
+                'num_errors': self.num_errors,
+                'num_new_connections': self.num_new_connections,
+                'total_connect_seconds': self.total_connect_seconds,
+                'total_transfer_seconds': self.total_transfer_seconds,
+            }
+
+
+class AsyncAPIClient:
+    """
+    The asyncio version of APIClient, backed by an httpx.AsyncClient with the same pool size and timeouts.
+
+    Each instance belongs to a single event loop. httpx doesn't report connection set-up time, so only request counts
+    and total request time are recorded.
+    """
+    def __init__(self, connect_timeout: float, read_timeout: float):
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=CONST_POOL_MAXSIZE, max_keepalive_connections=CONST_POOL_MAXSIZE)
+        )
+        self.num_requests = 0
+        self.num_errors = 0
+        self.total_transfer_seconds = 0.0
+
+    def set_timeouts(self, connect_timeout: float, read_timeout: float):
+        self.client.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+
+    async def get(self, url: str, headers: dict = None, params: dict = None) -> httpx.Response:
+        start_time = time.perf_counter()
+        try:
+            return await self.client.get(url, headers=headers, params=params)
+        except Exception:
+            self.num_errors += 1
+            raise
+        finally:
+            self.num_requests += 1
+            self.total_transfer_seconds += time.perf_counter() - start_time
+
+    def get_stats(self) -> dict:
+        return {
+            'num_requests': self.num_requests,
+            'num_errors': self.num_errors,
+            'total_transfer_seconds': self.total_transfer_seconds,
+        }
+
+
+_clients = {}
+_transports = {}
+_clients_lock = threading.Lock()
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> {API name: AsyncAPIClient}
+
+
+def get_client(api: API) -> APIClient:
+    """
+    Get the client for an API record, creating it on first use. Timeouts are re-read from the record each time so
+    changes made on the admin site apply to the next request.
+    """
+    with _clients_lock:
+        client = _clients.get(api.name)
+        if client is None:
+            client = APIClient(
+                connect_timeout=float(api.connect_timeout),
+                read_timeout=float(api.read_timeout),
+                transport=_transports.get(api.name)
+            )
+            _clients[api.name] = client
+    client.connect_timeout = float(api.connect_timeout)
+    client.read_timeout = float(api.read_timeout)
+    return client
+
+
+def get_async_client(api: API) -> AsyncAPIClient:
+    """
+    Get the async client for an API record and the running event loop, creating it on first use.
+    """
+    loop_clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = loop_clients.get(api.name)
+    if client is None:
+        client = AsyncAPIClient(connect_timeout=float(api.connect_timeout), read_timeout=float(api.read_timeout))
+        loop_clients[api.name] = client
+    else:
+        client.set_timeouts(float(api.connect_timeout), float(api.read_timeout))
+    return client
+
+
+def set_transport(api_name: str, transport: HTTPAdapter or None):
+    """
+    Replace the transport used for an API, or pass None to go back to the default pooled transport.
+    """
+    with _clients_lock:
+        if transport is None:
+            _transports.pop(api_name, None)
+        else:
+            _transports[api_name] = transport
+        _clients.pop(api_name, None)
+
+
+def get_all_client_stats() -> dict:
+    with _clients_lock:
+        return {name: client.get_stats() for name, client in _clients.items()}
+
+
+def collect_client_metrics() -> list:
+    stats = get_all_client_stats()
+    return [
+        (
+            metrics.CONST_METRIC_PREFIX + name, "counter", description,
+            [(metrics.CONST_METRIC_PREFIX + name, {'api': x}, y[key]) for x, y in stats.items()]
+        )
+        for name, description, key in (
+            ("http_new_connections_total", "Connections opened to each external API.", 'num_new_connections'),
+            ("http_connect_seconds_total", "Time spent opening connections to each external API.",
+             'total_connect_seconds'),
+        )
+    ]
+
+
+metrics.register_collector(collect_client_metrics)
@@ -0,0 +1,186 @@
+"""
+Background processing of route requests.
+
+The route view only validates the request and queues a RouteJob, so web workers are never held while addresses are
+geocoded and routed. Jobs are run either by a thread pool inside each web worker process (the default), or by separate
+"python manage.py run_route_worker" processes that use the RouteJob table as their queue. Set ROUTE_JOBS_IN_PROCESS to
+False in settings.py to use the latter.
+"""
+import datetime
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from api import metrics, utils
+from api.models import RouteJob
+from exceptions import NotRoutableException
+
+logger = logging.getLogger(__name__)
+
+CONST_MAX_ROUTE_JOB_WORKERS = 4  # Route jobs run at once per process. API admission is still up to api.scheduler.
+CONST_ROUTE_JOB_STALE_SECONDS = 10 * 60  # Unfinished jobs not updated for this long are assumed to be abandoned.
+CONST_ROUTE_JOB_HEARTBEAT_SECONDS = 60  # How often a running job's updated_at is touched, however long its stage.
+
+route_job_executor = ThreadPoolExecutor(max_workers=CONST_MAX_ROUTE_JOB_WORKERS, thread_name_prefix="route_job")
+
+
+def enqueue_route_job(
+        routing_data: dict,
+        client_key: str = "",
+        tracked_action=None,
+        blacklisted_jwt=None
+) -> RouteJob:
+    job = RouteJob(
+        payload=routing_data,
+        client_key=client_key or "",
+        tracked_action=tracked_action,
+        blacklisted_jwt=blacklisted_jwt
+    )
+    job.save()
+    if getattr(settings, 'ROUTE_JOBS_IN_PROCESS', True):
+        # Wait for the job to be committed, or the worker thread might not be able to see it yet.
+        transaction.on_commit(lambda: route_job_executor.submit(_run_route_job_in_thread, job.id))
+    return job
+
+
+def claim_route_job(job_id: int) -> bool:
+    """
+    Mark a queued job as running. Only one worker can claim each job, even across processes.
+    """
+    return RouteJob.objects.filter(id=job_id, status=RouteJob.CONST_STATUS_QUEUED).update(
+        status=RouteJob.CONST_STATUS_RUNNING,
+        updated_at=datetime.datetime.now(tz=datetime.timezone.utc)
+    ) == 1
+
+
+def claim_next_route_job() -> RouteJob or None:
+    """
+    Claim the oldest queued job.
+    """
+    while True:
+        job_id = RouteJob.objects.filter(status=RouteJob.CONST_STATUS_QUEUED).order_by('id') \
+            .values_list('id', flat=True).first()
+        if job_id is None:
+            return None
+        if claim_route_job(job_id):
+            return RouteJob.objects.get(id=job_id)
+        # Another worker claimed it first. Try the next one.
+
+
+def requeue_stale_route_jobs() -> int:
+    """
+    Put running jobs whose worker seems to have died back in the queue.
+
+    :return: The number of jobs requeued.
+    """
+    oldest_allowed = datetime.datetime.now(tz=datetime.timezone.utc) - \
+        datetime.timedelta(seconds=CONST_ROUTE_JOB_STALE_SECONDS)
+    return RouteJob.objects.filter(status=RouteJob.CONST_STATUS_RUNNING, updated_at__lt=oldest_allowed).update(
+        status=RouteJob.CONST_STATUS_QUEUED, progress=""
+    )
+
+
+def resume_stale_route_job(job: RouteJob) -> Future or None:
+    """
+    Run a job again in this process if it has been queued or running for too long, such as when the process that had
+    it died. Only used when ROUTE_JOBS_IN_PROCESS is True, since nothing else would ever pick the job up. Otherwise,
+    the run_route_worker command requeues stale jobs.
+
+    Called when a client polls the job's status, so a job is only resumed while someone is still waiting for it.
+
+    :return: The Future of the job's new run, or None if this call didn't resume it.
+    """
+    if not getattr(settings, 'ROUTE_JOBS_IN_PROCESS', True):
+        return None
+    if job.status not in (RouteJob.CONST_STATUS_QUEUED, RouteJob.CONST_STATUS_RUNNING):
+        return None
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    oldest_allowed = now - datetime.timedelta(seconds=CONST_ROUTE_JOB_STALE_SECONDS)
+    if job.updated_at >= oldest_allowed:
+        return None
+
+    # Touching updated_at means only one poller resumes the job, even across processes.
+    if RouteJob.objects.filter(
+        id=job.id,
+        status__in=(RouteJob.CONST_STATUS_QUEUED, RouteJob.CONST_STATUS_RUNNING),
+        updated_at__lt=oldest_allowed
+    ).update(status=RouteJob.CONST_STATUS_QUEUED, progress="", updated_at=now) != 1:
+        return None
+    return route_job_executor.submit(_run_route_job_in_thread, job.id)
+
+
+def run_route_job(job: RouteJob):
+    """
+    Create the route for a job that has already been claimed, and record the result on the job.
+    """
+    def set_progress(progress: str):
+        job.progress = progress
+        job.save(update_fields=['progress', 'updated_at'])
+
+    # A single stage can take longer than CONST_ROUTE_JOB_STALE_SECONDS, such as when its API calls wait their turn in
+    # api.scheduler, so the job would look abandoned between progress updates without this.
+    stop_heartbeat = threading.Event()
+    heartbeat = threading.Thread(
+        target=_send_route_job_heartbeats, args=(job.id, stop_heartbeat), name="route_job_heartbeat", daemon=True
+    )
+    heartbeat.start()
+    try:
+        route = utils.create_route(dict(job.payload), client_key=job.client_key, progress_callback=set_progress)
+        job.route = route
+        job.status = RouteJob.CONST_STATUS_FINISHED
+    except NotRoutableException:
+        # Let the user re-enter their addresses after changing them, and refresh the page without waiting.
+        if job.blacklisted_jwt_id is not None:
+            job.blacklisted_jwt.delete()
+            job.blacklisted_jwt = None
+        if job.tracked_action_id is not None:
+            job.tracked_action.delete()
+            job.tracked_action = None
+        job.status = RouteJob.CONST_STATUS_NOT_ROUTABLE
+    except Exception as ex:
+        job.status = RouteJob.CONST_STATUS_ERROR
+        job.error = str(ex)
+    finally:
+        stop_heartbeat.set()
+        heartbeat.join()
+    job.progress = ""
+    job.save()
+
+
+def _send_route_job_heartbeats(job_id: int, stop_heartbeat: threading.Event):
+    """
+    Touch a running job's updated_at every CONST_ROUTE_JOB_HEARTBEAT_SECONDS until stop_heartbeat is set, so it is
+    only ever treated as stale once the process running it has died.
+    """
+    try:
+        while not stop_heartbeat.wait(CONST_ROUTE_JOB_HEARTBEAT_SECONDS):
+            RouteJob.objects.filter(id=job_id, status=RouteJob.CONST_STATUS_RUNNING).update(
+                updated_at=datetime.datetime.now(tz=datetime.timezone.utc)
+            )
+    except Exception:
+        logger.exception("Could not update the heartbeat of route job %d.", job_id)
+    finally:
+        connections.close_all()
+
+
+def _run_route_job_in_thread(job_id: int):
+    try:
+        if claim_route_job(job_id):
+            run_route_job(RouteJob.objects.get(id=job_id))
+    except Exception:
+        logger.exception("Route job %d failed.", job_id)
+    finally:
+        # Each worker thread opens its own database connection. Close it so it isn't left dangling.
+        connections.close_all()
+
+
+def collect_route_job_metrics() -> list:
+    num_queued = RouteJob.objects.filter(status=RouteJob.CONST_STATUS_QUEUED).count()
+    name = metrics.CONST_METRIC_PREFIX + "route_jobs_queued"
+    return [(name, "gauge", "Route jobs waiting for a worker, across every process.", [(name, {}, num_queued), ]), ]
+
+
+metrics.register_collector(collect_route_job_metrics)
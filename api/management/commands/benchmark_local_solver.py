@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import solver
+from api.utils import get_cached_connection_matrix
+from routing.models import Route
+
+
+class Command(BaseCommand):
+    help = "Compares the local route solver against the stop order the routing API chose for saved routes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--num-routes', type=int, default=100, help="How many of the newest routes to check.")
+
+    def handle(self, *args, **options):
+        num_compared = 0
+        num_skipped = 0
+        total_api_seconds = 0
+        total_local_seconds = 0
+        solve_times = []
+
+        for route in Route.objects.with_legs().order_by('-id')[:options['num_routes']]:
+            connections = [x.address_connection for x in route.get_route_address_connections()]
+            if len(connections) == 0:
+                continue
+            addresses = [connections[0].from_address, ] + [x.to_address for x in connections]
+
+            # Compare against the route's own legs, so recompute the matrix with the route's flags.
+            matrix, _ = get_cached_connection_matrix(
+                addresses,
+                avoid_highways=connections[0].avoid_highways,
+                avoid_tolls=connections[0].avoid_tolls,
+                avoid_ferries=connections[0].avoid_ferries
+            )
+            start_time = time.perf_counter()
+            order = solver.solve_fixed_endpoint_path(matrix)
+            solve_times.append(time.perf_counter() - start_time)
+            if order is None:
+                num_skipped += 1
+                continue
+
+            num_compared += 1
+            total_api_seconds += sum(x.travel_seconds for x in connections)
+            total_local_seconds += solver.get_path_cost(matrix, order)
+
+        if len(solve_times) == 0:
+            self.stdout.write("There are no saved routes to compare.")
+            return
+
+        solve_times.sort()
+        self.stdout.write("Routes compared: {} ({} skipped because a leg was missing or too many stops)".format(
+            num_compared, num_skipped
+        ))
+        if num_compared > 0:
+            self.stdout.write("Total travel time from the routing API: {} seconds".format(total_api_seconds))
+            self.stdout.write("Total travel time from the local solver: {:.0f} seconds ({:+.2%})".format(
+                total_local_seconds, total_local_seconds / total_api_seconds - 1 if total_api_seconds else 0
+            ))
+        self.stdout.write("Solver time: median {:.4f} seconds, max {:.4f} seconds".format(
+            solve_times[len(solve_times) // 2], solve_times[-1]
+        ))
@@ -0,0 +1,75 @@
+import asyncio
+import secrets
+import time
+
+import httpx
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends many concurrent geolocate requests to a running server and reports throughput and latency. "
+        "Run it against a WSGI deployment (gunicorn) and an ASGI deployment (e.g. uvicorn with API_ASYNC_VIEWS = True) "
+        "that both use \"manage.py run_stub_upstream\", to compare how many waiting requests each can hold."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--base-url', default="http://127.0.0.1:8000/")
+        parser.add_argument('--username', required=True)
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--concurrency', type=int, default=100, help="Requests in flight at once.")
+        parser.add_argument('--requests', type=int, default=500, help="Total number of requests.")
+        parser.add_argument('--timeout', type=float, default=120.0, help="Seconds before a request is abandoned.")
+
+    def handle(self, *args, **options):
+        asyncio.run(self.run_load_test(options))
+
+    async def run_load_test(self, options: dict):
+        base_url = options['base_url'].rstrip('/') + '/'
+        limits = httpx.Limits(max_connections=options['concurrency'], max_keepalive_connections=options['concurrency'])
+        async with httpx.AsyncClient(timeout=options['timeout'], limits=limits) as client:
+            response = await client.post(
+                base_url + "api/token/", data={'username': options['username'], 'password': options['password']}
+            )
+            response.raise_for_status()
+            headers = {'Authorization': "Bearer {}".format(response.json()['access'])}
+
+            # Every address is new, so every request has to wait for the (stub) geolocation API.
+            run_id = secrets.token_hex(4).upper()
+            semaphore = asyncio.Semaphore(options['concurrency'])
+            latencies = []
+            status_counts = {}
+
+            async def send_request(index: int):
+                address_dict = {
+                    'street': "{} LOAD TEST {} ST".format(index, run_id),
+                    'city': "Little Rock",
+                    'state': "AR",
+                    'postal_code': "72201",
+                    'country': "United States",
+                }
+                async with semaphore:
+                    start_time = time.perf_counter()
+                    try:
+                        response = await client.post(base_url + "api/geolocate/", json=address_dict, headers=headers)
+                        status = response.status_code
+                    except httpx.HTTPError as ex:
+                        status = type(ex).__name__
+                    latencies.append(time.perf_counter() - start_time)
+                    status_counts[status] = status_counts.get(status, 0) + 1
+
+            start_time = time.perf_counter()
+            await asyncio.gather(*[send_request(x) for x in range(options['requests'])])
+            total_seconds = time.perf_counter() - start_time
+
+        latencies.sort()
+        self.stdout.write("Requests: {} with {} in flight at once".format(options['requests'], options['concurrency']))
+        self.stdout.write("Total time: {:.2f} seconds ({:.1f} requests per second)".format(
+            total_seconds, options['requests'] / total_seconds
+        ))
+        self.stdout.write("Latency: p50 {:.3f}s, p95 {:.3f}s, max {:.3f}s".format(
+            latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)], latencies[-1]
+        ))
+        self.stdout.write("Responses: {}".format(
+            ", ".join("{}: {}".format(status, count) for status, count in sorted(status_counts.items(), key=str))
+        ))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api import jobs
+
+
+class Command(BaseCommand):
+    help = "Runs queued route jobs. Use this when ROUTE_JOBS_IN_PROCESS is False in settings.py."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty.")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Waiting for route jobs...")
+        while True:
+            num_requeued = jobs.requeue_stale_route_jobs()
+            if num_requeued > 0:
+                self.stdout.write("Requeued {} abandoned route jobs.".format(num_requeued))
+
+            job = jobs.claim_next_route_job()
+            if job is None:
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            start_time = time.perf_counter()
+            jobs.run_route_job(job)
+            self.stdout.write("Route job {} {} in {:.1f} seconds.".format(
+                job.job_id, job.status, time.perf_counter() - start_time
+            ))
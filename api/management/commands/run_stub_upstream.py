@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.models import API
+from api.stub_upstream import StubUpstream
+
+
+class Command(BaseCommand):
+    help = "Runs a local stand-in for the geolocation and routing APIs, for load testing without spending API quota."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8089)
+        parser.add_argument('--latency', type=float, default=0.5, help="Seconds to wait before each response.")
+        parser.add_argument(
+            '--configure-apis', action='store_true',
+            help="Point the Geolocate and Routing API records at the stub. Don't use this on a production database."
+        )
+
+    def handle(self, *args, **options):
+        with StubUpstream(latency_seconds=options['latency'], port=options['port']) as upstream:
+            if options['configure_apis']:
+                for api_name, path in (("Geolocate", "Geocode"), ("Routing", "FindDrivingRoute")):
+                    API.objects.update_or_create(name=api_name, defaults={'api_url': upstream.url + path})
+                self.stdout.write("Pointed the Geolocate and Routing APIs at the stub.")
+
+            self.stdout.write("Stub upstream listening on {} with {} seconds of latency.".format(
+                upstream.url, options['latency']
+            ))
+            try:
+                while True:
+                    time.sleep(60)
+                    self.stdout.write("{} requests served.".format(upstream.server.num_requests))
+            except KeyboardInterrupt:
+                pass
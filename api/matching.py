@@ -0,0 +1,111 @@
+"""
+Matches the legs returned by the routing API back to the addresses that were sent to it.
+"""
+import numpy as np
+
+from api import distance
+from routing.models import Address
+
+
+def get_linear_sum_assignment(cost: np.ndarray) -> tuple:
+    """
+    Solve the assignment problem with the Hungarian algorithm (shortest augmenting paths with potentials), in
+    O(n^2 * m) time.
+
+    :param cost: An n x m matrix with n <= m, where cost[i, j] is the cost of assigning row i to column j.
+    :return: A (row_indices, column_indices) tuple of arrays that gives each row its column, minimizing the total cost.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    num_rows, num_columns = cost.shape
+    assert num_rows <= num_columns
+
+    # Index 0 is a sentinel, so rows and columns are numbered from 1 below.
+    row_potentials = np.zeros(num_rows + 1)
+    column_potentials = np.zeros(num_columns + 1)
+    column_owners = np.zeros(num_columns + 1, dtype=np.int64)  # The row assigned to each column, or 0.
+    previous_columns = np.zeros(num_columns + 1, dtype=np.int64)
+
+    for row in range(1, num_rows + 1):
+        column_owners[0] = row
+        column = 0
+        min_slack = np.full(num_columns + 1, np.inf)
+        visited = np.zeros(num_columns + 1, dtype=bool)
+        while True:
+            visited[column] = True
+            current_row = column_owners[column]
+            unvisited = ~visited[1:]
+
+            slack = cost[current_row - 1] - row_potentials[current_row] - column_potentials[1:]
+            improved = unvisited & (slack < min_slack[1:])
+            min_slack[1:][improved] = slack[improved]
+            previous_columns[1:][improved] = column
+
+            candidates = np.where(unvisited, min_slack[1:], np.inf)
+            next_column = int(np.argmin(candidates)) + 1
+            delta = candidates[next_column - 1]
+
+            row_potentials[column_owners[visited]] += delta
+            column_potentials[visited] -= delta
+            min_slack[1:][unvisited] -= delta
+
+            column = next_column
+            if column_owners[column] == 0:
+                break
+
+        # Flip the augmenting path.
+        while column != 0:
+            previous_column = previous_columns[column]
+            column_owners[column] = column_owners[previous_column]
+            column = previous_column
+
+    column_indices = np.zeros(num_rows, dtype=np.int64)
+    for column in range(1, num_columns + 1):
+        if column_owners[column] != 0:
+            column_indices[column_owners[column] - 1] = column - 1
+    return np.arange(num_rows), column_indices
+
+
+def match_legs_to_addresses(
+        legs: list,
+        start_address: Address,
+        intermediate_addresses: list,
+        end_address: Address
+) -> tuple:
+    """
+    Find the order the routing API visited the intermediate addresses in.
+
+    The legs describe positions along the route: the start, the end of each leg, and the end. The start and end
+    addresses are fixed, and each intermediate address is assigned to one position between them so that the total
+    distance between addresses and leg endpoints is as small as possible. Unlike matching one leg at a time, two stops
+    close to each other cannot take each other's place.
+
+    :return: An (addresses, residuals) tuple. addresses is every address in route order. residuals[i] is the larger
+        distance in meters between addresses[i] and the leg endpoints at its position.
+    """
+    if len(legs) != len(intermediate_addresses) + 1:
+        raise Exception("The route has {} legs, but {} were expected.".format(
+            len(legs), len(intermediate_addresses) + 1
+        ))
+
+    leg_starts = [(leg['start_point']['lat'], leg['start_point']['lng']) for leg in legs]
+    leg_ends = [(leg['end_point']['lat'], leg['end_point']['lng']) for leg in legs]
+    addresses = [start_address, ] + list(intermediate_addresses) + [end_address, ]
+
+    # Position i is where leg i - 1 ends and leg i starts.
+    arrival_distances = distance.get_distance_matrix(leg_ends, addresses)  # Row i is position i + 1.
+    departure_distances = distance.get_distance_matrix(leg_starts, addresses)  # Row i is position i.
+
+    order = [0, ]
+    if len(intermediate_addresses) > 0:
+        cost = arrival_distances[:-1, 1:-1] + departure_distances[1:, 1:-1]
+        _, columns = get_linear_sum_assignment(cost)
+        order += [int(x) + 1 for x in columns]
+    order.append(len(addresses) - 1)
+
+    residuals = np.zeros(len(addresses))
+    for position, address_index in enumerate(order):
+        if position > 0:
+            residuals[position] = max(residuals[position], arrival_distances[position - 1, address_index])
+        if position < len(legs):
+            residuals[position] = max(residuals[position], departure_distances[position, address_index])
+    return [addresses[x] for x in order], residuals
@@ -0,0 +1,234 @@
+"""
+Latency histograms and counters for the request path, exported with the caches' and schedulers' stats in the
+Prometheus text format. See the metrics view in api.views.
+
+Metrics are kept per worker process, like the caches and schedulers they are exported with. Every sample is labelled
+with the process ID, so scrapes that reach different workers don't overwrite each other's series.
+
+Recording is cheap enough to leave on everywhere. A timed span is two perf_counter() calls, a bisect and a dictionary
+update under a lock, which takes a few microseconds at most.
+"""
+import bisect
+import math
+import os
+import threading
+import time
+
+CONST_METRIC_PREFIX = "traveling_salesman_"
+CONST_LATENCY_BUCKETS_SECONDS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+CONST_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+_collectors = []
+_caches = {}
+_registry_lock = threading.Lock()
+
+
+class Counter:
+    """
+    A count that only goes up, with a separate value for each combination of label values.
+    """
+    def __init__(self, name: str, description: str, label_names: tuple = ()):
+        self.name = CONST_METRIC_PREFIX + name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.__values = {}
+        self.__lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def inc(self, *label_values, amount: float = 1):
+        with self.__lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> float:
+        with self.__lock:
+            return self.__values.get(label_values, 0)
+
+    def collect(self) -> list:
+        with self.__lock:
+            values = list(self.__values.items())
+        samples = [(self.name, dict(zip(self.label_names, x)), y) for x, y in values]
+        return [(self.name, "counter", self.description, samples), ]
+
+
+class _Span:
+    __slots__ = ('histogram', 'label_values', 'start_time')
+
+    def __init__(self, histogram, label_values: tuple):
+        self.histogram = histogram
+        self.label_values = label_values
+        self.start_time = 0.0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram._record(time.perf_counter() - self.start_time, self.label_values)
+
+
+class Histogram:
+    """
+    Counts observations, such as durations in seconds, into fixed buckets, with a separate set of buckets for each
+    combination of label values.
+    """
+    def __init__(
+            self,
+            name: str,
+            description: str,
+            label_names: tuple = (),
+            buckets: tuple = CONST_LATENCY_BUCKETS_SECONDS
+    ):
+        self.name = CONST_METRIC_PREFIX + name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.__values = {}  # label values -> [count in each bucket, then above the last bucket; sum]
+        self.__lock = threading.Lock()
+        with _registry_lock:
+            _metrics.append(self)
+
+    def observe(self, value: float, *label_values):
+        self._record(value, label_values)
+
+    def _record(self, value: float, label_values: tuple):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            entry = self.__values.get(label_values)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self.__values[label_values] = entry
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *label_values) -> _Span:
+        """
+        Time a block of code:
+
+            with stage_seconds.time("geocode_addresses"):
+                ...
+        """
+        return _Span(self, label_values)
+
+    def get_count(self, *label_values) -> int:
+        with self.__lock:
+            entry = self.__values.get(label_values)
+            return sum(entry[0]) if entry is not None else 0
+
+    def collect(self) -> list:
+        with self.__lock:
+            values = [(x, list(y[0]), y[1]) for x, y in self.__values.items()]
+        samples = []
+        for label_values, bucket_counts, total in values:
+            labels = dict(zip(self.label_names, label_values))
+            num_observations = 0
+            for bucket, bucket_count in zip(self.buckets + (math.inf, ), bucket_counts):
+                num_observations += bucket_count
+                samples.append((self.name + "_bucket", dict(labels, le=_format_value(bucket)), num_observations))
+            samples.append((self.name + "_sum", labels, total))
+            samples.append((self.name + "_count", labels, num_observations))
+        return [(self.name, "histogram", self.description, samples), ]
+
+
+def register_collector(collect):
+    """
+    Export values that are already kept elsewhere, such as get_stats() results.
+
+    :param collect: Called on each scrape. Returns a list of (name, type, description, samples) tuples, where samples
+        is a list of (sample_name, labels, value) tuples. Names are used as they are, without the prefix.
+    """
+    with _registry_lock:
+        _collectors.append(collect)
+
+
+def register_cache(cache_name: str, cache):
+    """
+    Export a cache's hit ratio and size. The cache's get_stats() must return either "hits", or "local_hits" and
+    "shared_hits", along with "misses".
+    """
+    with _registry_lock:
+        _caches[cache_name] = cache
+
+
+def _collect_caches() -> list:
+    with _registry_lock:
+        caches = list(_caches.items())
+    hits, misses, ratios, sizes = [], [], [], []
+    for cache_name, cache in caches:
+        stats = cache.get_stats()
+        num_hits = stats['hits'] if 'hits' in stats else stats['local_hits'] + stats['shared_hits']
+        num_lookups = num_hits + stats['misses']
+        labels = {'cache': cache_name}
+        hits.append((CONST_METRIC_PREFIX + "cache_hits_total", labels, num_hits))
+        misses.append((CONST_METRIC_PREFIX + "cache_misses_total", labels, stats['misses']))
+        ratios.append((CONST_METRIC_PREFIX + "cache_hit_ratio", labels, num_hits / num_lookups if num_lookups else 0.0))
+        sizes.append((CONST_METRIC_PREFIX + "cache_size", labels, stats.get('size', stats.get('local_size', 0))))
+    return [
+        (CONST_METRIC_PREFIX + "cache_hits_total", "counter", "Cache lookups that found a value.", hits),
+        (CONST_METRIC_PREFIX + "cache_misses_total", "counter", "Cache lookups that found nothing.", misses),
+        (CONST_METRIC_PREFIX + "cache_hit_ratio", "gauge", "The share of cache lookups that found a value.", ratios),
+        (CONST_METRIC_PREFIX + "cache_size", "gauge", "Entries in the cache's in-process tier.", sizes),
+    ]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: dict) -> str:
+    return ",".join(
+        '{}="{}"'.format(x, str(y).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for x, y in labels.items()
+    )
+
+
+def render() -> str:
+    """
+    :return: Every metric in the Prometheus text exposition format.
+    """
+    with _registry_lock:
+        metrics = list(_metrics)
+        collectors = list(_collectors)
+    families = []
+    for metric in metrics:
+        families += metric.collect()
+    for collect in collectors + [_collect_caches, ]:
+        families += collect()
+
+    process_id = str(os.getpid())
+    lines = []
+    for name, metric_type, description, samples in families:
+        lines.append("# HELP {} {}".format(name, description.replace("\\", "\\\\").replace("\n", "\\n")))
+        lines.append("# TYPE {} {}".format(name, metric_type))
+        for sample_name, labels, value in samples:
+            lines.append("{}{{{}}} {}".format(
+                sample_name, _format_labels(dict(labels, pid=process_id)), _format_value(value)
+            ))
+    return "\n".join(lines) + "\n"
+
+
+# The request path's metrics. Other modules record into these rather than defining their own, so every stage of a
+# request shows up in one histogram.
+
+stage_seconds = Histogram(
+    "stage_seconds", "Time spent in each stage of handling a request.", label_names=('stage', )
+)
+api_call_seconds = Histogram(
+    "api_call_seconds", "Time spent on each HTTP call to an external API, including retries' calls.",
+    label_names=('api', )
+)
+api_calls_total = Counter("api_calls_total", "HTTP calls to each external API.", label_names=('api', ))
+api_errors_total = Counter(
+    "api_errors_total", "HTTP calls to each external API that failed or returned an error status.",
+    label_names=('api', )
+)
+api_wait_seconds = Histogram(
+    "api_wait_seconds", "Time requests waited for the API scheduler to admit them.", label_names=('api', )
+)
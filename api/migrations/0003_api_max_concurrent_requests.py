@@ -0,0 +1,18 @@
+# Generated by Django 4.0.6 on 2026-10-18 15:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_alter_api_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='api',
+            name='max_concurrent_requests',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
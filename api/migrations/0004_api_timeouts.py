@@ -0,0 +1,23 @@
+# Generated by Django 4.0.6 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_api_max_concurrent_requests'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='api',
+            name='connect_timeout',
+            field=models.DecimalField(decimal_places=2, default=3.05, max_digits=6),
+        ),
+        migrations.AddField(
+            model_name='api',
+            name='read_timeout',
+            field=models.DecimalField(decimal_places=2, default=20, max_digits=6),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 4.0.6 on 2026-10-18 15:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routing', '0002_address_address_key'),
+        ('security', '0002_jwtblacklist'),
+        ('api', '0004_api_timeouts'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RouteJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('job_id', models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ('status', models.CharField(choices=[('queued', 'queued'), ('running', 'running'), ('finished', 'finished'), ('not_routable', 'not_routable'), ('error', 'error')], db_index=True, default='queued', max_length=20)),
+                ('progress', models.CharField(blank=True, max_length=100)),
+                ('payload', models.JSONField()),
+                ('client_key', models.CharField(blank=True, max_length=100)),
+                ('error', models.TextField(blank=True)),
+                ('blacklisted_jwt', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='security.jwtblacklist')),
+                ('route', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='routing.route')),
+                ('tracked_action', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='security.trackedaction')),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_routejob'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='apirequest',
+            index=models.Index(fields=['status', 'time'], name='apirequest_status_time'),
+        ),
+        migrations.AddIndex(
+            model_name='apirequest',
+            index=models.Index(fields=['time'], name='apirequest_time'),
+        ),
+    ]
@@ -1,4 +1,5 @@
 import datetime
+import uuid
 
 from django.db import models
 
@@ -16,6 +17,9 @@ class API(models.Model):
     api_key = models.TextField()  # Specific implementation of the key will be handled by each view.
     request_delay = models.DecimalField(default=0.5, max_digits=5, decimal_places=4)
     num_request_attempts = models.PositiveIntegerField(default=2)
+    max_concurrent_requests = models.PositiveIntegerField(default=1)
+    connect_timeout = models.DecimalField(default=3.05, max_digits=6, decimal_places=2)  # Seconds.
+    read_timeout = models.DecimalField(default=20, max_digits=6, decimal_places=2)  # Seconds.
 
     def __str__(self):
         return "{}".format(self.name)
@@ -23,8 +27,8 @@ class API(models.Model):
 
 class APIRequest(models.Model):
     """
-    A model that tracks requests to each external API. Use this to prevent overburdening their API using the
-    API foreign table's "request_delay" attribute.
+    An audit log of requests to each external API. Admission is handled in memory by api.scheduler, which uses the
+    API foreign table's "request_delay" and "max_concurrent_requests" attributes to avoid overburdening their API.
     """
     CONST_STATUS_CHOICES = (
         ("waiting", "waiting"),
@@ -36,5 +40,54 @@ class APIRequest(models.Model):
     time = models.DateTimeField(default=datetime.datetime.utcnow, blank=True)
     status = models.CharField(max_length=20, choices=CONST_STATUS_CHOICES, default="waiting")
 
+    class Meta:
+        indexes = [
+            # Startup clears out requests left waiting. See traveling_salesman.db_setup.
+            models.Index(fields=['status', 'time'], name='apirequest_status_time'),
+            # Old requests are deleted by age. See the compact_security_tables command.
+            models.Index(fields=['time'], name='apirequest_time'),
+        ]
+
     def __str__(self):
         return "{}, {}  |  {}, {}".format(self.id, self.api, self.status, self.time)
+
+
+class RouteJob(models.Model):
+    """
+    A route request waiting for, or being processed by, a background worker. See api.jobs.
+
+    The client is given the job_id when the request is accepted and polls the job's status until it has a route.
+    """
+    CONST_STATUS_QUEUED = "queued"
+    CONST_STATUS_RUNNING = "running"
+    CONST_STATUS_FINISHED = "finished"
+    CONST_STATUS_NOT_ROUTABLE = "not_routable"
+    CONST_STATUS_ERROR = "error"
+    CONST_STATUS_CHOICES = (
+        (CONST_STATUS_QUEUED, CONST_STATUS_QUEUED),
+        (CONST_STATUS_RUNNING, CONST_STATUS_RUNNING),
+        (CONST_STATUS_FINISHED, CONST_STATUS_FINISHED),
+        (CONST_STATUS_NOT_ROUTABLE, CONST_STATUS_NOT_ROUTABLE),
+        (CONST_STATUS_ERROR, CONST_STATUS_ERROR),
+    )
+    CONST_DONE_STATUSES = (CONST_STATUS_FINISHED, CONST_STATUS_NOT_ROUTABLE, CONST_STATUS_ERROR)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    status = models.CharField(max_length=20, choices=CONST_STATUS_CHOICES, default=CONST_STATUS_QUEUED, db_index=True)
+    progress = models.CharField(max_length=100, blank=True)
+    payload = models.JSONField()  # The routing data, as posted by the client.
+    client_key = models.CharField(max_length=100, blank=True)  # The client's hashed IP, for fair API scheduling.
+    route = models.ForeignKey('routing.Route', null=True, blank=True, on_delete=models.SET_NULL)
+    error = models.TextField(blank=True)
+
+    # Undone if the addresses can't be routed, so the user can fix them and submit again right away.
+    tracked_action = models.ForeignKey('security.TrackedAction', null=True, blank=True, on_delete=models.SET_NULL)
+    blacklisted_jwt = models.ForeignKey('security.JWTBlacklist', null=True, blank=True, on_delete=models.SET_NULL)
+
+    def is_done(self) -> bool:
+        return self.status in self.CONST_DONE_STATUSES
+
+    def __str__(self):
+        return "{}  |  {}".format(self.job_id, self.status)
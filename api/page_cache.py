@@ -0,0 +1,114 @@
+"""
+Caches whole rendered pages that are the same for every visitor, such as saved routes and the informational pages.
+
+Pages are stored in a TwoTierCache keyed on the URL path, so every worker on the host can serve a page that any of them
+rendered. Each page gets a strong ETag and a Last-Modified date, and conditional requests that match are answered with
+304 Not Modified straight from the cache.
+"""
+import functools
+import hashlib
+import time
+
+from django.contrib.messages import get_messages
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+from api import metrics
+from api.caching import TwoTierCache
+from api.single_flight import SingleFlight
+from routing.models import Route
+
+CONST_PAGE_CACHE_MAX_ENTRIES = 200  # Pages for large routes can be hundreds of kilobytes each.
+CONST_PAGE_CACHE_LOCAL_TTL_SECONDS = 5 * 60
+# Routes with stored legs never change, so this only bounds how long a new template waits.
+CONST_ROUTE_PAGE_TTL_SECONDS = 24 * 60 * 60
+CONST_STATIC_PAGE_TTL_SECONDS = 10 * 60
+
+page_cache = TwoTierCache(
+    name="page",
+    max_local_entries=CONST_PAGE_CACHE_MAX_ENTRIES,
+    local_ttl_seconds=CONST_PAGE_CACHE_LOCAL_TTL_SECONDS
+)
+
+metrics.register_cache("page", page_cache)
+
+# Concurrent requests for the same uncached page in this process share one render.
+page_flight = SingleFlight(name="page")
+
+
+def get_page_cache_key(path: str) -> str:
+    return "page|{}".format(path)
+
+
+def get_etag(content: bytes) -> str:
+    return '"{}"'.format(hashlib.sha256(content).hexdigest()[:32])
+
+
+def _render_page(view, request, key: str, ttl_seconds: float, args: tuple, kwargs: dict) -> tuple:
+    """
+    :return: A (request, response, entry) tuple. entry is the cached form of the response, or None if it can't be
+        cached.
+    """
+    response = view(request, *args, **kwargs)
+    # Only plain pages are shared. Redirects, errors and anything that sets a cookie belong to one visitor. Views mark
+    # pages that may change without notice as private or no-store.
+    cache_control = response.get('Cache-Control', "")
+    if response.status_code != 200 or response.streaming or len(response.cookies) > 0 or \
+            'private' in cache_control or 'no-store' in cache_control:
+        return request, response, None
+
+    last_modified = parse_http_date_safe(response.get('Last-Modified', "")) or int(time.time())
+    entry = {
+        'content': response.content.decode(response.charset),
+        'content_type': response['Content-Type'],
+        'etag': get_etag(response.content),
+        'last_modified': last_modified,
+    }
+    page_cache.set(key, entry, ttl_seconds=ttl_seconds)
+    return request, response, entry
+
+
+def cache_page_response(ttl_seconds: float):
+    """
+    Decorate a view whose GET responses depend only on the URL path.
+
+    The page must only change when the view's own Last-Modified date does. Responses the view marks private or
+    no-store aren't cached.
+
+    Requests with messages waiting to be shown are passed straight to the view, since the messages are part of the
+    page. Don't use this on pages with forms, since CSRF tokens are different for every visitor. Use
+    django.utils.decorators.method_decorator() for class-based views.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or len(get_messages(request)) > 0:
+                return view(request, *args, **kwargs)
+
+            key = get_page_cache_key(request.path)
+            entry = page_cache.get(key)
+            if entry is None:
+                rendered_request, response, entry = page_flight.do(
+                    key, _render_page, view, request, key, ttl_seconds, args, kwargs
+                )
+                if entry is None:
+                    # Only the request that rendered it may use an uncacheable response.
+                    return response if rendered_request is request else view(request, *args, **kwargs)
+
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+            response['ETag'] = entry['etag']
+            response['Last-Modified'] = http_date(entry['last_modified'])
+            return get_conditional_response(
+                request, etag=entry['etag'], last_modified=entry['last_modified'], response=response
+            )
+        return wrapper
+    return decorator
+
+
+@receiver(post_delete, sender=Route)
+def invalidate_cached_route_page(sender, instance: Route, **kwargs):
+    page_cache.delete(get_page_cache_key(reverse('route_show', args=[instance.route_key])))
@@ -0,0 +1,412 @@
+"""
+In-process admission control for the external APIs.
+
+Each API record gets one APIRateScheduler per worker process. It replaces polling the APIRequest table: waiting
+requests block on a condition variable instead of querying the database, and APIRequest rows are only written as an
+audit log.
+
+The async views use an AsyncAPIRateScheduler instead. Both kinds of scheduler for the same API draw on one budget per
+process, so a process that uses both never sends more than its share of the API's limits.
+"""
+import asyncio
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from api import metrics
+from api.models import API
+
+CONST_DEFAULT_CLIENT_KEY = "anonymous"
+
+
+class _Ticket:
+    __slots__ = ('client_key', 'enqueued_at')
+
+    def __init__(self, client_key: str):
+        self.client_key = client_key
+        self.enqueued_at = time.monotonic()
+
+
+class _APIBudget:
+    """
+    The token bucket and in-flight count for one API in this process. The API's thread scheduler and its asyncio
+    schedulers all draw on the same budget, so together they stay within the process's share of the API's limits.
+
+    The budget has its own lock, which is only held briefly and never while waiting. Schedulers hold their own lock
+    around every call.
+    """
+    def __init__(self, request_delay: float, max_concurrent_requests: int):
+        self.__lock = threading.Lock()
+        self.__in_flight = 0
+        self.__tokens = 1.0
+        self.__last_refill = time.monotonic()
+        self.__schedulers = weakref.WeakSet()
+        self.request_delay = 0.0
+        self.max_concurrent_requests = 1
+        self.set_limits(request_delay, max_concurrent_requests)
+
+    def set_limits(self, request_delay: float, max_concurrent_requests: int):
+        with self.__lock:
+            self.request_delay = max(float(request_delay), 0.0)
+            self.max_concurrent_requests = max(int(max_concurrent_requests), 1)
+
+    def add_scheduler(self, scheduler):
+        with self.__lock:
+            self.__schedulers.add(scheduler)
+
+    def __refill(self, now: float):
+        if self.request_delay <= 0:
+            self.__tokens = 1.0
+        else:
+            self.__tokens = min(1.0, self.__tokens + (now - self.__last_refill) / self.request_delay)
+        self.__last_refill = now
+
+    def try_take(self) -> float or None:
+        """
+        Take a token and an in-flight slot if both are available.
+
+        :return: 0 if they were taken, the number of seconds until the next token if only the rate limit is in the
+            way, or None if too many requests are in flight.
+        """
+        with self.__lock:
+            self.__refill(time.monotonic())
+            if self.__in_flight >= self.max_concurrent_requests:
+                return None
+            if self.__tokens >= 1.0:
+                self.__tokens -= 1.0
+                self.__in_flight += 1
+                return 0.0
+            return (1.0 - self.__tokens) * self.request_delay
+
+    def release(self):
+        with self.__lock:
+            self.__in_flight -= 1
+
+    def get_in_flight(self) -> int:
+        with self.__lock:
+            return self.__in_flight
+
+    def wake_schedulers(self, caller=None):
+        """
+        Let every scheduler but the caller check its waiting requests again, such as after a release. Don't hold a
+        scheduler's lock while calling this.
+        """
+        with self.__lock:
+            schedulers = [x for x in self.__schedulers if x is not caller]
+        for scheduler in schedulers:
+            scheduler._wake()
+
+
+class _APIRateSchedulerState:
+    """
+    The round-robin queues shared by the thread and asyncio schedulers. Callers must hold their scheduler's lock
+    around every method.
+    """
+    def __init__(self, request_delay: float, max_concurrent_requests: int, budget: _APIBudget = None):
+        self.__queues = OrderedDict()  # client_key -> deque of tickets, in round-robin order.
+        self.budget = budget or _APIBudget(request_delay, max_concurrent_requests)
+        self.budget.add_scheduler(self)
+
+        self.num_admitted = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @property
+    def request_delay(self) -> float:
+        return self.budget.request_delay
+
+    @property
+    def max_concurrent_requests(self) -> int:
+        return self.budget.max_concurrent_requests
+
+    def __get_next_ticket(self) -> _Ticket or None:
+        for client_queue in self.__queues.values():
+            return client_queue[0]
+        return None
+
+    def _enqueue(self, ticket: _Ticket):
+        self.__queues.setdefault(ticket.client_key, deque()).append(ticket)
+
+    def _remove_ticket(self, ticket: _Ticket):
+        client_queue = self.__queues[ticket.client_key]
+        client_queue.remove(ticket)
+        del self.__queues[ticket.client_key]
+        if len(client_queue) > 0:
+            self.__queues[ticket.client_key] = client_queue  # Move this client to the back of the line.
+
+    def _try_admit(self, ticket: _Ticket) -> float or None:
+        """
+        Admit the ticket if it is next in line and the budget allows it.
+
+        :return: 0 if the ticket was admitted, the number of seconds until its next token if it is only waiting on the
+            rate limit, or None if it must wait for another request to be admitted or released first.
+        """
+        if self.__get_next_ticket() is not ticket:
+            return None
+        wait_seconds = self.budget.try_take()
+        if wait_seconds == 0:
+            self._remove_ticket(ticket)
+        return wait_seconds
+
+    def _record_admission(self, ticket: _Ticket) -> float:
+        wait_seconds = time.monotonic() - ticket.enqueued_at
+        self.num_admitted += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        return wait_seconds
+
+    def _get_queue_depth(self) -> int:
+        return sum(len(x) for x in self.__queues.values())
+
+    def _get_stats(self) -> dict:
+        return {
+            'queue_depth': self._get_queue_depth(),
+            'in_flight': self.budget.get_in_flight(),
+            'num_admitted': self.num_admitted,
+            'average_wait_seconds': self.total_wait_seconds / self.num_admitted if self.num_admitted else 0.0,
+            'max_wait_seconds': self.max_wait_seconds,
+        }
+
+
+class APIRateScheduler(_APIRateSchedulerState):
+    """
+    Admits requests to a single external API.
+
+    A token bucket spaces the start of each request at least request_delay seconds apart (fractions of a second
+    included), and no more than max_concurrent_requests may be in flight at once. Waiting requests are grouped by
+    client and admitted round-robin, so one client submitting a 22-stop route cannot starve everyone else.
+
+    :param budget: Share the limits with other schedulers of the same API. Otherwise, the scheduler gets its own
+        budget with the given limits.
+    """
+    def __init__(self, request_delay: float = 0.0, max_concurrent_requests: int = 1, budget: _APIBudget = None):
+        self.__condition = threading.Condition()
+        super().__init__(request_delay, max_concurrent_requests, budget=budget)
+
+    def configure(self, request_delay: float, max_concurrent_requests: int):
+        self.budget.set_limits(request_delay, max_concurrent_requests)
+        self.budget.wake_schedulers()
+
+    def _wake(self):
+        with self.__condition:
+            self.__condition.notify_all()
+
+    def acquire(self, client_key: str = None) -> float:
+        """
+        Block until the request may be sent.
+
+        :return: The number of seconds spent waiting.
+        """
+        ticket = _Ticket(client_key or CONST_DEFAULT_CLIENT_KEY)
+        with self.__condition:
+            self._enqueue(ticket)
+            try:
+                while True:
+                    wait_seconds = self._try_admit(ticket)
+                    if wait_seconds == 0:
+                        break
+                    self.__condition.wait(timeout=wait_seconds)
+            except BaseException:
+                self._remove_ticket(ticket)
+                self.__condition.notify_all()
+                raise
+
+            wait_seconds = self._record_admission(ticket)
+            self.__condition.notify_all()
+            return wait_seconds
+
+    def release(self):
+        self.budget.release()
+        self._wake()
+        self.budget.wake_schedulers(caller=self)
+
+    @contextmanager
+    def slot(self, client_key: str = None):
+        """
+        Hold a slot for the length of the block. "with scheduler.slot() as wait_seconds" gives how long it waited.
+        """
+        wait_seconds = self.acquire(client_key)
+        try:
+            yield wait_seconds
+        finally:
+            self.release()
+
+    def get_queue_depth(self) -> int:
+        with self.__condition:
+            return self._get_queue_depth()
+
+    def get_stats(self) -> dict:
+        with self.__condition:
+            return self._get_stats()
+
+
+class AsyncAPIRateScheduler(_APIRateSchedulerState):
+    """
+    The asyncio version of APIRateScheduler, for the async views. Waiting requests cost a suspended coroutine rather
+    than a blocked thread.
+
+    Each instance belongs to a single event loop.
+    """
+    def __init__(self, request_delay: float = 0.0, max_concurrent_requests: int = 1, budget: _APIBudget = None):
+        self.__condition = asyncio.Condition()
+        self.__loop = None  # A weak reference to the event loop, once the scheduler is used.
+        self.__wake_tasks = set()
+        super().__init__(request_delay, max_concurrent_requests, budget=budget)
+
+    def configure(self, request_delay: float, max_concurrent_requests: int):
+        # Waiting requests pick up the new limits the next time they wake up.
+        self.budget.set_limits(request_delay, max_concurrent_requests)
+        self.budget.wake_schedulers()
+
+    def _wake(self):
+        """
+        Wake the waiting requests from any thread. Requests released by other schedulers sharing the budget may let
+        them in.
+        """
+        loop = self.__loop() if self.__loop is not None else None
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self.__start_wake_task)
+        except RuntimeError:
+            pass  # The event loop is closed, so nothing is waiting.
+
+    def __start_wake_task(self):
+        task = asyncio.ensure_future(self.__notify_all())
+        self.__wake_tasks.add(task)
+        task.add_done_callback(self.__wake_tasks.discard)
+
+    async def __notify_all(self):
+        async with self.__condition:
+            self.__condition.notify_all()
+
+    async def acquire(self, client_key: str = None) -> float:
+        ticket = _Ticket(client_key or CONST_DEFAULT_CLIENT_KEY)
+        if self.__loop is None:
+            self.__loop = weakref.ref(asyncio.get_running_loop())
+        async with self.__condition:
+            self._enqueue(ticket)
+            try:
+                while True:
+                    wait_seconds = self._try_admit(ticket)
+                    if wait_seconds == 0:
+                        break
+                    try:
+                        await asyncio.wait_for(self.__condition.wait(), timeout=wait_seconds)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                self._remove_ticket(ticket)
+                self.__condition.notify_all()
+                raise
+
+            wait_seconds = self._record_admission(ticket)
+            self.__condition.notify_all()
+            return wait_seconds
+
+    async def release(self):
+        self.budget.release()
+        async with self.__condition:
+            self.__condition.notify_all()
+        self.budget.wake_schedulers(caller=self)
+
+    @asynccontextmanager
+    async def slot(self, client_key: str = None):
+        wait_seconds = await self.acquire(client_key)
+        try:
+            yield wait_seconds
+        finally:
+            await self.release()
+
+    def get_stats(self) -> dict:
+        return self._get_stats()
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+_async_schedulers = weakref.WeakKeyDictionary()  # event loop -> {API name: AsyncAPIRateScheduler}
+_budgets = {}  # API name -> _APIBudget, shared by the API's thread scheduler and asyncio schedulers.
+
+
+def _get_process_limits(api: API) -> tuple:
+    """
+    The API record's limits are for the whole host. They are split evenly across API_RATE_LIMIT_NUM_PROCESSES worker
+    processes, since each process schedules its own requests.
+
+    :return: A (request_delay, max_concurrent_requests) tuple for this process.
+    """
+    num_processes = max(int(getattr(settings, 'API_RATE_LIMIT_NUM_PROCESSES', 1)), 1)
+    return float(api.request_delay) * num_processes, max(api.max_concurrent_requests // num_processes, 1)
+
+
+def _get_budget(api: API) -> _APIBudget:
+    """
+    Get this process's budget for an API record, creating it on first use. The limits are re-read from the record each
+    time so changes made on the admin site apply to the next request.
+    """
+    request_delay, max_concurrent_requests = _get_process_limits(api)
+    with _schedulers_lock:
+        budget = _budgets.get(api.name)
+        if budget is None:
+            budget = _APIBudget(request_delay, max_concurrent_requests)
+            _budgets[api.name] = budget
+    if budget.request_delay != request_delay or budget.max_concurrent_requests != max_concurrent_requests:
+        budget.set_limits(request_delay, max_concurrent_requests)
+        budget.wake_schedulers()
+    return budget
+
+
+def get_scheduler(api: API) -> APIRateScheduler:
+    """
+    Get the scheduler for an API record, creating it on first use.
+    """
+    budget = _get_budget(api)
+    with _schedulers_lock:
+        scheduler = _schedulers.get(api.name)
+        if scheduler is None:
+            scheduler = APIRateScheduler(budget=budget)
+            _schedulers[api.name] = scheduler
+    return scheduler
+
+
+def get_async_scheduler(api: API) -> AsyncAPIRateScheduler:
+    """
+    Get the asyncio scheduler for an API record and the running event loop, creating it on first use.
+
+    It shares its budget with the thread scheduler returned by get_scheduler(), so a process that uses both still
+    stays within its share of the API's limits.
+    """
+    budget = _get_budget(api)
+    loop_schedulers = _async_schedulers.setdefault(asyncio.get_running_loop(), {})
+    scheduler = loop_schedulers.get(api.name)
+    if scheduler is None:
+        scheduler = AsyncAPIRateScheduler(budget=budget)
+        loop_schedulers[api.name] = scheduler
+    return scheduler
+
+
+def get_all_scheduler_stats() -> dict:
+    with _schedulers_lock:
+        return {name: scheduler.get_stats() for name, scheduler in _schedulers.items()}
+
+
+def collect_scheduler_metrics() -> list:
+    stats = get_all_scheduler_stats()
+    return [
+        (
+            metrics.CONST_METRIC_PREFIX + name, metric_type, description,
+            [(metrics.CONST_METRIC_PREFIX + name, {'api': x}, y[key]) for x, y in stats.items()]
+        )
+        for name, metric_type, description, key in (
+            ("api_queue_depth", "gauge", "Requests waiting for the API scheduler.", 'queue_depth'),
+            ("api_in_flight", "gauge", "Requests the API scheduler has admitted and not released.", 'in_flight'),
+            ("api_admitted_total", "counter", "Requests the API scheduler has admitted.", 'num_admitted'),
+        )
+    ]
+
+
+metrics.register_collector(collect_scheduler_metrics)
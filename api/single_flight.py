@@ -0,0 +1,104 @@
+"""
+Coalesces identical in-flight calls to the external APIs.
+"""
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'exception')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time within this process. Callers that arrive while a call with the same key
+    is in flight wait for it and share its result (or its exception) instead of making their own call.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.__calls = {}
+        self.__lock = threading.Lock()
+        self.num_calls = 0
+        self.num_coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        with self.__lock:
+            call = self.__calls.get(key)
+            if call is not None:
+                self.num_coalesced += 1
+                is_leader = False
+            else:
+                call = _Call()
+                self.__calls[key] = call
+                self.num_calls += 1
+                is_leader = True
+
+        if not is_leader:
+            call.event.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as ex:
+            call.exception = ex
+            raise
+        finally:
+            with self.__lock:
+                del self.__calls[key]
+            call.event.set()
+
+    def get_stats(self) -> dict:
+        return {
+            'calls': self.num_calls,
+            'coalesced': self.num_coalesced,
+        }
+
+
+class AsyncSingleFlight:
+    """
+    The asyncio version of SingleFlight. Coroutines that arrive while a call with the same key is in flight await its
+    result instead of making their own call.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.__calls = {}
+        self.num_calls = 0
+        self.num_coalesced = 0
+
+    async def do(self, key, fn, *args, **kwargs):
+        call = self.__calls.get(key)
+        if call is not None:
+            self.num_coalesced += 1
+            # Shielded, so a follower's cancellation doesn't cancel the call for everyone else.
+            return await asyncio.shield(call)
+
+        call = asyncio.get_running_loop().create_future()
+        self.__calls[key] = call
+        self.num_calls += 1
+        try:
+            result = await fn(*args, **kwargs)
+            call.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as ex:
+            call.set_exception(ex)
+            call.exception()  # Mark it as retrieved, in case no other coroutine was waiting.
+            raise
+        finally:
+            del self.__calls[key]
+
+    def get_stats(self) -> dict:
+        return {
+            'calls': self.num_calls,
+            'coalesced': self.num_coalesced,
+        }
@@ -0,0 +1,144 @@
+"""
+Route ordering solved locally instead of by the routing API. Small routes are solved exactly. Large routes are ordered
+with a heuristic, so they can be split into pieces the routing API accepts.
+"""
+import time
+
+import numpy as np
+
+CONST_MAX_INTERMEDIATE_STOPS = 15  # The table below has 2^n * n entries, so keep n small.
+
+
+def get_path_cost(matrix: np.ndarray, order: list) -> float:
+    return float(sum(matrix[a, b] for a, b in zip(order[:-1], order[1:])))
+
+
+def solve_fixed_endpoint_path(matrix: np.ndarray, time_budget_seconds: float = None) -> list or None:
+    """
+    Find the cheapest path that starts at the first node, ends at the last node, and visits every other node once.
+
+    This is the Held-Karp dynamic program. Subsets of the intermediate nodes are stored as bitmasks and processed one
+    subset size at a time, with every subset of that size handled in a single NumPy operation.
+
+    :param matrix: An n x n matrix where matrix[i, j] is the cost of going from node i to node j. Use numpy.inf for
+        legs that are unknown or impossible.
+    :param time_budget_seconds: Give up and return None if the solver runs longer than this.
+    :return: The node indices in visiting order, or None if there is no finite path, there are too many nodes, or
+        the time budget ran out.
+    """
+    start_time = time.perf_counter()
+    matrix = np.asarray(matrix, dtype=np.float64)
+    num_nodes = matrix.shape[0]
+    assert matrix.shape == (num_nodes, num_nodes)
+    assert num_nodes >= 2
+
+    num_intermediate = num_nodes - 2
+    if num_intermediate > CONST_MAX_INTERMEDIATE_STOPS:
+        return None
+    if num_intermediate == 0:
+        return [0, 1] if np.isfinite(matrix[0, 1]) else None
+
+    intermediate_matrix = matrix[1:-1, 1:-1]
+    num_masks = 1 << num_intermediate
+    masks = np.arange(num_masks)
+    mask_sizes = np.zeros(num_masks, dtype=np.int64)
+    for bit in range(num_intermediate):
+        mask_sizes += (masks >> bit) & 1
+
+    # cost[mask, j] is the cheapest path from the start through every intermediate node in mask, ending at node j.
+    cost = np.full((num_masks, num_intermediate), np.inf)
+    previous = np.full((num_masks, num_intermediate), -1, dtype=np.int8)
+    for j in range(num_intermediate):
+        cost[1 << j, j] = matrix[0, j + 1]
+
+    for size in range(2, num_intermediate + 1):
+        masks_of_size = masks[mask_sizes == size]
+        for j in range(num_intermediate):
+            bit = 1 << j
+            masks_with_j = masks_of_size[(masks_of_size & bit) != 0]
+            candidates = cost[masks_with_j ^ bit, :] + intermediate_matrix[:, j]
+            best = np.argmin(candidates, axis=1)
+            cost[masks_with_j, j] = candidates[np.arange(len(masks_with_j)), best]
+            previous[masks_with_j, j] = best
+
+        if time_budget_seconds is not None and time.perf_counter() - start_time > time_budget_seconds:
+            return None
+
+    full_mask = num_masks - 1
+    final_costs = cost[full_mask, :] + matrix[1:-1, -1]
+    last = int(np.argmin(final_costs))
+    if not np.isfinite(final_costs[last]):
+        return None
+
+    order = []
+    mask = full_mask
+    j = last
+    while j != -1:
+        order.append(j + 1)
+        next_j = int(previous[mask, j])
+        mask ^= 1 << j
+        j = next_j
+    return [0] + order[::-1] + [num_nodes - 1]
+
+
+def get_nearest_neighbor_path(matrix: np.ndarray) -> list:
+    """
+    Start at the first node and keep going to the closest unvisited node. The last node is kept for the end.
+    """
+    num_nodes = matrix.shape[0]
+    unvisited = np.ones(num_nodes, dtype=bool)
+    unvisited[0] = False
+    unvisited[-1] = False
+    order = [0, ]
+    for _ in range(num_nodes - 2):
+        candidates = np.where(unvisited, matrix[order[-1]], np.inf)
+        next_node = int(np.argmin(candidates))
+        unvisited[next_node] = False
+        order.append(next_node)
+    order.append(num_nodes - 1)
+    return order
+
+
+def improve_path_with_2_opt(matrix: np.ndarray, order: list, time_budget_seconds: float = None) -> list:
+    """
+    Repeatedly reverse the section of the path that shortens it the most, until no reversal helps. The first and last
+    nodes stay in place.
+
+    The matrix must be symmetric, since reversing a section is assumed not to change that section's cost.
+    """
+    start_time = time.perf_counter()
+    order = np.array(order, dtype=np.int64)
+    num_nodes = len(order)
+    improved = True
+    while improved:
+        improved = False
+        # Reversing order[i:j + 1] replaces the edges (i - 1, i) and (j, j + 1) with (i - 1, j) and (i, j + 1).
+        for i in range(1, num_nodes - 2):
+            j = np.arange(i + 1, num_nodes - 1)
+            gains = matrix[order[i - 1], order[i]] + matrix[order[j], order[j + 1]] - \
+                matrix[order[i - 1], order[j]] - matrix[order[i], order[j + 1]]
+            best = int(np.argmax(gains))
+            if gains[best] > 1e-9:
+                order[i:j[best] + 1] = order[i:j[best] + 1][::-1]
+                improved = True
+
+        if time_budget_seconds is not None and time.perf_counter() - start_time > time_budget_seconds:
+            break
+    return [int(x) for x in order]
+
+
+def get_heuristic_fixed_endpoint_path(matrix: np.ndarray, time_budget_seconds: float = None) -> list:
+    """
+    Find a short path that starts at the first node, ends at the last node, and visits every other node once. Unlike
+    solve_fixed_endpoint_path(), this works for any number of nodes, but the path is not guaranteed to be optimal.
+
+    :param matrix: A symmetric n x n matrix of finite costs, such as straight-line distances.
+    :param time_budget_seconds: Stop improving the path after roughly this long.
+    :return: The node indices in visiting order.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    num_nodes = matrix.shape[0]
+    assert matrix.shape == (num_nodes, num_nodes)
+    assert num_nodes >= 2
+
+    return improve_path_with_2_opt(matrix, get_nearest_neighbor_path(matrix), time_budget_seconds=time_budget_seconds)
@@ -0,0 +1,113 @@
+"""
+A local stand-in for the TrueWay geocoding and directions APIs, for tests and load tests.
+
+Point the "Geolocate" and "Routing" API records at StubUpstream.url + "Geocode" and StubUpstream.url +
+"FindDrivingRoute" to use it.
+"""
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from geopy import distance
+
+CONST_MAX_GATE_WAIT_SECONDS = 10
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    """
+    Imitates the TrueWay geocoding and directions endpoints so tests can run without spending API quota.
+    Coordinates are derived from a hash of the address, and legs are returned in the order the stops were given.
+    """
+    protocol_version = "HTTP/1.1"  # Allow keep-alive connections.
+
+    def do_GET(self):
+        self.server.gate.wait(CONST_MAX_GATE_WAIT_SECONDS)
+        time.sleep(self.server.latency_seconds)
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        with self.server.num_requests_lock:  # Each request is handled on its own thread.
+            self.server.num_requests += 1
+
+        if self.server.fail_requests:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if url.path.endswith("Geocode"):
+            digest = hashlib.sha256(params['address'][0].encode('utf-8')).digest()
+            result = {
+                'results': [
+                    {'location': {'lat': 30 + digest[0] / 25.6, 'lng': -120 + digest[1] / 8.0}},
+                ]
+            }
+            if "NOWHERE" in params['address'][0].upper():
+                result['results'] = []
+        elif self.server.not_routable:
+            result = {}
+        else:
+            stops = [tuple(float(x) for x in stop.split(',')) for stop in params['stops'][0].split(';')]
+            legs = []
+            for start_point, end_point in zip(stops[:-1], stops[1:]):
+                meters = int(distance.distance(start_point, end_point).meters)
+                legs.append({
+                    'distance': meters,
+                    'duration': meters // 25,
+                    'start_point': {'lat': start_point[0], 'lng': start_point[1]},
+                    'end_point': {'lat': end_point[0], 'lng': end_point[1]},
+                })
+            result = {'route': {'legs': legs}}
+
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubUpstream:
+    """
+    Runs StubUpstreamHandler on a background thread. Use it as a context manager. Port 0 picks a free port.
+
+    Clear server.gate to hold every response until it is set again, for up to CONST_MAX_GATE_WAIT_SECONDS.
+    """
+    def __init__(self, latency_seconds: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.server = ThreadingHTTPServer((host, port), StubUpstreamHandler)
+        self.server.daemon_threads = True
+        self.server.latency_seconds = latency_seconds
+        self.server.num_requests = 0
+        self.server.num_requests_lock = threading.Lock()
+        self.server.not_routable = False
+        self.server.fail_requests = False  # Answer every request with an error status.
+        self.server.gate = threading.Event()
+        self.server.gate.set()
+        self.url = "http://{}:{}/".format(host, self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.gate.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def get_stub_address_dicts(num_addresses: int) -> list:
+    return [
+        {
+            'street': '{} Main St'.format(100 + index),
+            'city': 'Little Rock',
+            'state': 'AR',
+            'postal_code': '72201',
+            'country': 'United States'
+        }
+        for index in range(num_addresses)
+    ]
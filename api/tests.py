@@ -1,9 +1,16 @@
+import asyncio
+import copy
+import datetime
+import itertools
 import json
 import os
 import random
+import threading
 import time
 import unittest
+from decimal import Decimal
 
+import numpy as np
 import requests
 from geopy import distance
 
@@ -12,9 +19,23 @@ import django
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "traveling_salesman.settings")
 django.setup()
 
-from api.utils import get_or_create_address, create_route
-from api.models import API
-from routing.models import Address, Route
+from django.conf import settings
+from django.db import connection
+from django.contrib.auth.models import User
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient as DRFAPIClient
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api import async_utils, distance as api_distance, jobs, matching, metrics, solver, utils, views
+from api.http_client import APIClient
+from api.stub_upstream import StubUpstream, get_stub_address_dicts
+from api.scheduler import APIRateScheduler, AsyncAPIRateScheduler, get_async_scheduler, get_scheduler
+from api.utils import get_or_create_address, get_or_create_addresses, create_route
+from api.models import API, RouteJob
+from exceptions import AddressNotFoundException, NotRoutableException
+from routing.models import Address, AddressConnection, Route, RouteAddressConnection, clean_address_piece
+from security.models import HashedIP, JWTBlacklist, TrackedAction, hashed_ip_cache
 
 random.seed(time.time())
 
@@ -129,6 +150,1075 @@ class TestAPIGeolocate(unittest.TestCase):
         self.assertIsInstance(float(result.longitude), float)
 
 
+class TestGeocodeBatch(TransactionTestCase):
+    CONST_STUB_LATENCY_SECONDS = 0.1
+
+    def setUp(self):
+        utils.address_cache.clear()
+        self.upstream = StubUpstream(latency_seconds=self.CONST_STUB_LATENCY_SECONDS).__enter__()
+        API.objects.create(
+            name="Geolocate", api_url=self.upstream.url + "Geocode", api_key="test", request_delay=0,
+            max_concurrent_requests=8
+        )
+
+    def tearDown(self):
+        self.upstream.__exit__()
+
+    def test_addresses_are_returned_in_input_order(self):
+        address_dicts = get_stub_address_dicts(5)
+        address_dicts.append(dict(address_dicts[0]))  # Duplicates should only be geocoded once.
+
+        result = get_or_create_addresses(address_dicts)
+        self.assertEqual(len(result), len(address_dicts))
+        for address_dict, address in zip(address_dicts, result):
+            self.assertIsInstance(address, Address)
+            self.assertEqual(address.street, clean_address_piece(address_dict['street']))
+        self.assertEqual(result[0].id, result[-1].id)
+        self.assertEqual(self.upstream.server.num_requests, 5)
+
+    def test_failed_geocoding_raises(self):
+        self.upstream.server.fail_requests = True
+
+        with self.assertRaisesMessage(Exception, "The external geolocation API could not be reached."):
+            get_or_create_addresses(get_stub_address_dicts(3))
+        # Each address is tried num_request_attempts times.
+        self.assertEqual(self.upstream.server.num_requests, 3 * API.objects.get(name="Geolocate").num_request_attempts)
+        self.assertEqual(Address.objects.count(), 0)
+
+    def test_cold_route_timing(self):
+        # A route has a start, an end, and up to 20 intermediate addresses. None of them are in the test database.
+        address_dicts = get_stub_address_dicts(22)
+
+        start_time = time.perf_counter()
+        for address_dict in address_dicts:
+            get_or_create_address(dict(address_dict))
+        sequential_seconds = time.perf_counter() - start_time
+
+        Address.objects.all().delete()
+        utils.address_cache.clear()
+        start_time = time.perf_counter()
+        get_or_create_addresses([dict(x) for x in address_dicts])
+        batched_seconds = time.perf_counter() - start_time
+
+        print("Cold geocoding of {} addresses with {}s of upstream latency: sequential {:.2f}s, batched {:.2f}s".format(
+            len(address_dicts), self.CONST_STUB_LATENCY_SECONDS, sequential_seconds, batched_seconds
+        ))
+
+
+class TestAPIRateScheduler(unittest.TestCase):
+    def test_fractional_request_delay(self):
+        scheduler = APIRateScheduler(request_delay=0.25, max_concurrent_requests=4)
+        start_time = time.monotonic()
+        for _ in range(4):
+            scheduler.acquire("a")
+        # The first token is available right away, and each of the others takes a quarter of a second.
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.75)
+        self.assertEqual(scheduler.get_stats()['in_flight'], 4)
+
+    def test_max_concurrent_requests(self):
+        scheduler = APIRateScheduler(request_delay=0, max_concurrent_requests=3)
+        lock = threading.Lock()
+        num_in_flight = [0, 0]  # Now, and the most at once.
+        # Each request waits until two others are in flight with it, so the scheduler must admit three at once.
+        barrier = threading.Barrier(3, timeout=10)
+
+        def run(client_key):
+            with scheduler.slot(client_key):
+                with lock:
+                    num_in_flight[0] += 1
+                    num_in_flight[1] = max(num_in_flight)
+                barrier.wait()
+                with lock:
+                    num_in_flight[0] -= 1
+
+        threads = [threading.Thread(target=run, args=("a", )) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(barrier.broken)
+        self.assertEqual(num_in_flight[1], 3)
+        self.assertEqual(scheduler.get_stats()['num_admitted'], 6)
+        self.assertEqual(scheduler.get_stats()['queue_depth'], 0)
+
+    def test_clients_are_admitted_round_robin(self):
+        scheduler = APIRateScheduler(request_delay=0, max_concurrent_requests=1)
+        admitted = []
+
+        def run(client_key):
+            with scheduler.slot(client_key):
+                admitted.append(client_key)
+
+        # The first request for "a" holds the only slot while the others queue up.
+        scheduler.acquire("a")
+        threads = []
+        for client_key in ["a", "a", "a", "b", "b"]:
+            thread = threading.Thread(target=run, args=(client_key, ))
+            thread.start()
+            threads.append(thread)
+            # Start the next one once this one is in the queue, so they queue up in a known order.
+            while thread.is_alive() and scheduler.get_queue_depth() < len(threads):
+                time.sleep(0.001)
+        scheduler.release()
+        for thread in threads:
+            thread.join()
+        # "b" doesn't wait for every "a" request.
+        self.assertEqual(admitted, ["a", "b", "a", "b", "a"])
+
+
+class TestAsyncAPIRateScheduler(unittest.TestCase):
+    def test_fractional_request_delay(self):
+        async def run():
+            scheduler = AsyncAPIRateScheduler(request_delay=0.25, max_concurrent_requests=4)
+            start_time = time.monotonic()
+            for _ in range(4):
+                await scheduler.acquire("a")
+            # The first request takes the bucket's token, and each of the others waits a quarter of a second for one.
+            self.assertGreaterEqual(time.monotonic() - start_time, 0.75)
+            self.assertEqual(scheduler.get_stats()['in_flight'], 4)
+
+        asyncio.run(run())
+
+    def test_max_concurrent_requests(self):
+        in_flight = []
+        peak_in_flight = []
+
+        async def run():
+            scheduler = AsyncAPIRateScheduler(request_delay=0, max_concurrent_requests=3)
+            all_admitted = asyncio.Event()
+
+            async def client():
+                async with scheduler.slot("a"):
+                    in_flight.append(None)
+                    peak_in_flight.append(len(in_flight))
+                    if len(in_flight) == 3:
+                        all_admitted.set()
+                    # Hold the slot until the third request is in, so the first three are in flight together.
+                    await asyncio.wait_for(all_admitted.wait(), timeout=10)
+                    in_flight.pop()
+
+            await asyncio.gather(*(client() for _ in range(6)))
+            stats = scheduler.get_stats()
+            self.assertEqual(stats['num_admitted'], 6)
+            self.assertEqual(stats['queue_depth'], 0)
+
+        asyncio.run(run())
+        self.assertEqual(max(peak_in_flight), 3)
+
+    def test_clients_are_admitted_round_robin(self):
+        admitted = []
+
+        async def run():
+            scheduler = AsyncAPIRateScheduler(request_delay=0, max_concurrent_requests=1)
+
+            async def client(client_key):
+                async with scheduler.slot(client_key):
+                    admitted.append(client_key)
+
+            # Hold the only slot until every request is queued, so the order they are admitted in only depends on
+            # the scheduler.
+            await scheduler.acquire("a")
+            tasks = []
+            for client_key in ["a", "a", "a", "b", "b"]:
+                tasks.append(asyncio.create_task(client(client_key)))
+                while scheduler.get_stats()['queue_depth'] < len(tasks):
+                    await asyncio.sleep(0)
+            await scheduler.release()
+            await asyncio.gather(*tasks)
+
+        asyncio.run(run())
+        # "b" doesn't wait for every "a" request.
+        self.assertEqual(admitted, ["a", "b", "a", "b", "a"])
+
+    def test_shares_limits_with_thread_scheduler(self):
+        api = API(name="Shared limits test", request_delay=0, max_concurrent_requests=1)
+        thread_scheduler = get_scheduler(api)
+
+        async def run():
+            async_scheduler = get_async_scheduler(api)
+            self.assertIs(async_scheduler.budget, thread_scheduler.budget)
+
+            thread_scheduler.acquire("a")
+            task = asyncio.create_task(async_scheduler.acquire("b"))
+            while async_scheduler.get_stats()['queue_depth'] == 0:
+                await asyncio.sleep(0)
+            # The thread's request holds the only slot, so the coroutine waits until another thread releases it.
+            await asyncio.sleep(0)
+            self.assertFalse(task.done())
+            await asyncio.get_running_loop().run_in_executor(None, thread_scheduler.release)
+            await asyncio.wait_for(task, timeout=5)
+            self.assertEqual(thread_scheduler.get_stats()['in_flight'], 1)
+            await async_scheduler.release()
+
+        asyncio.run(run())
+        self.assertEqual(thread_scheduler.get_stats()['in_flight'], 0)
+
+
+class TestAsyncGeocode(TransactionTestCase):
+    CONST_STUB_LATENCY_SECONDS = 0.2
+
+    def setUp(self):
+        utils.address_cache.clear()
+        utils.negative_cache.clear()
+        self.upstream = StubUpstream(latency_seconds=self.CONST_STUB_LATENCY_SECONDS).__enter__()
+        API.objects.create(
+            name="Geolocate", api_url=self.upstream.url + "Geocode", api_key="test", request_delay=0,
+            max_concurrent_requests=50
+        )
+
+    def tearDown(self):
+        self.upstream.__exit__()
+
+    def test_concurrent_requests_without_threads(self):
+        address_dicts = get_stub_address_dicts(50)
+
+        start_time = time.perf_counter()
+        addresses = asyncio.run(async_utils.aget_or_create_addresses(address_dicts + address_dicts[:5]))
+        total_seconds = time.perf_counter() - start_time
+        print("Geocoded 50 addresses concurrently in {:.2f} seconds.".format(total_seconds))
+
+        # Sequentially, this would take at least 50 * 0.2 = 10 seconds.
+        self.assertLess(total_seconds, 50 * self.CONST_STUB_LATENCY_SECONDS / 4)
+        self.assertEqual(self.upstream.server.num_requests, 50)
+        self.assertEqual(
+            [x.street for x in addresses], [clean_address_piece(x['street']) for x in address_dicts + address_dicts[:5]]
+        )
+        self.assertEqual(
+            [x.id for x in addresses], [x.id for x in get_or_create_addresses(address_dicts + address_dicts[:5])]
+        )
+
+    def test_address_not_found(self):
+        address_dict = dict(get_stub_address_dicts(1)[0], street="1 Nowhere Ln")
+        with self.assertRaises(AddressNotFoundException):
+            asyncio.run(async_utils.aget_or_create_address(address_dict))
+        with self.assertRaises(AddressNotFoundException):
+            asyncio.run(async_utils.aget_or_create_address(address_dict))
+        self.assertEqual(self.upstream.server.num_requests, 1)
+
+    def test_geolocate_view(self):
+        user = User.objects.create_user(username="async_test", password="password")
+        request = AsyncRequestFactory().post(
+            "/api/geolocate/", data=get_stub_address_dicts(3), content_type="application/json",
+            authorization="Bearer {}".format(RefreshToken.for_user(user).access_token)
+        )
+        response = asyncio.run(views.geolocate_async(request))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.content)), 3)
+
+        request = AsyncRequestFactory().post(
+            "/api/geolocate/", data=get_stub_address_dicts(1)[0], content_type="application/json"
+        )
+        response = asyncio.run(views.geolocate_async(request))
+        self.assertEqual(response.status_code, 401)
+
+
+class TestAPIClient(unittest.TestCase):
+    def test_connections_are_reused(self):
+        client = APIClient(connect_timeout=1, read_timeout=1)
+        with StubUpstream() as upstream:
+            for _ in range(5):
+                with client.get(upstream.url + "Geocode", params={'address': "a"}) as req:
+                    req.raise_for_status()
+                    self.assertGreaterEqual(req.transfer_seconds, 0.0)
+
+        self.assertEqual(client.get_stats()['num_requests'], 5)
+        self.assertEqual(client.get_stats()['num_new_connections'], 1)
+        self.assertGreater(client.get_stats()['total_connect_seconds'], 0.0)
+
+    def test_read_timeout(self):
+        client = APIClient(connect_timeout=1, read_timeout=0.2)
+        with StubUpstream(latency_seconds=1.0) as upstream:
+            start_time = time.perf_counter()
+            with self.assertRaises(requests.Timeout):
+                client.get(upstream.url + "Geocode", params={'address': "a"})
+            self.assertLess(time.perf_counter() - start_time, 0.9)
+        self.assertEqual(client.get_stats()['num_errors'], 1)
+
+    def test_pluggable_transport(self):
+        class RecordingAdapter(requests.adapters.HTTPAdapter):
+            urls = []
+
+            def send(self, request, **kwargs):
+                self.urls.append(request.url)
+                return super().send(request, **kwargs)
+
+        with StubUpstream() as upstream:
+            client = APIClient(connect_timeout=1, read_timeout=1, transport=RecordingAdapter())
+            client.get(upstream.url + "Geocode", params={'address': "a"}).raise_for_status()
+        self.assertEqual(len(RecordingAdapter.urls), 1)
+
+
+class TestAddressCache(TransactionTestCase):
+    def setUp(self):
+        utils.address_cache.clear()
+        self.upstream = StubUpstream().__enter__()
+        API.objects.create(name="Geolocate", api_url=self.upstream.url + "Geocode", api_key="test", request_delay=0)
+
+    def tearDown(self):
+        self.upstream.__exit__()
+
+    def test_repeated_lookup_skips_database(self):
+        address_dict = get_stub_address_dicts(1)[0]
+        first = get_or_create_address(dict(address_dict))
+        stats = utils.address_cache.get_stats()
+
+        with self.assertNumQueries(0):
+            second = get_or_create_address(dict(address_dict))
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(first.latitude, second.latitude)
+        self.assertEqual(utils.address_cache.get_stats()['local_hits'], stats['local_hits'] + 1)
+
+        # Other workers would only find the entry in the shared tier.
+        utils.address_cache.local.clear()
+        with self.assertNumQueries(0):
+            get_or_create_address(dict(address_dict))
+        self.assertEqual(utils.address_cache.get_stats()['shared_hits'], stats['shared_hits'] + 1)
+
+    def test_saving_address_invalidates_entry(self):
+        address_dict = get_stub_address_dicts(1)[0]
+        address = get_or_create_address(dict(address_dict))
+        address.latitude = Decimal("1.5")
+        address.save()
+
+        self.assertIsNone(utils.get_cached_address(utils.get_cleaned_address_tuple(address_dict)))
+        self.assertEqual(get_or_create_address(dict(address_dict)).latitude, Decimal("1.5"))
+
+    def test_shared_tier_follows_settings(self):
+        # The tests clear the caches, so they must never use the deployment's file.
+        self.assertNotEqual(
+            utils.address_cache.shared.path, os.path.join(settings.BASE_DIR, 'shared_cache', 'cache.sqlite3')
+        )
+        address_dict = get_stub_address_dicts(1)[0]
+        get_or_create_address(dict(address_dict))
+        utils.address_cache.local.clear()
+        with override_settings(SHARED_CACHE_PATH=os.path.join(settings.SHARED_CACHE_PATH + "_other", "cache.sqlite3")):
+            self.assertIsNone(utils.get_cached_address(utils.get_cleaned_address_tuple(address_dict)))
+            utils.address_cache.clear()
+        self.assertIsNotNone(utils.get_cached_address(utils.get_cleaned_address_tuple(address_dict)))
+
+
+class TestStaleWhileRevalidate(TransactionTestCase):
+    def setUp(self):
+        utils.address_cache.clear()
+        self.upstream = StubUpstream().__enter__()
+        API.objects.create(name="Geolocate", api_url=self.upstream.url + "Geocode", api_key="test", request_delay=0)
+        self.address_dict = get_stub_address_dicts(1)[0]
+        self.address = Address.objects.get(id=get_or_create_address(dict(self.address_dict)).id)
+        utils.address_cache.clear()
+
+    def tearDown(self):
+        self.upstream.__exit__()
+
+    def set_address_age(self, num_days: int):
+        Address.objects.filter(id=self.address.id).update(
+            latitude=Decimal("1.0"),
+            updated_at=datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(days=num_days)
+        )
+
+    def test_outdated_address_is_refreshed_in_background(self):
+        self.set_address_age(utils.CONST_NUM_DAYS_ADDRESS_OUTDATED + 1)
+
+        # Hold the upstream's responses, so the outdated address can only come back if nothing waits for them.
+        self.upstream.server.gate.clear()
+        stale_address = get_or_create_address(dict(self.address_dict))
+        self.assertEqual(stale_address.latitude, Decimal("1.0"))
+        self.upstream.server.gate.set()
+
+        utils.wait_for_address_refreshes(timeout=10)
+        refreshed_address = Address.objects.get(id=self.address.id)
+        self.assertEqual(refreshed_address.latitude, self.address.latitude)
+        self.assertFalse(utils.address_is_outdated(refreshed_address))
+        self.assertEqual(self.upstream.server.num_requests, 2)
+
+    def test_failed_background_refresh_is_logged(self):
+        self.set_address_age(utils.CONST_NUM_DAYS_ADDRESS_OUTDATED + 1)
+        self.upstream.server.fail_requests = True
+
+        with self.assertLogs("api.utils", level="WARNING") as logs:
+            stale_address = get_or_create_address(dict(self.address_dict))
+            utils.wait_for_address_refreshes(timeout=10)
+        self.assertEqual(stale_address.latitude, Decimal("1.0"))
+        self.assertIn("Could not refresh address {}.".format(self.address.id), logs.output[0])
+        self.assertTrue(utils.address_is_outdated(Address.objects.get(id=self.address.id)))
+
+    def test_address_past_hard_max_age_is_refreshed_synchronously(self):
+        self.set_address_age(settings.ADDRESS_HARD_MAX_AGE_DAYS + 1)
+
+        address = get_or_create_address(dict(self.address_dict))
+        self.assertNotEqual(address.latitude, Decimal("1.0"))
+        self.assertEqual(self.upstream.server.num_requests, 2)
+
+
+class TestNegativeCache(TransactionTestCase):
+    def setUp(self):
+        utils.address_cache.clear()
+        utils.negative_cache.clear()
+        self.upstream = StubUpstream().__enter__()
+        for api_name, path in (("Geolocate", "Geocode"), ("Routing", "FindDrivingRoute")):
+            API.objects.create(name=api_name, api_url=self.upstream.url + path, api_key="test", request_delay=0)
+
+    def tearDown(self):
+        self.upstream.__exit__()
+
+    def test_unknown_address_is_not_geocoded_twice(self):
+        address_dict = get_stub_address_dicts(1)[0]
+        address_dict['street'] = "1 Nowhere Lane"
+
+        for _ in range(3):
+            with self.assertRaises(AddressNotFoundException):
+                get_or_create_address(dict(address_dict))
+        with self.assertRaises(AddressNotFoundException):
+            get_or_create_addresses(get_stub_address_dicts(2) + [dict(address_dict)])
+        # The batch geocodes nothing, since it already knows one of its addresses is bad.
+        self.assertEqual(self.upstream.server.num_requests, 1)
+
+    def test_not_routable_stops_are_not_routed_twice(self):
+        addresses = get_or_create_addresses(get_stub_address_dicts(3))
+        num_requests = self.upstream.server.num_requests
+        self.upstream.server.not_routable = True
+
+        for _ in range(3):
+            with self.assertRaises(NotRoutableException):
+                utils.request_trueway_route(addresses, avoid_highways=False, avoid_tolls=False, avoid_ferries=True)
+        self.assertEqual(self.upstream.server.num_requests, num_requests + 1)
+
+        # Different avoid flags are a different route.
+        with self.assertRaises(NotRoutableException):
+            utils.request_trueway_route(addresses, avoid_highways=True, avoid_tolls=False, avoid_ferries=True)
+        self.assertEqual(self.upstream.server.num_requests, num_requests + 2)
+
+
+class TestMetrics(TestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_histogram_seconds", "A test.", label_names=('stage', ), buckets=(0.1, 1))
+        histogram.observe(0.05, 'a "quoted" stage')
+        histogram.observe(0.5, 'a "quoted" stage')
+        histogram.observe(5, 'a "quoted" stage')
+        with histogram.time("timed"):
+            pass
+        self.assertEqual(histogram.get_count("timed"), 1)
+
+        text = metrics.render()
+        self.assertIn("# TYPE traveling_salesman_test_histogram_seconds histogram", text)
+        labels = 'stage="a \\"quoted\\" stage"'
+        self.assertIn('traveling_salesman_test_histogram_seconds_bucket{{{},le="0.1",pid='.format(labels), text)
+        for line in text.splitlines():
+            if line.startswith("traveling_salesman_test_histogram_seconds") and labels in line:
+                if 'le="0.1"' in line:
+                    self.assertTrue(line.endswith(" 1"))
+                elif 'le="1"' in line:
+                    self.assertTrue(line.endswith(" 2"))
+                elif 'le="+Inf"' in line or "_count" in line:
+                    self.assertTrue(line.endswith(" 3"))
+                elif "_sum" in line:
+                    self.assertTrue(line.endswith(" 5.55"))
+
+    def test_span_overhead(self):
+        num_spans = 10000
+        start_time = time.perf_counter()
+        for _ in range(num_spans):
+            with metrics.stage_seconds.time("test_overhead"):
+                pass
+        # A few microseconds each, with plenty of room for a busy test machine.
+        self.assertLess((time.perf_counter() - start_time) / num_spans, 50e-6)
+
+    def test_metrics_view(self):
+        response = self.client.get("/api/metrics/", REMOTE_ADDR="127.0.0.1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], metrics.CONST_CONTENT_TYPE)
+        text = response.content.decode()
+        self.assertIn('traveling_salesman_cache_hit_ratio{cache="address",', text)
+        self.assertIn("traveling_salesman_route_jobs_queued{", text)
+
+        with override_settings(METRICS_ALLOWED_IPS=[]):
+            self.assertEqual(self.client.get("/api/metrics/", REMOTE_ADDR="127.0.0.1").status_code, 404)
+
+
+class TestSingleFlight(TransactionTestCase):
+    def setUp(self):
+        utils.address_cache.clear()
+        self.upstream = StubUpstream(latency_seconds=0.2).__enter__()
+        API.objects.create(
+            name="Geolocate", api_url=self.upstream.url + "Geocode", api_key="test", request_delay=0,
+            max_concurrent_requests=8
+        )
+
+    def tearDown(self):
+        self.upstream.__exit__()
+
+    def test_identical_geocode_calls_are_coalesced(self):
+        address_dict = get_stub_address_dicts(1)[0]
+        num_coalesced_before = utils.geocode_flight.get_stats()['coalesced']
+        results = []
+
+        def run():
+            results.append(utils._get_or_create_address_in_thread(dict(address_dict), None))
+
+        threads = [threading.Thread(target=run) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.upstream.server.num_requests, 1)
+        self.assertEqual(len(set(x.id for x in results)), 1)
+        self.assertEqual(utils.geocode_flight.get_stats()['coalesced'] - num_coalesced_before, 4)
+
+
+class TestCreateRouteWithStub(TransactionTestCase):
+    def setUp(self):
+        utils.address_cache.clear()
+        utils.route_cache.clear()
+        self.upstream = StubUpstream().__enter__()
+        for api_name, path in (("Geolocate", "Geocode"), ("Routing", "FindDrivingRoute")):
+            API.objects.create(
+                name=api_name, api_url=self.upstream.url + path, api_key="test", request_delay=0,
+                max_concurrent_requests=8
+            )
+
+    def tearDown(self):
+        self.upstream.__exit__()
+
+    def get_routing_data(self, num_intermediate_addresses: int) -> dict:
+        address_dicts = get_stub_address_dicts(num_intermediate_addresses + 2)
+        return {
+            'start_address': address_dicts[0],
+            'intermediate_addresses': address_dicts[1:-1],
+            'end_address': address_dicts[-1],
+        }
+
+    def test_create_route(self):
+        num_routing_api_stages = metrics.stage_seconds.get_count("routing_api")
+        num_routing_calls = metrics.api_calls_total.get("Routing")
+        route = create_route(self.get_routing_data(6))
+        self.assertIsInstance(route, Route)
+        self.assertEqual(metrics.stage_seconds.get_count("routing_api"), num_routing_api_stages + 1)
+        self.assertEqual(metrics.api_calls_total.get("Routing"), num_routing_calls + 1)
+
+        racs = list(route.get_route_address_connections())
+        self.assertEqual(len(racs), 7)
+        self.assertEqual(racs[0].address_connection.from_address.street, "100 MAIN ST")
+        self.assertEqual(racs[-1].address_connection.to_address.street, "107 MAIN ST")
+        for previous_rac, rac in zip(racs[:-1], racs[1:]):
+            self.assertEqual(previous_rac.address_connection.to_address, rac.address_connection.from_address)
+
+
+    def test_route_cache(self):
+        routing_data = self.get_routing_data(6)
+        first_route = create_route(copy.deepcopy(routing_data))
+        num_requests = self.upstream.server.num_requests
+        local_hits = utils.route_cache.get_stats()['local_hits']
+
+        routing_data['intermediate_addresses'].reverse()
+        second_route = create_route(routing_data)
+        self.assertEqual(self.upstream.server.num_requests, num_requests)
+        self.assertEqual(utils.route_cache.get_stats()['local_hits'], local_hits + 1)
+
+        self.assertNotEqual(first_route.id, second_route.id)
+        self.assertNotEqual(first_route.route_key, second_route.route_key)
+        self.assertEqual(
+            [x.address_connection_id for x in first_route.get_route_address_connections()],
+            [x.address_connection_id for x in second_route.get_route_address_connections()]
+        )
+
+        # Different flags are a different route.
+        routing_data = self.get_routing_data(6)
+        routing_data['avoid_tolls'] = True
+        create_route(routing_data)
+        self.assertEqual(self.upstream.server.num_requests, num_requests + 1)
+
+    def get_addresses(self, routing_data: dict) -> list:
+        utils.validate_routing_data(routing_data)  # Fills in the default avoid flags.
+        return get_or_create_addresses(
+            [routing_data['start_address'], ] + routing_data['intermediate_addresses'] + [routing_data['end_address'], ]
+        )
+
+    def save_previous_route(self, ordered_addresses: list, routing_data: dict):
+        legs = []
+        for from_address, to_address in zip(ordered_addresses[:-1], ordered_addresses[1:]):
+            meters = int(distance.distance(
+                (from_address.latitude, from_address.longitude), (to_address.latitude, to_address.longitude)
+            ).meters)
+            legs.append({'distance': meters, 'duration': meters // 25})
+        utils.save_legs_to_database(
+            legs, ordered_addresses, routing_data['avoid_highways'], routing_data['avoid_tolls'],
+            routing_data['avoid_ferries']
+        )
+
+    def test_create_route_from_saved_connections(self):
+        routing_data = self.get_routing_data(2)
+        start, first, second, end = self.get_addresses(routing_data)
+        # Two earlier routes through the same stops in either order saved every leg this route could use. Neither
+        # went straight from the start to the end, and that leg isn't needed.
+        self.save_previous_route([start, first, second, end], routing_data)
+        self.save_previous_route([start, second, first, end], routing_data)
+        self.assertFalse(AddressConnection.objects.filter(from_address=start, to_address=end).exists())
+        num_requests = self.upstream.server.num_requests
+
+        route = create_route(routing_data)
+        self.assertEqual(self.upstream.server.num_requests, num_requests)
+
+        racs = list(route.get_route_address_connections())
+        self.assertEqual(len(racs), 3)
+        self.assertEqual(racs[0].address_connection.from_address, start)
+        self.assertEqual(racs[-1].address_connection.to_address, end)
+        self.assertEqual({x.address_connection.to_address_id for x in racs[:-1]}, {first.id, second.id})
+
+    def test_create_route_fetches_missing_connections(self):
+        routing_data = self.get_routing_data(2)
+        start, first, second, end = self.get_addresses(routing_data)
+        self.save_previous_route([start, first, second, end], routing_data)
+        num_requests = self.upstream.server.num_requests
+
+        # Only the legs of the other order are missing, so they are routed on their own.
+        route = create_route(routing_data)
+        self.assertEqual(self.upstream.server.num_requests, num_requests + 3)
+        self.assertEqual(len(list(route.get_route_address_connections())), 3)
+        for from_address, to_address in ((start, second), (second, first), (first, end)):
+            self.assertTrue(AddressConnection.objects.filter(from_address=from_address, to_address=to_address).exists())
+
+    def test_create_route_with_missing_connection(self):
+        routing_data = self.get_routing_data(3)
+        addresses = self.get_addresses(routing_data)
+        self.save_previous_route(addresses, routing_data)
+        num_requests = self.upstream.server.num_requests
+
+        # Too many legs are missing, so the whole route is routed at once.
+        create_route(routing_data)
+        self.assertEqual(self.upstream.server.num_requests, num_requests + 1)
+
+    def test_create_large_route(self):
+        routing_data = self.get_routing_data(60)
+        addresses = get_or_create_addresses(
+            [routing_data['start_address'], ] + routing_data['intermediate_addresses'] + [routing_data['end_address'], ]
+        )
+        num_requests = self.upstream.server.num_requests
+
+        route = create_route(routing_data)
+        chunks = utils.get_route_chunks(len(addresses), utils.CONST_MAX_ROUTING_API_INTERMEDIATE_ADDRESSES)
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(all(last - first - 1 <= 20 for first, last in chunks))
+        self.assertEqual(self.upstream.server.num_requests, num_requests + len(chunks))
+
+        self.assertEqual(route.num_stops, 62)
+        racs = list(route.get_route_address_connections())
+        self.assertEqual(len(racs), 61)
+        self.assertEqual([x.order for x in racs], list(range(61)))
+        self.assertEqual(racs[0].address_connection.from_address, addresses[0])
+        self.assertEqual(racs[-1].address_connection.to_address, addresses[-1])
+        for previous_rac, rac in zip(racs[:-1], racs[1:]):
+            self.assertEqual(previous_rac.address_connection.to_address, rac.address_connection.from_address)
+        self.assertEqual(
+            sorted(x.address_connection.to_address_id for x in racs[:-1]), sorted(x.id for x in addresses[1:-1])
+        )
+
+    def test_too_many_intermediate_addresses(self):
+        with self.assertRaises(Exception):
+            create_route(self.get_routing_data(utils.CONST_MAX_INTERMEDIATE_ADDRESSES + 1))
+        self.assertEqual(self.upstream.server.num_requests, 0)
+
+
+@override_settings(ROUTE_JOBS_IN_PROCESS=False)
+class TestRouteJobs(TransactionTestCase):
+    def setUp(self):
+        utils.address_cache.clear()
+        utils.negative_cache.clear()
+        utils.route_cache.clear()
+        hashed_ip_cache.clear()
+        self.upstream = StubUpstream().__enter__()
+        for api_name, path in (("Geolocate", "Geocode"), ("Routing", "FindDrivingRoute")):
+            API.objects.create(
+                name=api_name, api_url=self.upstream.url + path, api_key="test", request_delay=0,
+                max_concurrent_requests=8
+            )
+
+    def tearDown(self):
+        self.upstream.__exit__()
+
+    def get_routing_data(self) -> dict:
+        address_dicts = get_stub_address_dicts(5)
+        return {
+            'start_address': address_dicts[0],
+            'intermediate_addresses': address_dicts[1:-1],
+            'end_address': address_dicts[-1],
+        }
+
+    def test_run_route_job(self):
+        job = jobs.enqueue_route_job(self.get_routing_data())
+        self.assertEqual(job.status, RouteJob.CONST_STATUS_QUEUED)
+
+        claimed_job = jobs.claim_next_route_job()
+        self.assertEqual(claimed_job.id, job.id)
+        self.assertIsNone(jobs.claim_next_route_job())
+        jobs.run_route_job(claimed_job)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, RouteJob.CONST_STATUS_FINISHED)
+        self.assertEqual(len(job.route.get_route_address_connections()), 4)
+
+    def test_not_routable(self):
+        self.upstream.server.not_routable = True
+        tracked_action = TrackedAction.objects.create(
+            hashed_ip=HashedIP.objects.create(hashed_ip="127.0.0.1"), action_type="test"
+        )
+        blacklisted_jwt = JWTBlacklist.objects.create(jti="test")
+        job = jobs.enqueue_route_job(
+            self.get_routing_data(), tracked_action=tracked_action, blacklisted_jwt=blacklisted_jwt
+        )
+        jobs.run_route_job(jobs.claim_next_route_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, RouteJob.CONST_STATUS_NOT_ROUTABLE)
+        self.assertFalse(TrackedAction.objects.filter(id=tracked_action.id).exists())
+        self.assertFalse(JWTBlacklist.objects.filter(id=blacklisted_jwt.id).exists())
+
+    def test_requeue_stale_route_jobs(self):
+        job = jobs.enqueue_route_job(self.get_routing_data())
+        jobs.claim_next_route_job()
+        self.assertEqual(jobs.requeue_stale_route_jobs(), 0)
+
+        RouteJob.objects.filter(id=job.id).update(
+            updated_at=datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+                seconds=jobs.CONST_ROUTE_JOB_STALE_SECONDS + 1
+            )
+        )
+        self.assertEqual(jobs.requeue_stale_route_jobs(), 1)
+        self.assertEqual(jobs.claim_next_route_job().id, job.id)
+
+    @override_settings(ROUTE_JOBS_IN_PROCESS=True)
+    def test_resume_stale_route_job(self):
+        # Queued by a process that died before running it.
+        job = RouteJob.objects.create(payload=self.get_routing_data())
+        self.assertIsNone(jobs.resume_stale_route_job(job))
+
+        RouteJob.objects.filter(id=job.id).update(
+            updated_at=datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+                seconds=jobs.CONST_ROUTE_JOB_STALE_SECONDS + 1
+            )
+        )
+        job.refresh_from_db()
+        future = jobs.resume_stale_route_job(job)
+        self.assertIsNotNone(future)
+        # Only the first poller resumes it.
+        self.assertIsNone(jobs.resume_stale_route_job(job))
+
+        future.result()
+        job.refresh_from_db()
+        self.assertEqual(job.status, RouteJob.CONST_STATUS_FINISHED)
+
+    @override_settings(ROUTE_JOBS_IN_PROCESS=True)
+    def test_running_job_is_not_resumed_during_a_long_stage(self):
+        heartbeat_seconds = jobs.CONST_ROUTE_JOB_HEARTBEAT_SECONDS
+        jobs.CONST_ROUTE_JOB_HEARTBEAT_SECONDS = 0.01
+        self.addCleanup(setattr, jobs, 'CONST_ROUTE_JOB_HEARTBEAT_SECONDS', heartbeat_seconds)
+
+        job = RouteJob.objects.create(payload=self.get_routing_data())
+        # Hold the geocoding calls, so the job stays in its first stage.
+        self.upstream.server.gate.clear()
+        future = jobs.route_job_executor.submit(jobs._run_route_job_in_thread, job.id)
+        while not future.done() and not RouteJob.objects.filter(
+                id=job.id, status=RouteJob.CONST_STATUS_RUNNING, progress=utils.CONST_PROGRESS_GEOCODING
+        ).exists():
+            time.sleep(0.001)
+
+        # The stage has now lasted longer than the stale time, without any progress updates.
+        stale_at = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(
+            seconds=jobs.CONST_ROUTE_JOB_STALE_SECONDS + 1
+        )
+        RouteJob.objects.filter(id=job.id).update(updated_at=stale_at)
+        while not future.done() and RouteJob.objects.filter(id=job.id, updated_at=stale_at).exists():
+            time.sleep(0.001)
+
+        # A poll lands in the middle of the stage.
+        job.refresh_from_db()
+        self.assertEqual(job.progress, utils.CONST_PROGRESS_GEOCODING)
+        self.assertIsNone(jobs.resume_stale_route_job(job))
+
+        self.upstream.server.gate.set()
+        future.result()
+        job.refresh_from_db()
+        self.assertEqual(job.status, RouteJob.CONST_STATUS_FINISHED)
+        self.assertEqual(Route.objects.count(), 1)
+
+    @override_settings(ROUTE_JOBS_IN_PROCESS=True)
+    def test_route_view(self):
+        client = DRFAPIClient()
+        user = User.objects.create_user(username="route_job_test", password="password")
+        client.credentials(HTTP_AUTHORIZATION="Bearer {}".format(RefreshToken.for_user(user).access_token))
+
+        response = client.post("/api/generate_route/", self.get_routing_data(), format='json')
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+
+        for _ in range(100):
+            result = client.get(status_url).json()
+            if result['status'] in RouteJob.CONST_DONE_STATUSES:
+                break
+            time.sleep(0.05)
+        self.assertEqual(result['status'], RouteJob.CONST_STATUS_FINISHED)
+        self.assertTrue(Route.objects.filter(route_key=result['route_key']).exists())
+
+    def test_invalid_routing_data_is_rejected(self):
+        routing_data = self.get_routing_data()
+        del routing_data['end_address']
+        with self.assertRaises(Exception):
+            utils.validate_routing_data(routing_data)
+
+
+class TestSaveRoute(TestCase):
+    def get_addresses(self, num_addresses: int, street_name: str) -> list:
+        addresses = []
+        for index in range(num_addresses):
+            address = Address(
+                street="{} {}".format(index, street_name), city="LITTLE ROCK", state="AR", postal_code="72201",
+                country="UNITED STATES", latitude=Decimal("34.7") + Decimal(index) / 100, longitude=Decimal("-92.3")
+            )
+            address.save()
+            addresses.append(address)
+        return addresses
+
+    def save_route(self, addresses: list, travel_seconds: int) -> tuple:
+        legs = [
+            {
+                'start_point': {'lat': float(a.latitude), 'lng': float(a.longitude)},
+                'end_point': {'lat': float(b.latitude), 'lng': float(b.longitude)},
+                'distance': 1000,
+                'duration': travel_seconds,
+            }
+            for a, b in zip(addresses[:-1], addresses[1:])
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            route = utils.save_trueway_routing_json_to_database(
+                legs, addresses[0], addresses[1:-1], addresses[-1],
+                avoid_highways=False, avoid_tolls=False, avoid_ferries=True
+            )
+        return route, len(queries)
+
+    def test_constant_number_of_queries(self):
+        small_addresses = self.get_addresses(3, "SMALL ST")
+        large_addresses = self.get_addresses(22, "LARGE ST")
+
+        # Every connection is new.
+        _, small_num_queries = self.save_route(small_addresses, travel_seconds=60)
+        _, large_num_queries = self.save_route(large_addresses, travel_seconds=60)
+        self.assertEqual(small_num_queries, large_num_queries)
+
+        # Every connection already exists.
+        _, small_num_queries = self.save_route(small_addresses, travel_seconds=90)
+        route, large_num_queries = self.save_route(large_addresses, travel_seconds=90)
+        self.assertEqual(small_num_queries, large_num_queries)
+
+        racs = list(RouteAddressConnection.objects.filter(route=route).order_by('order'))
+        self.assertEqual([x.order for x in racs], list(range(21)))
+        self.assertEqual(
+            [x.address_connection.from_address_id for x in racs] + [racs[-1].address_connection.to_address_id],
+            [x.id for x in large_addresses]
+        )
+        self.assertTrue(all(x.address_connection.travel_seconds == 90 for x in racs))
+        self.assertEqual(AddressConnection.objects.count(), 2 + 21)
+
+    def test_route_keeps_its_legs(self):
+        addresses = self.get_addresses(3, "MAIN ST")
+        first_route, _ = self.save_route(addresses, travel_seconds=60)
+        second_route, _ = self.save_route(addresses, travel_seconds=90)
+
+        # The second route updated the shared connections, but the first route still shows the legs it was saved with.
+        first_route = Route.objects.get(id=first_route.id)
+        racs = first_route.get_route_address_connections()
+        self.assertTrue(all(x.address_connection.travel_seconds == 90 for x in racs))
+        self.assertEqual([x.get_travel_seconds() for x in racs], [60, 60])
+        self.assertEqual(first_route.total_travel_seconds, sum(x.get_travel_seconds() for x in racs))
+        self.assertEqual(second_route.total_travel_seconds, 180)
+
+
+class TestSolver(unittest.TestCase):
+    def get_brute_force_cost(self, matrix: np.ndarray) -> float:
+        num_nodes = matrix.shape[0]
+        return min(
+            solver.get_path_cost(matrix, [0, ] + list(order) + [num_nodes - 1, ])
+            for order in itertools.permutations(range(1, num_nodes - 1))
+        )
+
+    def test_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        for num_nodes in range(2, 10):
+            for _ in range(5):
+                matrix = rng.integers(1, 10000, size=(num_nodes, num_nodes)).astype(float)
+                order = solver.solve_fixed_endpoint_path(matrix)
+                self.assertEqual(order[0], 0)
+                self.assertEqual(order[-1], num_nodes - 1)
+                self.assertEqual(sorted(order), list(range(num_nodes)))
+                self.assertEqual(solver.get_path_cost(matrix, order), self.get_brute_force_cost(matrix))
+
+    def test_missing_legs(self):
+        matrix = np.full((4, 4), np.inf)
+        matrix[0, 2] = matrix[2, 1] = matrix[1, 3] = 5
+        self.assertEqual(solver.solve_fixed_endpoint_path(matrix), [0, 2, 1, 3])
+
+        matrix[1, 3] = np.inf
+        self.assertIsNone(solver.solve_fixed_endpoint_path(matrix))
+
+    def test_too_many_stops(self):
+        num_nodes = solver.CONST_MAX_INTERMEDIATE_STOPS + 3
+        self.assertIsNone(solver.solve_fixed_endpoint_path(np.ones((num_nodes, num_nodes))))
+
+    def test_largest_route(self):
+        num_nodes = solver.CONST_MAX_INTERMEDIATE_STOPS + 2
+        matrix = np.random.default_rng(0).integers(1, 10000, size=(num_nodes, num_nodes)).astype(float)
+
+        start_time = time.perf_counter()
+        order = solver.solve_fixed_endpoint_path(matrix)
+        print("Solved {} intermediate stops in {:.3f} seconds.".format(
+            solver.CONST_MAX_INTERMEDIATE_STOPS, time.perf_counter() - start_time
+        ))
+        self.assertEqual(sorted(order), list(range(num_nodes)))
+        self.assertIsNone(solver.solve_fixed_endpoint_path(matrix, time_budget_seconds=0))
+
+    def test_heuristic_path(self):
+        coordinates = np.random.default_rng(0).uniform(0, 1, size=(200, 2))
+        matrix = np.linalg.norm(coordinates[:, np.newaxis, :] - coordinates[np.newaxis, :, :], axis=2)
+
+        start_time = time.perf_counter()
+        order = solver.get_heuristic_fixed_endpoint_path(matrix)
+        print("Ordered 200 stops in {:.3f} seconds.".format(time.perf_counter() - start_time))
+        self.assertEqual(order[0], 0)
+        self.assertEqual(order[-1], 199)
+        self.assertEqual(sorted(order), list(range(200)))
+        self.assertLessEqual(
+            solver.get_path_cost(matrix, order), solver.get_path_cost(matrix, solver.get_nearest_neighbor_path(matrix))
+        )
+
+        # Stops along a line are visited in order.
+        positions = np.array([0, 5, 2, 9, 1, 7, 3, 10], dtype=float)
+        matrix = np.abs(positions[:, np.newaxis] - positions[np.newaxis, :])
+        order = solver.get_heuristic_fixed_endpoint_path(matrix)
+        self.assertEqual(list(positions[order]), sorted(positions))
+
+
+class TestDistance(unittest.TestCase):
+    def get_random_coordinates(self, num_points: int, seed: int = 0) -> list:
+        rng = np.random.default_rng(seed)
+        return list(zip(rng.uniform(-80, 80, num_points), rng.uniform(-180, 180, num_points)))
+
+    def test_geodesic_matches_geopy(self):
+        points = self.get_random_coordinates(22) + [(0.0, 0.0), (0.0, 0.0), (0.0, 179.7), (0.5, -179.7)]
+
+        start_time = time.perf_counter()
+        expected = np.array([[distance.distance(a, b).meters for b in points] for a in points])
+        geopy_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        result = api_distance.get_distance_matrix(points, method=api_distance.CONST_METHOD_GEODESIC)
+        geodesic_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        haversine = api_distance.get_distance_matrix(points, method=api_distance.CONST_METHOD_HAVERSINE)
+        haversine_seconds = time.perf_counter() - start_time
+
+        print("{0}x{0} distance matrix: geopy {1:.4f}s, geodesic {2:.4f}s, haversine {3:.4f}s".format(
+            len(points), geopy_seconds, geodesic_seconds, haversine_seconds
+        ))
+        self.assertTrue(np.allclose(result, expected, rtol=0, atol=0.001))
+        self.assertTrue(np.allclose(haversine, expected, rtol=0.006, atol=0.001))
+
+    def test_point_to_set(self):
+        points = self.get_random_coordinates(10)
+        distances = api_distance.get_distances_to_point(points[3], points, method=api_distance.CONST_METHOD_GEODESIC)
+        self.assertEqual(distances.shape, (10,))
+        self.assertEqual(int(np.argmin(distances)), 3)
+        self.assertAlmostEqual(distances[5], distance.distance(points[3], points[5]).meters, places=3)
+
+    def test_addresses(self):
+        address = Address(latitude=Decimal("38.576"), longitude=Decimal("-121.494"))
+        matrix = api_distance.get_distance_matrix([address, ], [(38.576, -121.494), (39.576, -121.494)])
+        self.assertEqual(matrix.shape, (1, 2))
+        self.assertAlmostEqual(matrix[0, 0], 0)
+        self.assertAlmostEqual(matrix[0, 1], 111195, delta=10)
+
+
+class TestMatching(unittest.TestCase):
+    def get_legs(self, addresses: list, offset_degrees: float = 0.0) -> list:
+        def get_point(address: Address) -> dict:
+            return {'lat': float(address.latitude) + offset_degrees, 'lng': float(address.longitude) - offset_degrees}
+        return [
+            {'start_point': get_point(a), 'end_point': get_point(b), 'distance': 0, 'duration': 0}
+            for a, b in zip(addresses[:-1], addresses[1:])
+        ]
+
+    def get_addresses(self, num_addresses: int, seed: int = 0) -> list:
+        rng = np.random.default_rng(seed)
+        coordinates = zip(rng.uniform(38, 39, num_addresses), rng.uniform(-122, -121, num_addresses))
+        return [
+            Address(id=index, latitude=Decimal("{:.6f}".format(lat)), longitude=Decimal("{:.6f}".format(lng)))
+            for index, (lat, lng) in enumerate(coordinates)
+        ]
+
+    def test_assignment_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        for num_rows in range(1, 7):
+            for num_columns in (num_rows, num_rows + 2):
+                cost = rng.integers(0, 100, size=(num_rows, num_columns)).astype(float)
+                rows, columns = matching.get_linear_sum_assignment(cost)
+                self.assertEqual(len(set(columns)), num_rows)
+                expected = min(
+                    sum(cost[r, c] for r, c in zip(range(num_rows), x))
+                    for x in itertools.permutations(range(num_columns), num_rows)
+                )
+                self.assertEqual(cost[rows, columns].sum(), expected)
+
+    def test_close_stops(self):
+        # The leg endpoints are closer to the wrong stop of each close pair, so greedy matching swaps them.
+        addresses = [
+            Address(id=0, latitude=Decimal("38.5"), longitude=Decimal("-121.5")),
+            Address(id=1, latitude=Decimal("38.6"), longitude=Decimal("-121.5")),
+            Address(id=2, latitude=Decimal("38.6001"), longitude=Decimal("-121.5")),
+            Address(id=3, latitude=Decimal("38.7"), longitude=Decimal("-121.5")),
+        ]
+        legs = self.get_legs(addresses)
+        legs[0]['end_point']['lat'] = legs[1]['start_point']['lat'] = 38.60006
+
+        ordered_addresses, residuals = matching.match_legs_to_addresses(
+            legs, addresses[0], [addresses[2], addresses[1]], addresses[3]
+        )
+        self.assertEqual([x.id for x in ordered_addresses], [0, 1, 2, 3])
+        self.assertLess(residuals.max(), 10)
+
+    def test_22_stops(self):
+        addresses = self.get_addresses(22)
+        legs = self.get_legs(addresses, offset_degrees=0.0002)
+        intermediate_addresses = list(addresses[1:-1])
+        random.shuffle(intermediate_addresses)
+
+        start_time = time.perf_counter()
+        ordered_addresses, residuals = matching.match_legs_to_addresses(
+            legs, addresses[0], intermediate_addresses, addresses[-1]
+        )
+        matching_seconds = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        remaining_addresses = [addresses[0], ] + intermediate_addresses + [addresses[-1], ]
+        for leg in legs:
+            from_address = utils.get_closest_address_to_coordinates(
+                (leg['start_point']['lat'], leg['start_point']['lng']), remaining_addresses
+            )
+            remaining_addresses.remove(from_address)
+            utils.get_closest_address_to_coordinates(
+                (leg['end_point']['lat'], leg['end_point']['lng']), remaining_addresses
+            )
+        greedy_seconds = time.perf_counter() - start_time
+
+        print("Matched 22 stops in {:.4f}s (greedy: {:.4f}s). Largest residual: {:.1f} meters.".format(
+            matching_seconds, greedy_seconds, residuals.max()
+        ))
+        self.assertEqual([x.id for x in ordered_addresses], [x.id for x in addresses])
+        self.assertLess(residuals.max(), 50)
+
+    def test_wrong_number_of_legs(self):
+        addresses = self.get_addresses(4)
+        with self.assertRaises(Exception):
+            matching.match_legs_to_addresses(self.get_legs(addresses[:3]), addresses[0], addresses[1:3], addresses[3])
+
+
 class TestAPIRoute(unittest.TestCase):
     def test_get_response_with_server(self):
         # Get the token.
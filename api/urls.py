@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from . import views
@@ -5,6 +6,16 @@ from . import views
 urlpatterns = [
     path('token/', TokenObtainPairView.as_view(), name="api_token_get"),
     path('token/refresh/', TokenRefreshView.as_view(), name="api_token_refresh"),
-    path('geolocate/', views.geolocate, name="api_geolocate"),
-    path('generate_route/', views.route_addresses, name="api_route_coordinates"),
+    path(
+        'geolocate/',
+        views.geolocate_async if settings.API_ASYNC_VIEWS else views.geolocate,
+        name="api_geolocate"
+    ),
+    path(
+        'generate_route/',
+        views.route_addresses_async if settings.API_ASYNC_VIEWS else views.route_addresses,
+        name="api_route_coordinates"
+    ),
+    path('route_jobs/<uuid:job_id>/', views.route_job_status, name="api_route_job_status"),
+    path('metrics/', views.metrics_view, name="api_metrics"),
 ]
@@ -1,26 +1,93 @@
-import copy
 import datetime
+import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from decimal import Decimal
 
-import requests
-from geopy import distance
+from django.conf import settings
+from django.db import connections, transaction, IntegrityError
+from django.db.models import prefetch_related_objects
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import numpy as np
 
+from api import distance, http_client, matching, metrics, scheduler, solver
+from api.caching import TwoTierCache
+from api.single_flight import SingleFlight
 from api.models import API, APIRequest
-from exceptions import NotRoutableException
-from routing.models import Address, Route, RouteAddressConnection, AddressConnection
+from exceptions import NotRoutableException, AddressNotFoundException
+from routing.models import Address, Route, RouteAddressConnection, AddressConnection, get_address_key, \
+    get_cleaned_address_tuple
+
+logger = logging.getLogger(__name__)
+
+CONST_START_ADDRESS_KEY = 'start_address'
+CONST_INTERMEDIATE_ADDRESSES_KEY = 'intermediate_addresses'
+CONST_END_ADDRESS_KEY = 'end_address'
+
+CONST_PROGRESS_GEOCODING = "Finding your addresses"
+CONST_PROGRESS_ROUTING = "Planning your route"
+CONST_PROGRESS_SAVING = "Saving your route"
 
 CONST_NUM_DAYS_ADDRESS_OUTDATED = 30
+CONST_MAX_GEOCODE_WORKERS = 8  # Upper bound on concurrent geocoding threads per route.
+CONST_ADDRESS_CACHE_MAX_ENTRIES = 10000
+CONST_ADDRESS_CACHE_LOCAL_TTL_SECONDS = 5 * 60  # How long other workers may serve an address after it changes.
+CONST_MAX_ADDRESS_REFRESH_WORKERS = 2  # Background threads that re-geocode outdated addresses.
+CONST_NEGATIVE_CACHE_MAX_ENTRIES = 5000
+CONST_NEGATIVE_CACHE_TTL_SECONDS = 60 * 60
+CONST_NUM_DAYS_CONNECTION_OUTDATED = 30  # Saved travel times older than this aren't used to solve routes locally.
+CONST_LOCAL_SOLVER_TIME_BUDGET_SECONDS = 0.5
+# Each missing leg is its own routing API call, while routing the whole route is one call. Only fetch a few.
+CONST_MAX_MISSING_LEGS_TO_FETCH = 3
+CONST_ROUTE_CACHE_MAX_ENTRIES = 2000
+CONST_ROUTE_CACHE_LOCAL_TTL_SECONDS = 5 * 60
+CONST_ROUTE_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60  # Traffic patterns change, so re-optimize routes after a week.
+CONST_MAX_ROUTING_API_INTERMEDIATE_ADDRESSES = 20  # The most intermediate stops the routing API accepts at once.
+CONST_MAX_INTERMEDIATE_ADDRESSES = 200  # Routes with more than the routing API accepts are routed in chunks.
+CONST_MAX_ROUTE_CHUNK_WORKERS = 8  # Upper bound on concurrent routing threads per route.
+CONST_LARGE_ROUTE_ORDER_TIME_BUDGET_SECONDS = 2.0
+
+# Geocoded addresses, keyed on the cleaned (street, city, state, postal_code, country) tuple. Entries expire when the
+# address reaches settings.ADDRESS_HARD_MAX_AGE_DAYS, after which get_or_create_address() must re-geocode it before
+# returning.
+address_cache = TwoTierCache(
+    name="address",
+    max_local_entries=CONST_ADDRESS_CACHE_MAX_ENTRIES,
+    local_ttl_seconds=CONST_ADDRESS_CACHE_LOCAL_TTL_SECONDS
+)
+
+# Addresses the geolocation API could not find, and stops the routing API could not route. Kept briefly, so that
+# repeated submissions of known-bad input fail without spending API quota.
+negative_cache = TwoTierCache(
+    name="negative",
+    max_local_entries=CONST_NEGATIVE_CACHE_MAX_ENTRIES,
+    local_ttl_seconds=CONST_NEGATIVE_CACHE_TTL_SECONDS
+)
 
+# The ordered AddressConnection ids of solved routes, keyed on their stops and avoid flags. A repeated submission is
+# rebuilt from these legs instead of calling the routing API.
+route_cache = TwoTierCache(
+    name="route",
+    max_local_entries=CONST_ROUTE_CACHE_MAX_ENTRIES,
+    local_ttl_seconds=CONST_ROUTE_CACHE_LOCAL_TTL_SECONDS
+)
 
-def wait_for_api_request(api: API, api_request: APIRequest):
-    # Wait until this view's request is queued up.
-    next_id = -1
-    while api_request.id != next_id:
-        time.sleep(0.05)
-        next_id = APIRequest.objects.filter(api=api, status="waiting").order_by("id").first().id
+metrics.register_cache("address", address_cache)
+metrics.register_cache("negative", negative_cache)
+metrics.register_cache("route", route_cache)
 
-    # Wait to prevent overburdening the external API.
-    time.sleep(int(api.request_delay))
+# Concurrent identical geocoding and routing calls in this process share one external API call.
+geocode_flight = SingleFlight(name="geocode")
+route_flight = SingleFlight(name="route")
+
+# Outdated addresses are returned right away and re-geocoded by these threads.
+address_refresh_executor = ThreadPoolExecutor(
+    max_workers=CONST_MAX_ADDRESS_REFRESH_WORKERS, thread_name_prefix="address_refresh"
+)
+_pending_address_refreshes = {}  # address tuple -> Future
+_pending_address_refreshes_lock = threading.Lock()
 
 
 def get_closest_address_to_coordinates(coordinates: list or tuple, address_list: list) -> Address:
@@ -30,13 +97,8 @@ def get_closest_address_to_coordinates(coordinates: list or tuple, address_list:
     assert isinstance(coordinates[1], float)
     assert len(address_list) > 0
 
-    address_list.sort(
-        key=lambda x: distance.distance(
-            coordinates,
-            (x.latitude, x.longitude)
-        ).meters
-    )
-    return address_list[0]
+    distances = distance.get_distances_to_point(coordinates, address_list, method=distance.CONST_METHOD_GEODESIC)
+    return address_list[int(np.argmin(distances))]
 
 
 def save_trueway_routing_json_to_database(
@@ -48,95 +110,415 @@ def save_trueway_routing_json_to_database(
         avoid_tolls: bool,
         avoid_ferries: bool
 ) -> Route:
-    # Convert leg data to address_connections while preserving the route order.
-    address_connections = []
-    temp_address_list = [start_address, ] + copy.deepcopy(intermediate_addresses) + [end_address, ]
-    print("Processing legs in route...")
-    for leg in legs:
-        leg_duration_seconds = leg['duration']
-        leg_distance_meters = leg['distance']
-        start_coordinates = (leg['start_point']['lat'], leg['start_point']['lng'])
-        end_coordinates = (leg['end_point']['lat'], leg['end_point']['lng'])
-
-        from_address = get_closest_address_to_coordinates(start_coordinates, temp_address_list)
-        temp_address_list.pop(temp_address_list.index(from_address))  # Only use each address once.
-        to_address = get_closest_address_to_coordinates(end_coordinates, temp_address_list)
-
-        # Get the address connection if it already exists in the database. Otherwise, create it.
-        address_connection = AddressConnection.objects.filter(
-            from_address=from_address,
-            to_address=to_address,
-            avoid_highways=avoid_highways,
-            avoid_tolls=avoid_tolls,
-            avoid_ferries=avoid_ferries
-        ).first()
-        if address_connection:
-            address_connection.distance_meters = leg_distance_meters
-            address_connection.travel_seconds = leg_duration_seconds
-            address_connection.save()  # Update the information.
-        else:
-            address_connection = AddressConnection(
-                from_address=from_address,
-                to_address=to_address,
+    """
+    Match the routing API's legs to the addresses, then save them with save_legs_to_database().
+    """
+    with metrics.stage_seconds.time("match_legs"):
+        ordered_addresses, residuals = matching.match_legs_to_addresses(
+            legs, start_address, intermediate_addresses, end_address
+        )
+    logger.debug("Matched legs to addresses. Largest distance from a leg endpoint: %.0f meters.", residuals.max())
+
+    # Validate that the route start and end addresses are correct,
+    # and that they weren't mixed in with the intermediate addresses.
+    assert len(legs) >= 1  # Only 1 in case of no intermediate addresses.
+    assert ordered_addresses[0] == start_address
+    assert ordered_addresses[-1] == end_address
+
+    with metrics.stage_seconds.time("save_route"):
+        return save_legs_to_database(legs, ordered_addresses, avoid_highways, avoid_tolls, avoid_ferries)
+
+
+def save_legs_to_database(
+        legs: list,
+        ordered_addresses: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool
+) -> Route:
+    """
+    Save each leg as the AddressConnection between its two addresses and create a Route from them.
+
+    Everything is written in one transaction with a fixed number of queries, however many stops the route has.
+
+    :param legs: The routing API's legs, in route order.
+    :param ordered_addresses: The route's addresses in visiting order. Leg i goes from address i to address i + 1.
+    """
+    assert len(legs) == len(ordered_addresses) - 1
+    address_pairs = [(a.id, b.id) for a, b in zip(ordered_addresses[:-1], ordered_addresses[1:])]
+
+    with transaction.atomic():
+        connections = save_address_connections(legs, address_pairs, avoid_highways, avoid_tolls, avoid_ferries)
+        return save_route_from_address_connections([connections[x] for x in address_pairs])
+
+
+def save_address_connections(
+        legs: list,
+        address_pairs: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool
+) -> dict:
+    """
+    Save each leg as the AddressConnection between its two addresses, updating the connections that already exist.
+
+    :param address_pairs: A (from_address_id, to_address_id) tuple for each leg.
+    :return: The saved AddressConnection models, by (from_address_id, to_address_id).
+    """
+    assert len(legs) == len(address_pairs)
+    address_ids = {x for pair in address_pairs for x in pair}
+
+    def get_existing_connections() -> dict:
+        return {
+            (x.from_address_id, x.to_address_id): x
+            for x in AddressConnection.objects.filter(
+                from_address_id__in=address_ids,
+                to_address_id__in=address_ids,
                 avoid_highways=avoid_highways,
                 avoid_tolls=avoid_tolls,
-                avoid_ferries=avoid_ferries,
-                distance_meters=leg_distance_meters,
-                travel_seconds=leg_duration_seconds,
+                avoid_ferries=avoid_ferries
             )
-            address_connection.save()  # Create the information
-        address_connections.append(address_connection)
+        }
 
-    # Validate that the route start and end addresses are correct,
-    # and that they weren't mixed in with the intermediate addresses.
-    print("Asserting address connections...")
-    assert len(address_connections) >= 1  # Only 1 in case of no intermediate addresses.
-    assert address_connections[0].from_address == start_address
-    assert address_connections[-1].to_address == end_address
-
-    # TODO: Django cannot use foreign objects until they are saved.
-    #  Save foreign models first, then revert back by deleting in case of errors.
-    print("Saving data to database...")
-    route = Route()
-    route_address_connections = []
-    try:
-        # Save the address connections so they can be referenced by later modules.
-        for connection in address_connections:
-            connection.save()
+    with transaction.atomic():
+        # Update the connections that already exist and create the rest.
+        existing_connections = get_existing_connections()
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        updated_connections = {}
+        new_connections = {}
+        for leg, (from_address_id, to_address_id) in zip(legs, address_pairs):
+            address_connection = existing_connections.get((from_address_id, to_address_id))
+            if address_connection is not None:
+                address_connection.distance_meters = leg['distance']
+                address_connection.travel_seconds = leg['duration']
+                address_connection.updated_at = now  # bulk_update() doesn't apply auto_now.
+                updated_connections[address_connection.id] = address_connection
+            else:
+                new_connections[(from_address_id, to_address_id)] = AddressConnection(
+                    from_address_id=from_address_id,
+                    to_address_id=to_address_id,
+                    avoid_highways=avoid_highways,
+                    avoid_tolls=avoid_tolls,
+                    avoid_ferries=avoid_ferries,
+                    distance_meters=leg['distance'],
+                    travel_seconds=leg['duration'],
+                )
+        if updated_connections:
+            AddressConnection.objects.bulk_update(
+                updated_connections.values(), ['distance_meters', 'travel_seconds', 'updated_at']
+            )
+        if new_connections:
+            AddressConnection.objects.bulk_create(new_connections.values())
+            existing_connections.update(new_connections)
+            # MySQL doesn't return the ids of bulk-created rows, so look them up.
+            if any(x.id is None for x in new_connections.values()):
+                existing_connections = get_existing_connections()
 
-        # NOTE: In case additional data is saved for user notes, to make each user's route unique for them, don't
-        #   search for existing routes. Otherwise, it would pull up someone else's information.
-        #   If I decide that will never happen, it would be more space-efficient to search for existing routes rather
-        #   than creating new ones.
+    return {x: existing_connections[x] for x in address_pairs}
 
-        # Since the route doesn't already exist, create it.
+
+def save_route_from_address_connections(address_connections: list) -> Route:
+    """
+    Create a new Route made of saved AddressConnection models, in route order.
+    """
+    # NOTE: In case additional data is saved for user notes, to make each user's route unique for them, don't
+    #   search for existing routes. Otherwise, it would pull up someone else's information.
+    #   If I decide that will never happen, it would be more space-efficient to search for existing routes rather
+    #   than creating new ones.
+    # The map parameters need the addresses. Load them all at once instead of one at a time.
+    prefetch_related_objects(address_connections, 'from_address', 'to_address')
+    route_address_connections = [
+        RouteAddressConnection(address_connection=connection, order=index)
+        for index, connection in enumerate(address_connections)
+    ]
+    for route_address_connection in route_address_connections:
+        route_address_connection.set_leg()
+    with transaction.atomic():
+        route = Route()
+        route.set_totals(route_address_connections)
         route.save()
-        for index, connection in enumerate(address_connections):
-            route_address_connection = RouteAddressConnection(
-                route=route,
-                address_connection=connection,
-                order=index
+        for route_address_connection in route_address_connections:
+            route_address_connection.route = route
+        RouteAddressConnection.objects.bulk_create(route_address_connections)
+    return route
+
+
+def get_cached_connection_matrix(
+        addresses: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool
+) -> tuple:
+    """
+    Build a travel time matrix for the addresses from AddressConnection records saved by earlier routes.
+
+    :return: A (matrix, connections) tuple. matrix[i, j] is the travel time in seconds from addresses[i] to
+        addresses[j], or numpy.inf if there is no recent connection. connections maps (from_address_id, to_address_id)
+        to its AddressConnection.
+    """
+    address_ids = [x.id for x in addresses]
+    oldest_allowed = datetime.datetime.now(tz=datetime.timezone.utc) - \
+        datetime.timedelta(days=CONST_NUM_DAYS_CONNECTION_OUTDATED)
+    connections = {
+        (x.from_address_id, x.to_address_id): x
+        for x in AddressConnection.objects.filter(
+            from_address_id__in=set(address_ids),
+            to_address_id__in=set(address_ids),
+            avoid_highways=avoid_highways,
+            avoid_tolls=avoid_tolls,
+            avoid_ferries=avoid_ferries,
+            updated_at__gte=oldest_allowed
+        )
+    }
+
+    matrix = np.full((len(addresses), len(addresses)), np.inf)
+    for i, from_address_id in enumerate(address_ids):
+        for j, to_address_id in enumerate(address_ids):
+            connection = connections.get((from_address_id, to_address_id))
+            if connection is not None:
+                matrix[i, j] = connection.travel_seconds
+    return matrix, connections
+
+
+def get_usable_legs(num_addresses: int) -> np.ndarray:
+    """
+    :return: A boolean matrix that is True for the legs a route through every address could use. The route starts at
+        the first address and ends at the last, so nothing goes into the start or out of the end, and the start only
+        goes straight to the end when there are no other stops.
+    """
+    usable_legs = np.ones((num_addresses, num_addresses), dtype=bool)
+    np.fill_diagonal(usable_legs, False)
+    usable_legs[:, 0] = False
+    usable_legs[-1, :] = False
+    if num_addresses > 2:
+        usable_legs[0, -1] = False
+    return usable_legs
+
+
+def fetch_missing_connections(
+        address_pairs: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool,
+        client_key: str = None
+) -> dict:
+    """
+    Ask the routing API for each leg on its own, concurrently, and save them.
+
+    :param address_pairs: A (from_address, to_address) tuple of Address models for each leg.
+    :return: The saved AddressConnection models by (from_address_id, to_address_id). Legs the routing API can't route
+        are left out.
+    """
+    num_workers = min(CONST_MAX_ROUTE_CHUNK_WORKERS, len(address_pairs))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                _request_trueway_route_in_thread, [a, b], avoid_highways, avoid_tolls, avoid_ferries, client_key
             )
-            route_address_connection.save()
-        return route
-    except Exception as ex:
-        # NOTE: Records in the AddressConnection model must not be deleted. It's possible they will be
-        # used in multiple routes, so deleting it from one route would break others.
-
-        # TODO: Something went wrong if the code reaches this point.
-        #  Delete the Route and its RouteAddressConnection records, but not AddressConnections.
-        routing_models = [route, ] + list(route_address_connections)
-        for x in routing_models:
+            for a, b in address_pairs
+        ]
+        legs = []
+        routed_pairs = []
+        for (a, b), future in zip(address_pairs, futures):
             try:
-                if hasattr(x, "delete"):
-                    x.delete()
-            except Exception:
+                route_dict = future.result()
+            except NotRoutableException:
                 continue
+            assert len(route_dict['legs']) == 1
+            legs.append(route_dict['legs'][0])
+            routed_pairs.append((a.id, b.id))
+    if len(legs) == 0:
+        return {}
+    return save_address_connections(legs, routed_pairs, avoid_highways, avoid_tolls, avoid_ferries)
 
-        raise ex
 
+def solve_route_from_cached_connections(
+        addresses: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool,
+        client_key: str = None
+) -> list or None:
+    """
+    Order the route locally from the legs earlier routes saved. If only a few of the legs the route could use are
+    missing, ask the routing API for just those legs, which are saved for later routes too.
 
-def get_or_create_address(address_dict: dict) -> Address:
+    :param addresses: The route's addresses. The first and last are the start and end.
+    :return: The route's AddressConnection models in order, or None if too many legs are missing or the route is too
+        large to solve within the time budget.
+    """
+    if len(addresses) - 2 > solver.CONST_MAX_INTERMEDIATE_STOPS:
+        return None
+    matrix, connections = get_cached_connection_matrix(addresses, avoid_highways, avoid_tolls, avoid_ferries)
+
+    # Only the true optimum is good enough, so every leg the route could use must be known.
+    missing_legs = np.argwhere(get_usable_legs(len(addresses)) & ~np.isfinite(matrix))
+    if len(missing_legs) > CONST_MAX_MISSING_LEGS_TO_FETCH:
+        return None
+    if len(missing_legs) > 0:
+        with metrics.stage_seconds.time("routing_api"):
+            new_connections = fetch_missing_connections(
+                [(addresses[a], addresses[b]) for a, b in missing_legs], avoid_highways, avoid_tolls, avoid_ferries,
+                client_key=client_key
+            )
+        connections.update(new_connections)
+        for a, b in missing_legs:
+            connection = new_connections.get((addresses[a].id, addresses[b].id))
+            if connection is not None:
+                matrix[a, b] = connection.travel_seconds
+
+    with metrics.stage_seconds.time("local_solve"):
+        order = solver.solve_fixed_endpoint_path(matrix, time_budget_seconds=CONST_LOCAL_SOLVER_TIME_BUDGET_SECONDS)
+    if order is None:
+        return None
+    return [connections[(addresses[a].id, addresses[b].id)] for a, b in zip(order[:-1], order[1:])]
+
+
+def address_is_outdated(address: Address) -> bool:
+    return address.updated_at.timestamp() <= \
+        datetime.datetime.utcnow().timestamp() - \
+        datetime.timedelta(days=CONST_NUM_DAYS_ADDRESS_OUTDATED).total_seconds()
+
+
+def address_is_past_hard_max_age(address: Address) -> bool:
+    """
+    Outdated addresses are still returned while they are re-geocoded in the background. Past this age, they must be
+    re-geocoded before they are used.
+    """
+    return address.updated_at.timestamp() <= \
+        datetime.datetime.utcnow().timestamp() - \
+        datetime.timedelta(days=settings.ADDRESS_HARD_MAX_AGE_DAYS).total_seconds()
+
+
+def get_address_cache_key(address_tuple: tuple) -> str:
+    return get_address_key(address_tuple)
+
+
+def cache_address(address: Address):
+    seconds_until_hard_max_age = address.updated_at.timestamp() + \
+        datetime.timedelta(days=settings.ADDRESS_HARD_MAX_AGE_DAYS).total_seconds() - \
+        datetime.datetime.utcnow().timestamp()
+    address_cache.set(
+        get_address_cache_key((address.street, address.city, address.state, address.postal_code, address.country)),
+        {
+            'id': address.id,
+            'created_at': address.created_at.timestamp(),
+            'updated_at': address.updated_at.timestamp(),
+            'latitude': str(address.latitude),
+            'longitude': str(address.longitude),
+        },
+        ttl_seconds=seconds_until_hard_max_age
+    )
+
+
+def get_cached_address(address_tuple: tuple) -> Address or None:
+    cached_value = address_cache.get(get_address_cache_key(address_tuple))
+    if cached_value is None:
+        return None
+    street, city, state, postal_code, country = address_tuple
+    return Address.from_db(
+        'default',
+        [
+            'id', 'created_at', 'updated_at', 'street', 'city', 'state', 'postal_code', 'country',
+            'latitude', 'longitude'
+        ],
+        [
+            cached_value['id'],
+            datetime.datetime.fromtimestamp(cached_value['created_at'], tz=datetime.timezone.utc),
+            datetime.datetime.fromtimestamp(cached_value['updated_at'], tz=datetime.timezone.utc),
+            street, city, state, postal_code, country,
+            Decimal(cached_value['latitude']),
+            Decimal(cached_value['longitude']),
+        ]
+    )
+
+
+def get_geocode_negative_cache_key(address_tuple: tuple) -> str:
+    return "geocode|" + get_address_cache_key(address_tuple)
+
+
+def get_route_negative_cache_key(stops: tuple, avoid_highways: bool, avoid_tolls: bool, avoid_ferries: bool) -> str:
+    return "route|{}|{}|{}|{}".format(
+        ";".join("{},{}".format(*x) for x in stops), avoid_highways, avoid_tolls, avoid_ferries
+    )
+
+
+def get_route_cache_key(addresses: list, avoid_highways: bool, avoid_tolls: bool, avoid_ferries: bool) -> str:
+    """
+    The start and end are fixed, but the routing API chooses the order of the intermediate addresses, so they are
+    sorted to make the key order-insensitive.
+    """
+    return "route|{}|{}|{}|{}|{}|{}".format(
+        addresses[0].id, addresses[-1].id, ",".join(str(x) for x in sorted(x.id for x in addresses[1:-1])),
+        avoid_highways, avoid_tolls, avoid_ferries
+    )
+
+
+def cache_route(route: Route, addresses: list, avoid_highways: bool, avoid_tolls: bool, avoid_ferries: bool):
+    address_connection_ids = [x.address_connection_id for x in route.get_route_address_connections()]
+    route_cache.set(
+        get_route_cache_key(addresses, avoid_highways, avoid_tolls, avoid_ferries),
+        address_connection_ids,
+        ttl_seconds=CONST_ROUTE_CACHE_TTL_SECONDS
+    )
+
+
+def get_cached_route_connections(
+        addresses: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool
+) -> list or None:
+    """
+    :return: The AddressConnection models of an earlier route with the same stops and flags, in route order, or None
+        if there is no such route or one of its legs has since been deleted.
+    """
+    cache_key = get_route_cache_key(addresses, avoid_highways, avoid_tolls, avoid_ferries)
+    address_connection_ids = route_cache.get(cache_key)
+    if address_connection_ids is None:
+        return None
+
+    address_connections = AddressConnection.objects.in_bulk(address_connection_ids)
+    if len(address_connections) != len(set(address_connection_ids)):
+        route_cache.delete(cache_key)
+        return None
+    return [address_connections[x] for x in address_connection_ids]
+
+
+def get_address_not_found_message(address_dict: dict) -> str:
+    return "Could not find the address '{}, {}, {} {}, {}'. Please check it for typos and try again.".format(
+        address_dict['street'], address_dict['city'], address_dict['state'], address_dict['postal_code'],
+        address_dict['country']
+    )
+
+
+@receiver(post_save, sender=Address)
+@receiver(post_delete, sender=Address)
+def invalidate_cached_address(sender, instance: Address, **kwargs):
+    address_cache.delete(
+        get_address_cache_key((instance.street, instance.city, instance.state, instance.postal_code, instance.country))
+    )
+
+
+def validate_address_dict(address_dict: dict):
+    """
+    Check that the address data is valid before querying the database or the external API. Single-item lists, as
+    parsed from form data, are unwrapped in place.
+    """
+    for required_key in ('street', 'city', 'state', 'country', 'postal_code'):
+        if required_key not in address_dict:
+            raise Exception("Required key '{}' is missing from JSON data.".format(required_key))
+        else:
+            if isinstance(address_dict[required_key], list) or isinstance(address_dict[required_key], tuple):
+                if len(address_dict[required_key]) == 1:
+                    address_dict[required_key] = address_dict[required_key][0]
+                else:
+                    raise Exception("Could not parse the '{}' value. The server was expecting a string.")
+            if len(address_dict[required_key]) == 0:
+                raise Exception("Value for '{}' is empty.".format(required_key))
+
+
+def get_or_create_address(address_dict: dict, client_key: str = None) -> Address:
     """
     :param address_dict:
         A dictionary containing address routing_data. Example:
@@ -148,31 +530,52 @@ def get_or_create_address(address_dict: dict) -> Address:
                 'postal_code': 'United States':
             }
         All of the above keys are required.
+    :param client_key:
+        Identifies the client (such as a hashed IP address) so that api.scheduler can share the external API
+        fairly between clients.
 
     :return:
     """
     # Check that the data is valid before querying the external API.
-    for required_key in ('street', 'city', 'state', 'country', 'postal_code'):
-        if required_key not in address_dict:
-            raise Exception("Required key '{}' is missing from JSON data.".format(required_key))
-        else:
-            if isinstance(address_dict[required_key], list) or isinstance(address_dict[required_key], tuple):
-                if len(address_dict[required_key]) == 1:
-                    address_dict[required_key] = address_dict[required_key][0]
-                else:
-                    raise Exception("Could not parse the '{}' value. The server was expecting a string.")
-            if len(address_dict[required_key]) == 0:
-                raise Exception("Value for '{}' is empty.".format(required_key))
+    validate_address_dict(address_dict)
+
+    # Attempt to search for the address data in the cache, then the database, before querying the API.
+    # If it exists and isn't past the hard maximum age, assume it's still accurate enough and return it.
+    address_tuple = get_cleaned_address_tuple(address_dict)
+    found_address = get_cached_address(address_tuple)
+    if found_address is not None:
+        if address_is_outdated(found_address):
+            refresh_address_in_background(found_address, address_dict)
+        return found_address
+
+    # Addresses the geolocation API recently couldn't find fail right away.
+    if negative_cache.get(get_geocode_negative_cache_key(address_tuple)):
+        raise AddressNotFoundException(get_address_not_found_message(address_dict))
 
-    # Attempt to search for the address data in the database before querying the API.
-    # If it exists and isn't too old, assume it's still accurate and return it.
-    found_address = Address.get_if_exists(address_dict)
-    if found_address is not None and \
-            found_address.updated_at.timestamp() > \
-            datetime.datetime.utcnow().timestamp() - \
-            datetime.timedelta(days=CONST_NUM_DAYS_ADDRESS_OUTDATED).total_seconds():
+    # Identical lookups that arrive while this one is in flight wait for it and share its result, rather than paying
+    # for their own external API call.
+    return geocode_flight.do(address_tuple, _get_or_create_uncached_address, address_dict, client_key)
+
+
+def _get_or_create_uncached_address(address_dict: dict, client_key: str) -> Address:
+    with metrics.stage_seconds.time("address_db_lookup"):
+        found_address = Address.get_if_exists(address_dict)
+    if found_address is not None and not address_is_past_hard_max_age(found_address):
+        cache_address(found_address)
+        if address_is_outdated(found_address):
+            # Street coordinates almost never change. Return the outdated coordinates now and update them later.
+            refresh_address_in_background(found_address, address_dict)
         return found_address
 
+    return geocode_address(address_dict, found_address, client_key)
+
+
+def geocode_address(address_dict: dict, found_address: Address or None, client_key: str = None) -> Address:
+    """
+    Query the external API for the address's coordinates, then save them. Raises an exception if every attempt fails.
+
+    :param found_address: The outdated Address to update, or None to create a new one.
+    """
     api_name = "Geolocate"
     api_geolocate = API.objects.filter(name=api_name).first()
     if not api_geolocate:
@@ -195,54 +598,371 @@ def get_or_create_address(address_dict: dict) -> Address:
     api_request.save()
 
     try:
-        wait_for_api_request(api_geolocate, api_request)
+        with scheduler.get_scheduler(api_geolocate).slot(client_key) as wait_seconds:
+            metrics.api_wait_seconds.observe(wait_seconds, api_name)
+            for _ in range(api_geolocate.num_request_attempts):
+                try:
+                    metrics.api_calls_total.inc(api_name)
+                    with http_client.get_client(api_geolocate).get(
+                            api_geolocate.api_url, headers=headers, params=query_dict
+                    ) as req:
+                        metrics.api_call_seconds.observe(req.connect_seconds + req.transfer_seconds, api_name)
+                        req.raise_for_status()
+                        if len(req.json()['results']) == 0:
+                            api_request.status = "finished"
+                            api_request.save()
+                            negative_cache.set(
+                                get_geocode_negative_cache_key(get_cleaned_address_tuple(address_dict)), True,
+                                ttl_seconds=CONST_NEGATIVE_CACHE_TTL_SECONDS
+                            )
+                            raise AddressNotFoundException(get_address_not_found_message(address_dict))
+                        coordinates = dict(req.json()['results'][0]['location'])
+                        return_val = save_geocoded_address(address_dict, found_address, coordinates)
+                        api_request.status = "finished"
+                        api_request.save()
+                        return return_val
+                except AddressNotFoundException as ex:
+                    raise ex
+                except Exception:
+                    metrics.api_errors_total.inc(api_name)
+                    time.sleep(float(api_geolocate.request_delay) * 2)
+                    continue
+            raise Exception("Every request to the geolocation API failed.")
+    except AddressNotFoundException as ex:
+        raise ex
+    except Exception:
+        raise Exception("The external geolocation API could not be reached. Please try again tomorrow.")
+    finally:
+        if api_request.status == "waiting":
+            api_request.status = "error"
+            api_request.save()
 
-        for _ in range(api_geolocate.num_request_attempts):
-            try:
-                with requests.request("GET", api_geolocate.api_url, headers=headers, params=query_dict) as req:
-                    req.raise_for_status()
-                    coordinates = dict(req.json()['results'][0]['location'])
-
-                    # Save the coordinates to the database, if they don't exist.
-                    if found_address is not None:
-                        found_address.latitude = coordinates['lat']
-                        found_address.longitude = coordinates['lng']
-                        found_address.save()
-                        return_val = found_address
-                    else:
-                        new_address = Address(
-                            # No need to clean data here. The model does that already before saving.
-                            street=address_dict['street'],
-                            city=address_dict['city'],
-                            state=address_dict['state'],
-                            postal_code=address_dict['postal_code'],
-                            country=address_dict['country'],
-                            latitude=coordinates['lat'],
-                            longitude=coordinates['lng']
-                        )
-                        new_address.save()
-                        return_val = new_address
-
-                    api_request.status = "finished"
-                    api_request.save()
-                    return return_val
-            except Exception:
-                time.sleep(int(api_geolocate.request_delay) * 2)
-                continue
+
+def save_geocoded_address(address_dict: dict, found_address: Address or None, coordinates: dict) -> Address:
+    """
+    Save coordinates from the geolocation API and cache the address.
+
+    :param found_address: The outdated Address to update, or None to create a new one.
+    :param coordinates: A dictionary with 'lat' and 'lng' keys.
+    """
+    # Save the coordinates to the database, if they don't exist.
+    if found_address is not None:
+        found_address.latitude = coordinates['lat']
+        found_address.longitude = coordinates['lng']
+        found_address.save()
+        address = found_address
+    else:
+        address = Address(
+            # No need to clean data here. The model does that already before saving.
+            street=address_dict['street'],
+            city=address_dict['city'],
+            state=address_dict['state'],
+            postal_code=address_dict['postal_code'],
+            country=address_dict['country'],
+            latitude=coordinates['lat'],
+            longitude=coordinates['lng']
+        )
+        try:
+            with transaction.atomic():
+                address.save()
+        except IntegrityError:
+            # Another worker process saved the same address first. Use theirs.
+            address = Address.get_if_exists(address_dict)
+
+    cache_address(address)
+    return address
+
+
+def refresh_address_in_background(address: Address, address_dict: dict):
+    address_tuple = (address.street, address.city, address.state, address.postal_code, address.country)
+    with _pending_address_refreshes_lock:
+        if address_tuple in _pending_address_refreshes:
+            return
+        # Submitted under the lock, so the refresh can't remove its entry before it is added.
+        _pending_address_refreshes[address_tuple] = address_refresh_executor.submit(
+            _refresh_address, address.id, dict(address_dict), address_tuple
+        )
+
+
+def wait_for_address_refreshes(timeout: float = None):
+    """
+    Wait for the background refreshes started so far to finish.
+    """
+    with _pending_address_refreshes_lock:
+        futures = list(_pending_address_refreshes.values())
+    wait(futures, timeout=timeout)
+
+
+def _refresh_address(address_id: int, address_dict: dict, address_tuple: tuple):
+    try:
+        # Another worker process may have refreshed the address already.
+        address = Address.objects.filter(id=address_id).first()
+        if address is not None and address_is_outdated(address):
+            geocode_flight.do(address_tuple, geocode_address, address_dict, address)
+    except Exception:
+        # The outdated address is still served, and the next request for it tries again.
+        logger.warning("Could not refresh address %d.", address_id, exc_info=True)
+    finally:
+        with _pending_address_refreshes_lock:
+            _pending_address_refreshes.pop(address_tuple, None)
+        connections.close_all()
+
+
+def _get_or_create_address_in_thread(address_dict: dict, client_key: str) -> Address:
+    try:
+        return get_or_create_address(address_dict, client_key=client_key)
+    finally:
+        # Each worker thread opens its own database connection. Close it so it isn't left dangling.
+        connections.close_all()
+
+
+def get_or_create_addresses(address_dicts: list, client_key: str = None) -> list:
+    """
+    Batched version of get_or_create_address().
+
+    All addresses are checked against the database with a single query. Outdated addresses are returned as they are
+    and refreshed in the background. Addresses that are missing or past the hard maximum age are geocoded
+    concurrently, and each of those calls still waits its turn through api.scheduler, so the external API's
+    rate limit is honored. Duplicate addresses (such as a start address that is also the end address) are only
+    geocoded once.
+
+    :return: A list of Address models in the same order as address_dicts.
+    """
+    for address_dict in address_dicts:
+        validate_address_dict(address_dict)
+    address_keys = [get_cleaned_address_tuple(x) for x in address_dicts]
+
+    first_dict_by_key = {}
+    for address_key, address_dict in zip(address_keys, address_dicts):
+        first_dict_by_key.setdefault(address_key, address_dict)
+
+    # Check the cache, then fetch every other known address at once.
+    found_addresses = {}
+    for address_key in first_dict_by_key:
+        cached_address = get_cached_address(address_key)
+        if cached_address is not None:
+            found_addresses[address_key] = cached_address
+    uncached_keys = [x for x in first_dict_by_key if x not in found_addresses]
+    if len(uncached_keys) > 0:
+        stored_addresses = Address.get_many_if_exists([first_dict_by_key[x] for x in uncached_keys])
+        for address_key, address in zip(uncached_keys, stored_addresses):
+            if address is not None and not address_is_past_hard_max_age(address):
+                cache_address(address)
+                found_addresses[address_key] = address
+
+    for address_key in first_dict_by_key:
+        if address_key not in found_addresses and negative_cache.get(get_geocode_negative_cache_key(address_key)):
+            raise AddressNotFoundException(get_address_not_found_message(first_dict_by_key[address_key]))
+
+    # Street coordinates almost never change. Use outdated coordinates now and update them later.
+    for address_key, address in found_addresses.items():
+        if address_is_outdated(address):
+            refresh_address_in_background(address, first_dict_by_key[address_key])
+
+    # Geocode the rest concurrently.
+    missing_keys = [x for x in first_dict_by_key if x not in found_addresses]
+    if len(missing_keys) > 0:
+        num_workers = min(CONST_MAX_GEOCODE_WORKERS, len(missing_keys))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = {
+                address_key: executor.submit(
+                    _get_or_create_address_in_thread, first_dict_by_key[address_key], client_key
+                )
+                for address_key in missing_keys
+            }
+            for address_key, future in futures.items():
+                address = future.result()
+                if address is None:
+                    raise Exception("No coordinates were found for '{}'.".format(", ".join(address_key)))
+                found_addresses[address_key] = address
+
+    return [found_addresses[x] for x in address_keys]
+
+
+def request_trueway_route(
+        addresses: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool,
+        client_key: str = None
+) -> dict:
+    """
+    Ask the routing API for the optimized order of the addresses. The first and last addresses are kept as the start
+    and end of the route.
+
+    :return: The 'route' dictionary from the API response, which contains the route's legs.
+    """
+    stops = tuple((str(x.latitude), str(x.longitude)) for x in addresses)
+    if negative_cache.get(get_route_negative_cache_key(stops, avoid_highways, avoid_tolls, avoid_ferries)):
+        raise NotRoutableException
+    return route_flight.do(
+        (stops, avoid_highways, avoid_tolls, avoid_ferries),
+        _request_trueway_route, stops, avoid_highways, avoid_tolls, avoid_ferries, client_key
+    )
+
+
+def _request_trueway_route(
+        stops: tuple,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool,
+        client_key: str
+) -> dict:
+    api_name = "Routing"
+    api_route = API.objects.filter(name=api_name).first()
+    if not api_route:
+        raise Exception("The '{}' API does not exist in the database.".format(api_name))
+
+    query_dict = {
+        'stops': "",
+        'avoid_highways': avoid_highways,
+        'avoid_tolls': avoid_tolls,
+        'avoid_ferries': avoid_ferries,
+        'optimize': True
+    }
+    for coordinates in stops:
+        query_dict['stops'] += "{},{};".format(coordinates[0], coordinates[1])
+    query_dict['stops'] = query_dict['stops'].strip(';')
+    headers = {
+        "X-RapidAPI-Key": api_route.api_key,
+        "X-RapidAPI-Host": "trueway-directions2.p.rapidapi.com"
+    }
+
+    api_request = APIRequest(api=api_route)
+    api_request.save()
+
+    route_dict = {}
+    try:
+        with scheduler.get_scheduler(api_route).slot(client_key) as wait_seconds:
+            metrics.api_wait_seconds.observe(wait_seconds, api_name)
+            for _ in range(api_route.num_request_attempts):
+                try:
+                    metrics.api_calls_total.inc(api_name)
+                    with http_client.get_client(api_route).get(
+                            api_route.api_url, headers=headers, params=query_dict
+                    ) as req:
+                        metrics.api_call_seconds.observe(req.connect_seconds + req.transfer_seconds, api_name)
+                        req.raise_for_status()
+                        if len(req.json()) == 0:
+                            negative_cache.set(
+                                get_route_negative_cache_key(stops, avoid_highways, avoid_tolls, avoid_ferries), True,
+                                ttl_seconds=CONST_NEGATIVE_CACHE_TTL_SECONDS
+                            )
+                            raise NotRoutableException
+                        route_dict = dict(req.json()['route'])
+
+                        api_request.status = "finished"
+                        api_request.save()
+                        break
+                except NotRoutableException as ex:
+                    raise ex
+                except Exception:
+                    metrics.api_errors_total.inc(api_name)
+                    time.sleep(float(api_route.request_delay) * 2)
+                    continue
+    except NotRoutableException as ex:
+        raise ex
     except Exception:
         raise Exception("The external geolocation API could not be reached. Please try again tomorrow.")
     finally:
-        test_request = APIRequest.objects.filter(id=api_request.id).first()
-        if test_request and test_request.status == "waiting":
-            test_request.status = "error"
-            test_request.save()
+        if api_request.status == "waiting":
+            api_request.status = "error"
+            api_request.save()
+
+    return route_dict
 
 
-def create_route(routing_data: dict) -> Route:
-    CONST_START_ADDRESS_KEY = 'start_address'
-    CONST_INTERMEDIATE_ADDRESSES_KEY = 'intermediate_addresses'
-    CONST_END_ADDRESS_KEY = 'end_address'
+def get_route_chunks(num_addresses: int, max_intermediate_addresses: int) -> list:
+    """
+    Split a path of addresses into consecutive chunks that share their boundary addresses. The last address of each
+    chunk is the first address of the next one, so the chunks' routes join into one route.
+
+    Chunks are kept about the same size, so there is never a tiny chunk left over at the end.
+
+    :return: A list of (first_index, last_index) tuples, both inclusive.
+    """
+    num_legs = num_addresses - 1
+    max_legs_per_chunk = max_intermediate_addresses + 1
+    num_chunks = -(-num_legs // max_legs_per_chunk)
+    boundaries = [round(x * num_legs / num_chunks) for x in range(num_chunks + 1)]
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _request_trueway_route_in_thread(
+        addresses: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool,
+        client_key: str
+) -> dict:
+    try:
+        return request_trueway_route(addresses, avoid_highways, avoid_tolls, avoid_ferries, client_key=client_key)
+    finally:
+        # Each worker thread opens its own database connection. Close it so it isn't left dangling.
+        connections.close_all()
+
 
+def create_large_route(
+        addresses: list,
+        avoid_highways: bool,
+        avoid_tolls: bool,
+        avoid_ferries: bool,
+        client_key: str = None
+) -> Route:
+    """
+    Route more stops than the routing API accepts at once.
+
+    The stops are put in a good order locally using straight-line distances, then the path is split into chunks the
+    routing API accepts, with neighboring chunks sharing a stop. The chunks are routed concurrently, and each of those
+    calls still waits its turn through api.scheduler, so the external API's rate limit is honored. The routing API
+    re-orders the stops within each chunk by actual travel time, and the chunks are joined into a single route.
+
+    The number of routing API calls, and the time spent on them, grows linearly with the number of stops.
+
+    :param addresses: The route's addresses. The first and last are the start and end.
+    """
+    with metrics.stage_seconds.time("local_solve"):
+        order = solver.get_heuristic_fixed_endpoint_path(
+            distance.get_distance_matrix(addresses), time_budget_seconds=CONST_LARGE_ROUTE_ORDER_TIME_BUDGET_SECONDS
+        )
+    ordered_addresses = [addresses[x] for x in order]
+    chunks = get_route_chunks(len(ordered_addresses), CONST_MAX_ROUTING_API_INTERMEDIATE_ADDRESSES)
+    logger.debug("Routing %d stops in %d chunks.", len(ordered_addresses), len(chunks))
+
+    num_workers = min(CONST_MAX_ROUTE_CHUNK_WORKERS, len(chunks))
+    with metrics.stage_seconds.time("routing_api"), ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                _request_trueway_route_in_thread, ordered_addresses[first:last + 1], avoid_highways, avoid_tolls,
+                avoid_ferries, client_key
+            )
+            for first, last in chunks
+        ]
+        route_dicts = [x.result() for x in futures]
+
+    # Join the chunks. Each chunk starts where the previous one ended.
+    legs = []
+    route_addresses = [ordered_addresses[0], ]
+    for (first, last), route_dict in zip(chunks, route_dicts):
+        assert 'legs' in route_dict
+        with metrics.stage_seconds.time("match_legs"):
+            chunk_addresses, _ = matching.match_legs_to_addresses(
+                route_dict['legs'], ordered_addresses[first], ordered_addresses[first + 1:last],
+                ordered_addresses[last]
+            )
+        legs += route_dict['legs']
+        route_addresses += chunk_addresses[1:]
+    with metrics.stage_seconds.time("save_route"):
+        return save_legs_to_database(legs, route_addresses, avoid_highways, avoid_tolls, avoid_ferries)
+
+
+def validate_routing_data(routing_data: dict):
+    """
+    Fill in the default avoid flags and check that the routing data is complete, so bad requests can be rejected
+    before any work is done.
+
+    :raises Exception: With a message for the user if the data is invalid.
+    """
     # Add missing data.
     if 'avoid_highways' not in routing_data:
         routing_data['avoid_highways'] = False
@@ -281,79 +1001,102 @@ def create_route(routing_data: dict) -> Route:
                     "'street', 'city', 'state', 'postal_code', 'country'. "
                     "Your data was: {}".format(required_key, routing_data[required_key])
                 )
-    if len(routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY]) > 20:
-        raise Exception("The server cannot process more than 20 intermediate addresses at once.")
+    if len(routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY]) > CONST_MAX_INTERMEDIATE_ADDRESSES:
+        raise Exception("The server cannot process more than {} intermediate addresses at once.".format(
+            CONST_MAX_INTERMEDIATE_ADDRESSES
+        ))
     elif len(routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY]) == 0 \
             and routing_data['start_address'] == routing_data['end_address']:
         raise Exception("The start and end addresses are the same, but there are no intermediate addresses.")
 
+
+def create_route(routing_data: dict, client_key: str = None, progress_callback=None) -> Route:
+    """
+    :param progress_callback: Called with a short, user-facing description of each step as it starts.
+    """
+    def report_progress(progress: str):
+        if progress_callback is not None:
+            progress_callback(progress)
+
+    with metrics.stage_seconds.time("validate_routing_data"):
+        validate_routing_data(routing_data)
+
     # Convert all addresses to GPS coordinates.
+    report_progress(CONST_PROGRESS_GEOCODING)
     try:
-        routing_data[CONST_START_ADDRESS_KEY] = get_or_create_address(routing_data[CONST_START_ADDRESS_KEY])
-        for index in range(len(routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY])):
-            routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY][index] = \
-                get_or_create_address(routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY][index])
-        routing_data[CONST_END_ADDRESS_KEY] = get_or_create_address(routing_data[CONST_END_ADDRESS_KEY])
+        with metrics.stage_seconds.time("geocode_addresses"):
+            addresses = get_or_create_addresses(
+                [routing_data[CONST_START_ADDRESS_KEY], ] + list(routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY]) +
+                [routing_data[CONST_END_ADDRESS_KEY], ],
+                client_key=client_key
+            )
+        routing_data[CONST_START_ADDRESS_KEY] = addresses[0]
+        routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY] = addresses[1:-1]
+        routing_data[CONST_END_ADDRESS_KEY] = addresses[-1]
+    except AddressNotFoundException as ex:
+        raise ex
     except Exception:
         raise Exception("Could not parse your JSON data. Please make sure it is formatted correctly.")
 
-    # Get response from routing API.
-    api_name = "Routing"
-    api_route = API.objects.filter(name=api_name).first()
-    if not api_route:
-        raise Exception("The '{}' API does not exist in the database.".format(api_name))
+    # The same stops were routed recently, so reuse that route's legs.
+    report_progress(CONST_PROGRESS_ROUTING)
+    with metrics.stage_seconds.time("route_cache_lookup"):
+        address_connections = get_cached_route_connections(
+            addresses,
+            avoid_highways=routing_data['avoid_highways'],
+            avoid_tolls=routing_data['avoid_tolls'],
+            avoid_ferries=routing_data['avoid_ferries']
+        )
+    if address_connections is not None:
+        logger.debug("Rebuilt route from the route cache.")
+        with metrics.stage_seconds.time("save_route"):
+            return save_route_from_address_connections(address_connections)
 
-    query_dict = {
-        'stops': "",
-        'avoid_highways': routing_data['avoid_highways'],
-        'avoid_tolls': routing_data['avoid_tolls'],
-        'avoid_ferries': routing_data['avoid_ferries'],
-        'optimize': True
-    }
-    for address in [routing_data[CONST_START_ADDRESS_KEY], ] + routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY] + \
-                   [routing_data[CONST_END_ADDRESS_KEY], ]:
-        query_dict['stops'] += "{},{};".format(address.latitude, address.longitude)
-    query_dict['stops'] = query_dict['stops'].strip(';')
-    headers = {
-        "X-RapidAPI-Key": api_route.api_key,
-        "X-RapidAPI-Host": "trueway-directions2.p.rapidapi.com"
-    }
-
-    api_request = APIRequest(api=api_route)
-    api_request.save()
+    # Repeat customers often have most legs between their stops saved already. If so, solve the route locally.
+    address_connections = solve_route_from_cached_connections(
+        addresses,
+        avoid_highways=routing_data['avoid_highways'],
+        avoid_tolls=routing_data['avoid_tolls'],
+        avoid_ferries=routing_data['avoid_ferries'],
+        client_key=client_key
+    )
+    if address_connections is not None:
+        logger.debug("Solved route locally from saved address connections.")
+        with metrics.stage_seconds.time("save_route"):
+            route_model = save_route_from_address_connections(address_connections)
+        cache_route(
+            route_model, addresses, routing_data['avoid_highways'], routing_data['avoid_tolls'],
+            routing_data['avoid_ferries']
+        )
+        return route_model
 
-    route_dict = {}
-    try:
-        wait_for_api_request(api_route, api_request)
+    if len(addresses) - 2 > CONST_MAX_ROUTING_API_INTERMEDIATE_ADDRESSES:
+        route_model = create_large_route(
+            addresses,
+            avoid_highways=routing_data['avoid_highways'],
+            avoid_tolls=routing_data['avoid_tolls'],
+            avoid_ferries=routing_data['avoid_ferries'],
+            client_key=client_key
+        )
+        cache_route(
+            route_model, addresses, routing_data['avoid_highways'], routing_data['avoid_tolls'],
+            routing_data['avoid_ferries']
+        )
+        return route_model
 
-        for _ in range(api_route.num_request_attempts):
-            try:
-                with requests.request("GET", api_route.api_url, headers=headers, params=query_dict) as req:
-                    req.raise_for_status()
-                    print("\n\n\n", req.json(), "\n\n\n")
-                    if len(req.json()) == 0:
-                        print("Raising NotRoutableException")
-                        raise NotRoutableException
-                    route_dict = dict(req.json()['route'])
-
-                    api_request.status = "finished"
-                    api_request.save()
-            except NotRoutableException as ex:
-                raise ex
-            except Exception:
-                time.sleep(int(api_route.request_delay) * 2)
-                continue
-    except NotRoutableException as ex:
-        raise ex
-    except Exception:
-        raise Exception("The external geolocation API could not be reached. Please try again tomorrow.")
-    finally:
-        test_request = APIRequest.objects.filter(id=api_request.id).first()
-        if test_request and test_request.status == "waiting":
-            test_request.status = "error"
-            test_request.save()
+    # Get response from routing API.
+    with metrics.stage_seconds.time("routing_api"):
+        route_dict = request_trueway_route(
+            [routing_data[CONST_START_ADDRESS_KEY], ] + routing_data[CONST_INTERMEDIATE_ADDRESSES_KEY] +
+            [routing_data[CONST_END_ADDRESS_KEY], ],
+            avoid_highways=routing_data['avoid_highways'],
+            avoid_tolls=routing_data['avoid_tolls'],
+            avoid_ferries=routing_data['avoid_ferries'],
+            client_key=client_key
+        )
 
     # Parse and save JSON data to database, then return a Route object if successful.
+    report_progress(CONST_PROGRESS_SAVING)
     assert 'legs' in route_dict
     legs = route_dict['legs']
     route_model = save_trueway_routing_json_to_database(
@@ -366,5 +1109,9 @@ def create_route(routing_data: dict) -> Route:
         avoid_ferries=routing_data['avoid_ferries']
     )
     assert isinstance(route_model, Route)
+    cache_route(
+        route_model, addresses, routing_data['avoid_highways'], routing_data['avoid_tolls'],
+        routing_data['avoid_ferries']
+    )
     return route_model
 
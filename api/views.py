@@ -1,29 +1,77 @@
+import json
+
 import rest_framework.request
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import render
 from django.urls import reverse
+from ipware import get_client_ip
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.decorators import api_view, permission_classes
+from rest_framework_simplejwt.authentication import JWTAuthentication
 
-from exceptions import NotRoutableException
-from routing.models import Route
+from .models import RouteJob
 from routing import views as routing_views
+from security import jwt_blacklist_filter, rate_counters
 from security.models import TrackedAction, HashedIP, JWTBlacklist
-from . import utils
+from . import async_utils, jobs, metrics, utils
 
 CONST_API_KEY_GEOLOCATE = ""
 CONST_API_KEY_ROUTE = ""
 
 CONST_ACTION_STR_USED_BLACLISTED_JWT = "Used a blacklisted JWT"
 
+# The most addresses a single route can have.
+CONST_MAX_GEOLOCATE_ADDRESSES = utils.CONST_MAX_INTERMEDIATE_ADDRESSES + 2
+
 
 @api_view(http_method_names=["POST"])
 @permission_classes([IsAuthenticated, ])
 def geolocate(request) -> Response:
     """
     :param request: Accepts JSON address_dict specifying a specific address and converts that to GPS coordinates.
-    :return: A JSON response containing 'lat' and 'lng' values for latitude and longitude coordinates.
+        A JSON list of address_dicts is also accepted, and they are all looked up at once.
+    :return: A JSON response containing 'lat' and 'lng' values for latitude and longitude coordinates, or a list of
+        them in the same order as the request.
     """
+    if isinstance(request.data, list):
+        if len(request.data) > CONST_MAX_GEOLOCATE_ADDRESSES:
+            return Response(
+                {'errors': ["The server cannot geolocate more than {} addresses at once.".format(
+                    CONST_MAX_GEOLOCATE_ADDRESSES
+                ), ]},
+                status=400
+            )
+        try:
+            address_dicts = [dict(x) for x in request.data]
+        except Exception:
+            return Response(
+                {'errors': ["Could not parse JSON address_dict from request.", ]},
+                status=400
+            )
+
+        try:
+            addresses = utils.get_or_create_addresses(
+                address_dicts, client_key=HashedIP.get_hashed_ip_from_request(request)
+            )
+            result_data = [
+                {
+                    'lat': address.latitude,
+                    'lng': address.longitude
+                }
+                for address in addresses
+            ]
+            return Response(result_data, status=200)
+        except Exception as ex:
+            result_data = {
+                'errors': [
+                    str(ex),
+                ]
+            }
+            return Response(result_data, status=400)
+
     try:
         data = dict(request.data)
     except Exception:
@@ -33,7 +81,7 @@ def geolocate(request) -> Response:
         )
 
     try:
-        address = utils.get_or_create_address(data)
+        address = utils.get_or_create_address(data, client_key=HashedIP.get_hashed_ip_from_request(request))
         result_data = {
             'lat': address.latitude,
             'lng': address.longitude
@@ -51,75 +99,191 @@ def geolocate(request) -> Response:
 @api_view(http_method_names=["POST"])
 @permission_classes([IsAuthenticated, ])
 def route_addresses(request) -> Response:
-    # Track the action for bot reduction.
-    submit_form_action = TrackedAction(
-        hashed_ip=HashedIP.get_or_create_from_request(request),
-        action_type=routing_views.CONST_ACTION_STR_SUBMIT_ROUTING_FORM
-    )
-    submit_form_action.save()
-
-    # Verify that the client isn't using blacklisted JWTs. If so, block them.
-    if JWTBlacklist.check_if_jwt_is_blacklisted_with_request(request):
-        TrackedAction.create_action_with_request_and_type(request, CONST_ACTION_STR_USED_BLACLISTED_JWT)
-        return Response(
-            {
+    assert isinstance(request, rest_framework.request.Request)
+    try:
+        data = dict(request.data)
+    except Exception:
+        data = None
+
+    result_data, status = queue_route_request(request, data)
+    return Response(result_data, status=status)
+
+
+def queue_route_request(request, data: dict or None) -> tuple:
+    """
+    Check the client and their routing data, then queue a RouteJob. Shared by the sync and async route views.
+
+    :param data: The parsed JSON body, or None if it could not be parsed.
+    :return: A (result_data, status) tuple for the response.
+    """
+    with metrics.stage_seconds.time("client_checks"):
+        # Track the action for bot reduction.
+        submit_form_action = TrackedAction(
+            hashed_ip=HashedIP.get_or_create_from_request(request),
+            action_type=routing_views.CONST_ACTION_STR_SUBMIT_ROUTING_FORM
+        )
+        HashedIP.save_with_hashed_ip(submit_form_action)
+
+        # Verify that the client isn't using blacklisted JWTs. If so, block them.
+        if jwt_blacklist_filter.is_request_jwt_blacklisted(request):
+            TrackedAction.create_action_with_request_and_type(request, CONST_ACTION_STR_USED_BLACLISTED_JWT)
+            return {
                 'errors': [
                     "The server refused your request for security reasons. Please refresh your page and try again.",
                 ]
-            },
-            status=403
-        )
-    blacklisted_jwt = JWTBlacklist.create_by_request(request)
-    found_actions = TrackedAction.get_actions_within_last_x_minutes(
-        request, action_type=CONST_ACTION_STR_USED_BLACLISTED_JWT, num_minutes=60*24
-    )
-    if len(found_actions) >= 3:
-        return Response(
-            {
+            }, 403
+        blacklisted_jwt = JWTBlacklist.create_by_request(request)
+        action_counts = rate_counters.get_action_counts(request, {CONST_ACTION_STR_USED_BLACLISTED_JWT: 60 * 24})
+        if action_counts[CONST_ACTION_STR_USED_BLACLISTED_JWT] >= 3:
+            return {
                 'errors': [
                     "Are you trying to scrape the website? ಠ_ಠ",
                 ]
-            },
-            status=403
+            }, 403
+
+    if data is None:
+        return {'errors': ["Could not parse JSON address_dict from request.", ]}, 400
+
+    try:
+        with metrics.stage_seconds.time("validate_routing_data"):
+            utils.validate_routing_data(data)
+    except Exception as ex:
+        return {'errors': [str(ex), ]}, 400
+
+    # Routing can take a while, so it's done in the background. The client polls the job's status until it's done.
+    with metrics.stage_seconds.time("enqueue_route_job"):
+        job = jobs.enqueue_route_job(
+            data,
+            client_key=submit_form_action.hashed_ip.hashed_ip,
+            tracked_action=submit_form_action,
+            blacklisted_jwt=blacklisted_jwt
         )
+    return {
+        'job_id': str(job.job_id),
+        'status_url': reverse('api_route_job_status', kwargs={'job_id': job.job_id})
+    }, 202
 
-    assert isinstance(request, rest_framework.request.Request)
+
+@api_view(http_method_names=["GET"])
+@permission_classes([IsAuthenticated, ])
+def route_job_status(request, job_id) -> Response:
+    """
+    :return: The job's status and progress. Once finished, also the 'route_key' and 'route_url' of the new route.
+    """
+    job = RouteJob.objects.filter(job_id=job_id).select_related('route').first()
+    if job is None:
+        return Response({'errors': ["That route request does not exist.", ]}, status=404)
+    if jobs.resume_stale_route_job(job) is not None:
+        job.refresh_from_db()
+
+    result_data = {
+        'job_id': str(job.job_id),
+        'status': job.status,
+        'progress': job.progress,
+    }
+    if job.status == RouteJob.CONST_STATUS_FINISHED:
+        result_data['route_key'] = job.route.route_key
+        result_data['route_url'] = reverse('route_show', kwargs={'route_key': job.route.route_key})
+    elif job.status == RouteJob.CONST_STATUS_NOT_ROUTABLE:
+        # Tells the page to show a pop-up on the user's screen.
+        result_data['notRoutableException'] = True
+    elif job.status == RouteJob.CONST_STATUS_ERROR:
+        result_data['errors'] = [job.error, ]
+    return Response(result_data, status=200)
+
+
+def metrics_view(request) -> HttpResponse:
+    """
+    Every metric in the Prometheus text format. Only clients in settings.METRICS_ALLOWED_IPS may see them.
+    """
+    client_ip, _ = get_client_ip(request)
+    if client_ip not in settings.METRICS_ALLOWED_IPS:
+        raise Http404
+    return HttpResponse(metrics.render(), content_type=metrics.CONST_CONTENT_TYPE)
+
+
+# Async versions of the views above, used when API_ASYNC_VIEWS is True in settings.py. Django REST Framework views are
+# sync only, so these are plain Django views that authenticate the JWT themselves. Responses match the DRF views.
+
+async def _is_authenticated(request) -> bool:
     try:
-        data = dict(request.data)
+        return await sync_to_async(JWTAuthentication().authenticate)(request) is not None
     except Exception:
-        return Response(
-            {'errors': ["Could not parse JSON address_dict from request.", ]},
-            status=400
-        )
+        return False
+
+
+async def _check_async_request(request) -> JsonResponse or None:
+    """
+    :return: An error response, or None if the request is a POST from an authenticated client.
+    """
+    if request.method != "POST":
+        return JsonResponse({'detail': 'Method "{}" not allowed.'.format(request.method)}, status=405)
+    if not await _is_authenticated(request):
+        return JsonResponse({'detail': "Authentication credentials were not provided."}, status=401)
+    return None
+
+
+async def geolocate_async(request) -> JsonResponse:
+    error_response = await _check_async_request(request)
+    if error_response is not None:
+        return error_response
 
     try:
-        print("Getting route.")
-        route = utils.create_route(data)
-        print("Got route.")
-        assert isinstance(route, Route)
-        result_data = {
-            'route_key': route.route_key,
-            'route_url': reverse('route_show', kwargs={'route_key': route.route_key})
-        }
-        return Response(result_data, status=200)
-    except NotRoutableException:
-        print("A NotRoutableException has been caught!")
-        blacklisted_jwt.delete()     # Let the user re-enter their addresses after changing them.
-        submit_form_action.delete()  # Let the user refresh the page without waiting.
+        data = json.loads(request.body)
+    except Exception:
+        data = None
+    client_key = HashedIP.get_hashed_ip_from_request(request)
 
-        # Return a response that will pop up on the user's screen.
+    if isinstance(data, list):
+        if len(data) > CONST_MAX_GEOLOCATE_ADDRESSES:
+            return JsonResponse(
+                {'errors': ["The server cannot geolocate more than {} addresses at once.".format(
+                    CONST_MAX_GEOLOCATE_ADDRESSES
+                ), ]},
+                status=400
+            )
+        try:
+            addresses = await async_utils.aget_or_create_addresses([dict(x) for x in data], client_key=client_key)
+            result_data = [
+                {
+                    'lat': address.latitude,
+                    'lng': address.longitude
+                }
+                for address in addresses
+            ]
+            return JsonResponse(result_data, status=200, safe=False)
+        except Exception as ex:
+            return JsonResponse({'errors': [str(ex), ]}, status=400)
+
+    if not isinstance(data, dict):
+        return JsonResponse({'errors': ["Could not parse JSON address_dict from request.", ]}, status=400)
+
+    try:
+        address = await async_utils.aget_or_create_address(data, client_key=client_key)
         result_data = {
-            'notRoutableException': True
+            'lat': address.latitude,
+            'lng': address.longitude
         }
-        return Response(result_data, status=400)
+        return JsonResponse(result_data, status=200)
     except Exception as ex:
-        print("Caught regular exception.")
-        result_data = {
-            'errors': [
-                str(ex),
-            ]
-        }
-        return Response(result_data, status=400)
+        return JsonResponse({'errors': [str(ex), ]}, status=400)
+
+
+async def route_addresses_async(request) -> JsonResponse:
+    error_response = await _check_async_request(request)
+    if error_response is not None:
+        return error_response
+
+    try:
+        data = dict(json.loads(request.body))
+    except Exception:
+        data = None
 
+    result_data, status = await sync_to_async(queue_route_request)(request, data)
+    return JsonResponse(result_data, status=status)
 
 
+# Django 4.0's csrf_exempt decorator doesn't support async views, so set the flag it would have set. Like the DRF
+# views, these authenticate with a JWT header rather than a session cookie.
+geolocate_async.csrf_exempt = True
+route_addresses_async.csrf_exempt = True
@@ -8,3 +8,8 @@ class NotRoutableException(Exception):
     pass
 
 
+class AddressNotFoundException(Exception):
+    """
+    The geolocation API returned no results for the provided address. Retrying the same address will not help.
+    """
+    pass
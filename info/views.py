@@ -1,6 +1,9 @@
 from django.shortcuts import render
 
+from api.page_cache import CONST_STATIC_PAGE_TTL_SECONDS, cache_page_response
 
+
+@cache_page_response(ttl_seconds=CONST_STATIC_PAGE_TTL_SECONDS)
 def frequently_asked_questions(request):
     context = {
 
@@ -16,10 +16,10 @@ class AddressAdmin(admin.ModelAdmin):
 
 
 class RouteAdmin(admin.ModelAdmin):
-    list_display = ('route_key', 'created_at', 'updated_at')
+    list_display = ('route_key', 'num_stops', 'created_at', 'updated_at')
     list_filter = ('created_at', 'updated_at')
-    fields = ('created_at', 'updated_at', 'route_key')
-    readonly_fields = ('created_at', 'updated_at', 'route_key')
+    fields = ('created_at', 'updated_at', 'route_key', 'num_stops', 'total_distance_meters', 'total_travel_seconds')
+    readonly_fields = fields
 
     def has_add_permission(self, request, obj=None):
         return False
@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from routing.models import Route, RouteAddressConnection
+
+
+class Command(BaseCommand):
+    help = "Stores the legs, totals and map parameters of routes saved before Route and RouteAddressConnection had " \
+           "those fields."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Routes to load and update at once.")
+
+    def handle(self, *args, **options):
+        num_updated = 0
+        num_skipped = 0
+        last_id = 0
+        while True:
+            # The legs are copied from the AddressConnections as they are now, and the totals are added up from them,
+            # so each route's page agrees with itself from then on.
+            routes = list(
+                Route.objects.with_legs().filter(
+                    Q(num_stops__isnull=True) | Q(route__distance_meters__isnull=True) |
+                    Q(route__travel_seconds__isnull=True),
+                    id__gt=last_id
+                ).distinct().order_by('id')[:options['batch_size']]
+            )
+            if len(routes) == 0:
+                break
+            last_id = routes[-1].id
+
+            # Routes without legs are incomplete and can't be shown. Leave them as they are.
+            routes_with_legs = [x for x in routes if len(x.get_route_address_connections()) > 0]
+            legs = []
+            for route in routes_with_legs:
+                for route_address_connection in route.get_route_address_connections():
+                    if route_address_connection.distance_meters is None or \
+                            route_address_connection.travel_seconds is None:
+                        route_address_connection.set_leg()
+                        legs.append(route_address_connection)
+                route.set_totals()
+            RouteAddressConnection.objects.bulk_update(legs, ['distance_meters', 'travel_seconds'])
+            Route.objects.bulk_update(
+                routes_with_legs, ['total_distance_meters', 'total_travel_seconds', 'num_stops', 'gmaps_embed_params']
+            )
+            num_updated += len(routes_with_legs)
+            num_skipped += len(routes) - len(routes_with_legs)
+
+        self.stdout.write("Stored totals for {} routes. Skipped {} routes without legs.".format(
+            num_updated, num_skipped
+        ))
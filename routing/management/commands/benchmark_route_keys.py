@@ -0,0 +1,59 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from routing import model_utils
+from routing.models import Route
+
+
+def get_probed_route_key() -> str:
+    """
+    How route keys used to be made: random.choice() for each character, then a query to check the key isn't taken.
+    """
+    key = None
+    while key is None or Route.objects.filter(route_key=key).first():
+        key = "".join([random.choice(model_utils.CONST_ROUTE_KEY_ALPHABET) for _ in range(16)])
+    return key
+
+
+class Command(BaseCommand):
+    help = "Measures how quickly route keys can be generated and new routes saved. Every saved route is rolled back."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--num-routes', type=int, default=1000, help="How many keys and routes to make.")
+
+    def report(self, name: str, num_items: int, seconds: float):
+        self.stdout.write("{}: {:,.0f} per second ({:.3f} seconds for {})".format(
+            name, num_items / seconds if seconds > 0 else float('inf'), seconds, num_items
+        ))
+
+    def handle(self, *args, **options):
+        num_routes = options['num_routes']
+
+        start_time = time.perf_counter()
+        for _ in range(num_routes):
+            model_utils.route_get_unique_key()
+        self.report("Keys, one at a time", num_routes, time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        model_utils.get_route_keys(num_routes)
+        self.report("Keys, all at once", num_routes, time.perf_counter() - start_time)
+
+        with transaction.atomic():
+            start_time = time.perf_counter()
+            for _ in range(num_routes):
+                Route(route_key=get_probed_route_key()).save()
+            self.report("Routes saved with a key lookup first (old)", num_routes, time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            for _ in range(num_routes):
+                Route().save()
+            self.report("Routes saved one at a time", num_routes, time.perf_counter() - start_time)
+
+            start_time = time.perf_counter()
+            Route.objects.bulk_create_with_keys([Route() for _ in range(num_routes)])
+            self.report("Routes saved all at once", num_routes, time.perf_counter() - start_time)
+
+            transaction.set_rollback(True)
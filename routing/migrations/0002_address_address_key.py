@@ -0,0 +1,38 @@
+# Generated by Django 4.0.6 on 2026-10-18 15:42
+
+from hashlib import sha256
+
+from django.db import migrations, models
+
+
+def fill_address_keys(apps, schema_editor):
+    # Stored addresses are already cleaned, so the key is a hash of the stored values. Keep this in sync with
+    # routing.models.get_address_key().
+    Address = apps.get_model('routing', 'Address')
+    batch = []
+    for address in Address.objects.all().iterator(chunk_size=1000):
+        address.address_key = sha256("\x1f".join((
+            address.street, address.city, address.state, address.postal_code, address.country
+        )).encode('utf-8')).hexdigest()
+        batch.append(address)
+        if len(batch) >= 1000:
+            Address.objects.bulk_update(batch, ['address_key'])
+            batch = []
+    if len(batch) > 0:
+        Address.objects.bulk_update(batch, ['address_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routing', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='address_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=64),
+        ),
+        migrations.RunPython(fill_address_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routing', '0002_address_address_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='route',
+            name='gmaps_embed_params',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='num_stops',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='total_distance_meters',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='route',
+            name='total_travel_seconds',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('routing', '0003_route_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='routeaddressconnection',
+            name='distance_meters',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='routeaddressconnection',
+            name='travel_seconds',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+    ]
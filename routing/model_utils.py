@@ -1,16 +1,39 @@
-import random
+import secrets
 import urllib
 
-from . import models
+CONST_ROUTE_KEY_ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
+# 62^16 is about 2^95 possible keys, so collisions are practically impossible. Route.save() retries if one happens.
+CONST_ROUTE_KEY_LENGTH = 16
+# The largest multiple of the alphabet size that fits in a byte. Higher bytes are skipped so every character is
+# equally likely.
+CONST_ROUTE_KEY_BYTE_LIMIT = 256 - 256 % len(CONST_ROUTE_KEY_ALPHABET)
+
+
+def get_route_keys(num_keys: int) -> list:
+    """
+    Generate random route keys from the operating system's secure random number generator, with no database lookups.
+    Random bytes are drawn in a few large blocks, so making many keys at once is cheaper than making them one by one.
+    """
+    num_characters = num_keys * CONST_ROUTE_KEY_LENGTH
+    characters = []
+    while len(characters) < num_characters:
+        # About 3% of bytes are skipped, so ask for a little more than is needed.
+        num_bytes = (num_characters - len(characters)) * 33 // 32 + 8
+        characters += [
+            CONST_ROUTE_KEY_ALPHABET[x % len(CONST_ROUTE_KEY_ALPHABET)] for x in secrets.token_bytes(num_bytes)
+            if x < CONST_ROUTE_KEY_BYTE_LIMIT
+        ]
+    key_string = "".join(characters[:num_characters])
+    return [
+        key_string[x:x + CONST_ROUTE_KEY_LENGTH] for x in range(0, num_characters, CONST_ROUTE_KEY_LENGTH)
+    ]
 
 
 def route_get_unique_key() -> str:
-    key = None
-    while key is None or models.Route.objects.filter(route_key=key).first():
-        key = "".join(
-            [random.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for _ in range(16)]
-        )
-    return key
+    """
+    The default for Route.route_key. Uniqueness is enforced by the column's unique index, not by checking first.
+    """
+    return get_route_keys(1)[0]
 
 
 def get_url_encoded_address(address) -> str:
@@ -2,13 +2,17 @@ import datetime
 import math
 import random
 import urllib
+from hashlib import sha256
 from typing import Any
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 
 from traveling_salesman.settings import GMAPS_API_KEY
 from . import model_utils
 
+CONST_MAX_GMAPS_EMBED_WAYPOINTS = 20  # Google Maps Embed API limit.
+CONST_ROUTE_KEY_MAX_ATTEMPTS = 3  # Route keys are random, so a second collision in a row means something else is wrong.
+
 
 def clean_address_piece(val: str):
     if not isinstance(val, str):
@@ -34,6 +38,42 @@ def clean_address_piece(val: str):
     return val
 
 
+def get_cleaned_address_tuple(address_dict: dict) -> tuple:
+    return tuple(
+        clean_address_piece(address_dict[key]) for key in ('street', 'city', 'state', 'postal_code', 'country')
+    )
+
+
+def get_address_key(address_tuple: tuple) -> str:
+    """
+    :param address_tuple: A cleaned (street, city, state, postal_code, country) tuple.
+    :return: A hash of the tuple. Addresses are looked up by this value rather than by all five columns.
+    """
+    return sha256("\x1f".join(address_tuple).encode('utf-8')).hexdigest()
+
+
+def get_leg_travel_time_string(travel_seconds: int) -> str:
+    minutes = math.ceil(int(travel_seconds) / 60)
+    hours = minutes // 60
+    minutes -= 60 * hours
+
+    result = ""
+    if hours == 1:
+        result += "{} hour".format(hours)
+    elif hours > 1:
+        result += "{} hours".format(hours)
+
+    if hours > 0 and minutes > 0:
+        result += " and "
+
+    if minutes == 1:
+        result += "{} minute".format(minutes)
+    elif minutes > 1:
+        result += "{} minutes".format(minutes)
+
+    return result
+
+
 class Address(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -44,6 +84,7 @@ class Address(models.Model):
     country = models.CharField(max_length=100)
     latitude = models.DecimalField(decimal_places=6, max_digits=10)
     longitude = models.DecimalField(decimal_places=6, max_digits=10)
+    address_key = models.CharField(max_length=64, db_index=True, editable=False, default="")
 
     def __str__(self):
         return "{} {} {}".format(self.get_addr_line_1(), self.get_addr_line_2(), self.get_addr_line_3())
@@ -57,6 +98,7 @@ class Address(models.Model):
         self.state = clean_address_piece(self.state)
         self.postal_code = clean_address_piece(self.postal_code)
         self.country = clean_address_piece(self.country)
+        self.address_key = get_address_key((self.street, self.city, self.state, self.postal_code, self.country))
 
     def save(self, *args, **kwargs):
         self.clean()
@@ -80,26 +122,31 @@ class Address(models.Model):
         for key in ('street', 'city', 'state', 'postal_code', 'country'):
             if key not in address_dict:
                 raise Exception("Key '{}' was not found.".format(key))
-        temp_addr_model = Address(
-            street=address_dict['street'],
-            city=address_dict['city'],
-            state=address_dict['state'],
-            postal_code=address_dict['postal_code'],
-            country=address_dict['country']
-        )
-        temp_addr_model.clean()
-        found_addr_model = Address.objects.filter(
-            street=temp_addr_model.street,
-            city=temp_addr_model.city,
-            state=temp_addr_model.state,
-            postal_code=temp_addr_model.postal_code,
-            country=temp_addr_model.country
-        ).first()
+        address_key = get_address_key(get_cleaned_address_tuple(address_dict))
+        found_addr_model = Address.objects.filter(address_key=address_key).first()
         if found_addr_model:
             return found_addr_model
         else:
             return None
 
+    @staticmethod
+    def get_many_if_exists(address_dicts: list) -> list:
+        """
+        Look up a list of addresses with a single query.
+
+        :return: A list in the same order as address_dicts, holding the matching Address or None for each one.
+        """
+        for address_dict in address_dicts:
+            for key in ('street', 'city', 'state', 'postal_code', 'country'):
+                if key not in address_dict:
+                    raise Exception("Key '{}' was not found.".format(key))
+        address_keys = [get_address_key(get_cleaned_address_tuple(x)) for x in address_dicts]
+        if len(address_keys) == 0:
+            return []
+
+        found_addr_models = {x.address_key: x for x in Address.objects.filter(address_key__in=set(address_keys))}
+        return [found_addr_models.get(x) for x in address_keys]
+
     @staticmethod
     def address_dict_is_valid(address_dict: dict):
         print(address_dict)
@@ -124,35 +171,129 @@ class Address(models.Model):
         return str(self.country).title()
 
 
+class RouteQuerySet(models.QuerySet):
+    def with_legs(self):
+        """
+        Load each route's legs in order, along with both addresses of every leg, in one more query in total.
+        get_route_address_connections() then doesn't need the database.
+        """
+        return self.prefetch_related(models.Prefetch(
+            'route',
+            queryset=RouteAddressConnection.objects.order_by('order').select_related(
+                'address_connection__from_address', 'address_connection__to_address'
+            ),
+            to_attr='prefetched_route_address_connections'
+        ))
+
+    def bulk_create_with_keys(self, routes: list, batch_size: int = None) -> list:
+        """
+        Save many new routes at once. Their keys are generated together and replaced if any of them is already taken.
+        """
+        for attempt in range(CONST_ROUTE_KEY_MAX_ATTEMPTS):
+            for route, route_key in zip(routes, model_utils.get_route_keys(len(routes))):
+                route.route_key = route_key
+            try:
+                # Roll back to a savepoint on failure, so a surrounding transaction can still be used.
+                with transaction.atomic(using=self.db):
+                    return self.bulk_create(routes, batch_size=batch_size)
+            except IntegrityError:
+                if attempt == CONST_ROUTE_KEY_MAX_ATTEMPTS - 1:
+                    raise
+
+
 class Route(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     route_key = models.CharField(default=model_utils.route_get_unique_key, max_length=32, unique=True)
 
+    # Totals are stored when the route is saved, so showing a route doesn't need to add up its legs. Routes saved
+    # before these fields existed have None until "python manage.py backfill_route_totals" is run.
+    total_distance_meters = models.PositiveIntegerField(null=True, blank=True)
+    total_travel_seconds = models.PositiveIntegerField(null=True, blank=True)
+    num_stops = models.PositiveIntegerField(null=True, blank=True)
+    # The embed URL without the API key, which is added when the URL is used so the key can be changed.
+    gmaps_embed_params = models.TextField(blank=True, default="")
+
+    objects = RouteQuerySet.as_manager()
+
     # Save the information to the model instance so the database doesn't need to be queried multiple times.
     __route_address_connections = None
 
     def __str__(self):
         return self.route_key
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+
+        # Let the unique index catch the practically impossible case of a repeated key, and pick another one.
+        for attempt in range(CONST_ROUTE_KEY_MAX_ATTEMPTS):
+            try:
+                # Roll back to a savepoint on failure, so a surrounding transaction can still be used.
+                with transaction.atomic(using=kwargs.get('using')):
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if attempt == CONST_ROUTE_KEY_MAX_ATTEMPTS - 1:
+                    raise
+                self.route_key = model_utils.route_get_unique_key()
+
     def get_route_address_connections(self):
         if self.__route_address_connections is None:
-            self.__route_address_connections = RouteAddressConnection.objects.filter(route=self).order_by('order')
+            if hasattr(self, 'prefetched_route_address_connections'):
+                # Loaded with Route.objects.with_legs().
+                self.__route_address_connections = self.prefetched_route_address_connections
+            else:
+                self.__route_address_connections = RouteAddressConnection.objects.filter(route=self) \
+                    .order_by('order') \
+                    .select_related('address_connection__from_address', 'address_connection__to_address')
         return self.__route_address_connections
 
+    def has_stored_legs(self) -> bool:
+        """
+        :return: True if the route has totals and every leg is stored on the route, so what it shows never changes.
+        """
+        return self.num_stops is not None and all(
+            x.distance_meters is not None and x.travel_seconds is not None for x in self.get_route_address_connections()
+        )
+
+    def set_totals(self, route_address_connections: list = None):
+        """
+        Store the route's totals and map parameters on the model. Call this before saving a new route.
+
+        :param route_address_connections: The route's RouteAddressConnection models in order, with their legs set.
+            Defaults to the saved legs.
+        """
+        if route_address_connections is None:
+            route_address_connections = self.get_route_address_connections()
+        assert len(route_address_connections) > 0
+        # Add up the same legs the route's page shows.
+        self.total_distance_meters = sum([x.get_distance_meters() for x in route_address_connections])
+        self.total_travel_seconds = sum([x.get_travel_seconds() for x in route_address_connections])
+        self.num_stops = len(route_address_connections) + 1
+        self.gmaps_embed_params = self.get_gmaps_embed_params(
+            [x.address_connection for x in route_address_connections]
+        )
+
     def get_gmaps_embed_src(self) -> str:
         """
         For a full list of Google Maps Direction parameters, check here:
             https://developers.google.com/maps/documentation/embed/embedding-map#directions_mode
         """
-        found_racs = self.get_route_address_connections()
-        assert len(found_racs) > 0
-        found_address_connections = [x.address_connection for x in found_racs]
-        assert len(found_racs) == len(found_address_connections)
+        gmaps_embed_params = self.gmaps_embed_params
+        if not gmaps_embed_params:
+            gmaps_embed_params = self.get_gmaps_embed_params(
+                [x.address_connection for x in self.get_route_address_connections()]
+            )
+        return "https://www.google.com/maps/embed/v1/directions?key={}{}".format(GMAPS_API_KEY, gmaps_embed_params)
 
-        result = "https://www.google.com/maps/embed/v1/directions?"
-        result += "key={}".format(GMAPS_API_KEY)
-        result += "&mode=driving"
+    @staticmethod
+    def get_gmaps_embed_params(found_address_connections: list) -> str:
+        """
+        :return: Every parameter of the embed URL after the API key, starting with "&".
+        """
+        assert len(found_address_connections) > 0
+
+        result = "&mode=driving"
 
         # These should all be the same within a single route, so only the first needs to be checked.
         if found_address_connections[0].avoid_highways or \
@@ -176,9 +317,15 @@ class Route(models.Model):
         result += model_utils.get_url_encoded_address(destination_address_connection.to_address)
 
         waypoint_connections = found_address_connections[:-1]
+        if len(waypoint_connections) > CONST_MAX_GMAPS_EMBED_WAYPOINTS:
+            # Large routes have more stops than the map accepts. Show an evenly spaced sample so it follows the route.
+            step = len(waypoint_connections) / CONST_MAX_GMAPS_EMBED_WAYPOINTS
+            waypoint_connections = [
+                waypoint_connections[int(x * step)] for x in range(CONST_MAX_GMAPS_EMBED_WAYPOINTS)
+            ]
         if len(waypoint_connections) > 0:
             result += "&waypoints="
-            for ac in found_address_connections[:-1]:
+            for ac in waypoint_connections:
                 result += model_utils.get_url_encoded_address(ac.to_address)
                 result += "|"
             result = result.strip("|")
@@ -186,8 +333,9 @@ class Route(models.Model):
         return result
 
     def get_total_travel_time_string(self) -> str:
-        racs = self.get_route_address_connections()
-        total_travel_seconds = sum([int(x.address_connection.travel_seconds) for x in racs])
+        total_travel_seconds = self.total_travel_seconds
+        if total_travel_seconds is None:
+            total_travel_seconds = sum([x.get_travel_seconds() for x in self.get_route_address_connections()])
 
         minutes = math.ceil(total_travel_seconds / 60)
         hours = minutes // 60
@@ -227,10 +375,17 @@ class Route(models.Model):
         return model_utils.convert_km_to_miles(self.get_total_distance_km())
 
     def get_total_distance_km(self) -> float:
+        if self.total_distance_meters is not None:
+            return round(int(self.total_distance_meters) / 1000, 2)
         racs = self.get_route_address_connections()
-        total_km = sum([x.address_connection.get_distance_km() for x in racs])
+        total_km = sum([x.get_distance_km() for x in racs])
         return round(total_km, 2)
 
+    def get_num_stops(self) -> int:
+        if self.num_stops is not None:
+            return self.num_stops
+        return len(self.get_route_address_connections()) + 1
+
     def get_created_at_day_str(self) -> str:
         creation_date = self.created_at.date()
         assert isinstance(creation_date, datetime.date)
@@ -254,25 +409,7 @@ class AddressConnection(models.Model):
     travel_seconds = models.PositiveIntegerField()
 
     def get_travel_time_string(self) -> str:
-        minutes = math.ceil(int(self.travel_seconds) / 60)
-        hours = minutes // 60
-        minutes -= 60 * hours
-
-        result = ""
-        if hours == 1:
-            result += "{} hour".format(hours)
-        elif hours > 1:
-            result += "{} hours".format(hours)
-
-        if hours > 0 and minutes > 0:
-            result += " and "
-
-        if minutes == 1:
-            result += "{} minute".format(minutes)
-        elif minutes > 1:
-            result += "{} minutes".format(minutes)
-
-        return result
+        return get_leg_travel_time_string(self.travel_seconds)
 
     def get_distance_miles(self) -> float:
         return model_utils.convert_km_to_miles(self.get_distance_km())
@@ -317,6 +454,11 @@ class RouteAddressConnection(models.Model):
         AddressConnection, on_delete=models.CASCADE, related_name='address_connection'
     )
     order = models.PositiveIntegerField()
+    # The leg as it was when the route was saved. Later routes update the shared AddressConnection, so reading it would
+    # make an old route's legs disagree with its stored totals. Legs saved before these fields existed have None until
+    # "python manage.py backfill_route_totals" is run, and show the AddressConnection meanwhile.
+    distance_meters = models.PositiveIntegerField(null=True, blank=True)
+    travel_seconds = models.PositiveIntegerField(null=True, blank=True)
 
     def delete(self, using=None, keep_parents=False):
         rac_model = RouteAddressConnection.objects.filter(id=self.id).first()
@@ -333,5 +475,31 @@ class RouteAddressConnection(models.Model):
     def get_step_num(self):
         return self.order + 1
 
+    def set_leg(self):
+        """
+        Store the AddressConnection's current distance and travel time as this route's leg.
+        """
+        self.distance_meters = self.address_connection.distance_meters
+        self.travel_seconds = self.address_connection.travel_seconds
+
+    def get_distance_meters(self) -> int:
+        if self.distance_meters is not None:
+            return int(self.distance_meters)
+        return int(self.address_connection.distance_meters)
+
+    def get_travel_seconds(self) -> int:
+        if self.travel_seconds is not None:
+            return int(self.travel_seconds)
+        return int(self.address_connection.travel_seconds)
+
+    def get_travel_time_string(self) -> str:
+        return get_leg_travel_time_string(self.get_travel_seconds())
+
+    def get_distance_miles(self) -> float:
+        return model_utils.convert_km_to_miles(self.get_distance_km())
+
+    def get_distance_km(self) -> float:
+        return round(self.get_distance_meters() / 1000, 2)
+
 
 
@@ -1,3 +1,262 @@
-from django.test import TestCase
+import os
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import Client, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
+
+from api import page_cache
+from routing import model_utils
+from routing.models import Address, AddressConnection, Route, RouteAddressConnection, get_address_key, \
+    get_cleaned_address_tuple
+from security.models import hashed_ip_cache
+
+
+def create_address(street: str, latitude: str = "34.746419", longitude: str = "-92.287923") -> Address:
+    address = Address(
+        street=street,
+        city="Little Rock",
+        state="AR",
+        postal_code="72201",
+        country="United States",
+        latitude=Decimal(latitude),
+        longitude=Decimal(longitude)
+    )
+    address.save()
+    return address
+
+
+def create_route(num_stops: int, street_name: str = "Main St", store_legs: bool = True) -> Route:
+    """
+    :param store_legs: Store the legs and totals on the route, as new routes do. Otherwise, create a route like the
+        ones saved before those fields existed.
+    """
+    addresses = [
+        create_address("{} {}".format(100 + x, street_name), latitude="34.{}".format(700 + x))
+        for x in range(num_stops)
+    ]
+    route = Route()
+    route.save()
+    for index, (from_address, to_address) in enumerate(zip(addresses[:-1], addresses[1:])):
+        address_connection = AddressConnection.objects.create(
+            from_address=from_address, to_address=to_address, distance_meters=1234 * (index + 1),
+            travel_seconds=600 * (index + 1)
+        )
+        route_address_connection = RouteAddressConnection(
+            route=route, address_connection=address_connection, order=index
+        )
+        if store_legs:
+            route_address_connection.set_leg()
+        route_address_connection.save()
+    route = Route.objects.get(id=route.id)
+    if store_legs:
+        route.set_totals()
+        route.save()
+    return Route.objects.get(id=route.id)
+
+
+class TestAddressKey(TestCase):
+    def test_key_is_maintained_on_save(self):
+        address = create_address("  Woodlane &  Capitol Avenue ")
+        self.assertEqual(
+            address.address_key,
+            get_address_key(("WOODLANE & CAPITOL AVENUE", "LITTLE ROCK", "AR", "72201", "UNITED STATES"))
+        )
+
+        address.street = "2300 N Lincoln Blvd"
+        address.save()
+        self.assertEqual(Address.objects.get(id=address.id).address_key, get_address_key(
+            get_cleaned_address_tuple(address.to_dict())
+        ))
+
+    def test_get_if_exists(self):
+        address = create_address("Woodlane & Capitol Avenue")
+        address_dict = {
+            'street': 'woodlane & capitol avenue ',
+            'city': 'Little Rock',
+            'state': 'ar',
+            'postal_code': '72201',
+            'country': 'United States'
+        }
+        self.assertEqual(Address.get_if_exists(address_dict), address)
+
+        address_dict['street'] = "Somewhere else"
+        self.assertIsNone(Address.get_if_exists(address_dict))
+
+    def test_get_many_if_exists(self):
+        addresses = [create_address("{} Main St".format(100 + x)) for x in range(3)]
+        address_dicts = [x.to_dict() for x in addresses]
+        address_dicts.insert(1, dict(address_dicts[0], street="999 Unknown St"))
+        address_dicts.append(dict(address_dicts[0]))
+
+        with self.assertNumQueries(1):
+            result = Address.get_many_if_exists(address_dicts)
+        self.assertEqual(result, [addresses[0], None, addresses[1], addresses[2], addresses[0]])
+
+
+class TestRouteTotals(TestCase):
+    def test_stored_totals_match_legs(self):
+        route = create_route(4, store_legs=False)
+        self.assertIsNone(route.num_stops)
+        expected = (
+            route.get_total_distance_km(), route.get_total_travel_time_string(), route.get_num_stops(),
+            route.get_gmaps_embed_src()
+        )
+        self.assertEqual(expected[:3], (7.4, "1 hour", 4))
+
+        route.set_totals()
+        route.save()
+        route = Route.objects.get(id=route.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                (
+                    route.get_total_distance_km(), route.get_total_travel_time_string(), route.get_num_stops(),
+                    route.get_gmaps_embed_src()
+                ),
+                expected
+            )
+
+    def test_backfill_command(self):
+        routes = [create_route(3, "Main St", store_legs=False), create_route(5, "Oak St", store_legs=False)]
+        empty_route = Route()
+        empty_route.save()
+
+        call_command('backfill_route_totals', batch_size=1, stdout=open(os.devnull, 'w'))
+        for route in routes:
+            stored_route = Route.objects.get(id=route.id)
+            self.assertEqual(stored_route.num_stops, route.get_num_stops())
+            self.assertEqual(stored_route.get_total_distance_km(), route.get_total_distance_km())
+            self.assertEqual(stored_route.get_total_travel_time_string(), route.get_total_travel_time_string())
+            self.assertEqual(stored_route.get_gmaps_embed_src(), route.get_gmaps_embed_src())
+            self.assertEqual(
+                [(x.distance_meters, x.travel_seconds) for x in stored_route.get_route_address_connections()],
+                [
+                    (x.address_connection.distance_meters, x.address_connection.travel_seconds)
+                    for x in route.get_route_address_connections()
+                ]
+            )
+        self.assertIsNone(Route.objects.get(id=empty_route.id).num_stops)
+
+
+class TestShowRoute(TestCase):
+    def setUp(self):
+        page_cache.page_cache.clear()
+        hashed_ip_cache.clear()
+
+    def get_num_queries(self, route: Route) -> int:
+        route.set_totals()
+        route.save()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/route/{}/".format(route.route_key))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Step {}".format(route.num_stops - 1))
+        return len(queries)
+
+    def test_constant_number_of_queries(self):
+        small_route = create_route(3, "Small St")
+        large_route = create_route(22, "Large St")
+        self.assertEqual(self.get_num_queries(small_route), self.get_num_queries(large_route))
+
+    def test_with_legs(self):
+        route = create_route(5, "Main St")
+        with self.assertNumQueries(2):
+            route = Route.objects.with_legs().get(id=route.id)
+        with self.assertNumQueries(0):
+            racs = route.get_route_address_connections()
+            self.assertEqual([x.order for x in racs], [0, 1, 2, 3])
+            streets = [x.address_connection.from_address.street for x in racs]
+            streets.append(racs[-1].address_connection.to_address.street)
+            self.assertEqual(streets, ["{} MAIN ST".format(100 + x) for x in range(5)])
+
+    def test_response_cache(self):
+        route = create_route(4)
+        url = "/route/{}/".format(route.route_key)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertEqual(response['Last-Modified'], http_date(route.created_at.timestamp()))
+
+        with self.assertNumQueries(0):
+            cached_response = self.client.get(url)
+            self.assertEqual(cached_response.content, response.content)
+            self.assertEqual(cached_response['ETag'], response['ETag'])
+
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"outdated"').status_code, 200)
+
+        # Deleted routes are removed from the cache.
+        route.delete()
+        self.assertEqual(self.client.get(url).status_code, 302)
+
+    def test_route_without_stored_legs_is_not_cached(self):
+        route = create_route(4, store_legs=False)
+        url = "/route/{}/".format(route.route_key)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        self.assertIsNone(page_cache.page_cache.get(page_cache.get_page_cache_key(url)))
+
+        # Its legs follow the shared connections until the route is backfilled.
+        AddressConnection.objects.filter(
+            id=route.get_route_address_connections()[0].address_connection_id
+        ).update(travel_seconds=3 * 60 * 60)
+        self.assertContains(self.client.get(url), "3 hours")
+
+
+class TestShowRouteStampede(TransactionTestCase):
+    def setUp(self):
+        page_cache.page_cache.clear()
+        hashed_ip_cache.clear()
+
+    def get_in_thread(self, url: str):
+        try:
+            return Client().get(url)
+        finally:
+            connections.close_all()
+
+    def test_concurrent_requests_render_once(self):
+        route = create_route(4)
+        url = "/route/{}/".format(route.route_key)
+        num_calls = page_cache.page_flight.get_stats()['calls']
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            responses = list(executor.map(lambda _: self.get_in_thread(url), range(8)))
+        self.assertTrue(all(x.status_code == 200 for x in responses))
+        self.assertEqual(len(set(x['ETag'] for x in responses)), 1)
+        self.assertEqual(page_cache.page_flight.get_stats()['calls'], num_calls + 1)
+
+
+class TestRouteKeys(TestCase):
+    def test_get_route_keys(self):
+        keys = model_utils.get_route_keys(1000)
+        self.assertEqual(len(keys), 1000)
+        self.assertEqual(len(set(keys)), 1000)
+        self.assertTrue(all(len(x) == model_utils.CONST_ROUTE_KEY_LENGTH for x in keys))
+        self.assertEqual(set("".join(keys)) - set(model_utils.CONST_ROUTE_KEY_ALPHABET), set())
+
+    def test_save_without_key_lookup(self):
+        with CaptureQueriesContext(connection) as queries:
+            Route().save()
+        self.assertFalse(any(x['sql'].lstrip().upper().startswith("SELECT") for x in queries))
+
+    def test_repeated_key_is_replaced(self):
+        route = Route()
+        route.save()
+        repeated_route = Route(route_key=route.route_key)
+        repeated_route.save()
+        self.assertNotEqual(repeated_route.route_key, route.route_key)
+        self.assertEqual(Route.objects.count(), 2)
+
+    def test_bulk_create_with_keys(self):
+        existing_route = Route()
+        existing_route.save()
+        routes = Route.objects.bulk_create_with_keys([Route() for _ in range(500)])
+        self.assertEqual(Route.objects.count(), 501)
+        self.assertEqual(len({x.route_key for x in routes} | {existing_route.route_key}), 501)
+
+    def test_benchmark_command(self):
+        call_command('benchmark_route_keys', num_routes=20, stdout=open(os.devnull, 'w'))
+        self.assertEqual(Route.objects.count(), 0)
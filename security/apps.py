@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class SecurityConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'security'
+
+    def ready(self):
+        # Connect the signal receivers that keep the action counts and the JWT blacklist filter up to date.
+        from security import jwt_blacklist_filter, rate_counters  # noqa: F401
@@ -0,0 +1,202 @@
+"""
+Checks whether a JWT is blacklisted without querying the database, except when it might be.
+
+Each worker keeps a Bloom filter of the blacklisted JTIs, which rules out almost every token that isn't blacklisted,
+and a bounded LRU cache of the JTIs the database has confirmed, which expire when their tokens do. Only the tokens the
+Bloom filter can't rule out, and that aren't confirmed yet, are looked up.
+
+Workers see each other's changes through two counters in the SQLite file shared by every worker on the host. When a
+JTI is blacklisted, the "inserts" counter goes up, and each worker loads the recently blacklisted JTIs on its next
+check. When one is removed, the "deletions" counter goes up, and each worker forgets the JTIs it had confirmed.
+"""
+import datetime
+import threading
+import time
+
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from api import metrics
+from api.caching import BloomFilter, LRUCache, SQLiteStore
+from security.models import JWTBlacklist
+
+CONST_BLOOM_FILTER_MIN_CAPACITY = 100_000
+CONST_BLOOM_FILTER_ERROR_RATE = 0.01
+CONST_BLOOM_FILTER_REBUILD_SECONDS = 60 * 60  # Rebuilding drops the JTIs of expired tokens.
+CONST_CONFIRMED_MAX_ENTRIES = 10_000
+CONST_CONFIRMED_TTL_SECONDS = 60 * 60  # The longest a confirmed JTI is kept, even if its token hasn't expired.
+CONST_SYNC_OVERLAP_SECONDS = 5 * 60  # JTIs saved this long before a sync may not have been committed yet.
+CONST_STATE_TTL_SECONDS = 365 * 24 * 60 * 60
+
+
+class JWTBlacklistFilter:
+    def __init__(self, table_name: str, path: str = None):
+        self.store = SQLiteStore(table_name=table_name, path=path)
+        self.confirmed = LRUCache(max_entries=CONST_CONFIRMED_MAX_ENTRIES, ttl_seconds=CONST_CONFIRMED_TTL_SECONDS)
+        self.__lock = threading.Lock()
+        self.__bloom_filter = None
+        self.__built_at = None
+        self.__synced_at = None
+        self.__state = None  # The shared counters, as of the last sync.
+        self.num_ruled_out = 0
+        self.num_lookups = 0
+
+    def __get_shared_state(self) -> dict or None:
+        """
+        :return: The shared counters, or None if the shared store can't be used.
+        """
+        state = self.store.get("state")
+        if state is None:
+            state = self.store.update(
+                "state", lambda x: x or {'inserts': 0, 'deletions': 0}, ttl_seconds=CONST_STATE_TTL_SECONDS
+            )
+        return state
+
+    def __change_shared_state(self, counter: str) -> dict or None:
+        """
+        Count a change made by this worker.
+
+        :return: The new shared counters if no other worker changed them since the last sync, so there is nothing new
+            to load. Otherwise, the counters as of the last sync.
+        """
+        previous_states = []
+
+        def add_one(state: dict or None) -> dict:
+            state = state or {'inserts': 0, 'deletions': 0}
+            previous_states.append(dict(state))
+            state[counter] += 1
+            return state
+        new_state = self.store.update("state", add_one, ttl_seconds=CONST_STATE_TTL_SECONDS)
+        if new_state is not None and previous_states[-1] == self.__state:
+            return new_state
+        return self.__state
+
+    def __build(self, state: dict):
+        now = timezone.now()
+        jtis = list(JWTBlacklist.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=now)
+        ).values_list('jti', flat=True))
+        bloom_filter = BloomFilter(
+            capacity=max(CONST_BLOOM_FILTER_MIN_CAPACITY, 2 * len(jtis)), error_rate=CONST_BLOOM_FILTER_ERROR_RATE
+        )
+        for jti in jtis:
+            bloom_filter.add(jti)
+        self.__bloom_filter = bloom_filter
+        self.__built_at = time.monotonic()
+        self.__synced_at = now
+        self.__state = state
+        self.confirmed.clear()
+
+    def __sync(self, state: dict):
+        if self.__bloom_filter is None or self.__bloom_filter.is_full() or \
+                time.monotonic() - self.__built_at > CONST_BLOOM_FILTER_REBUILD_SECONDS:
+            self.__build(state)
+            return
+
+        if state['deletions'] != self.__state['deletions']:
+            self.confirmed.clear()
+        if state['inserts'] != self.__state['inserts']:
+            now = timezone.now()
+            for jti in JWTBlacklist.objects.filter(
+                created_at__gte=self.__synced_at - datetime.timedelta(seconds=CONST_SYNC_OVERLAP_SECONDS)
+            ).values_list('jti', flat=True):
+                self.__bloom_filter.add(jti)
+            self.__synced_at = now
+        self.__state = state
+
+    def __lookup(self, jti: str) -> bool:
+        self.num_lookups += 1
+        found = JWTBlacklist.objects.filter(jti=jti).values_list('id', 'expires_at').first()
+        if found is None:
+            return False
+        ttl_seconds = CONST_CONFIRMED_TTL_SECONDS
+        if found[1] is not None:
+            ttl_seconds = min(ttl_seconds, (found[1] - timezone.now()).total_seconds())
+        self.confirmed.set(jti, True, ttl_seconds=ttl_seconds)
+        return True
+
+    def is_blacklisted(self, jti: str) -> bool:
+        state = self.__get_shared_state()
+        if state is None:
+            # Other workers' changes can't be seen, so only the database can be trusted.
+            return self.__lookup(jti)
+
+        with self.__lock:
+            self.__sync(state)
+            if jti not in self.__bloom_filter:
+                self.num_ruled_out += 1
+                return False
+        if self.confirmed.get(jti) is not None:
+            return True
+        return self.__lookup(jti)
+
+    def record_insert(self, jti: str):
+        with self.__lock:
+            if self.__bloom_filter is not None:
+                self.__bloom_filter.add(jti)
+            self.__state = self.__change_shared_state('inserts')
+
+    def record_delete(self):
+        with self.__lock:
+            self.__state = self.__change_shared_state('deletions')
+
+    def clear(self):
+        with self.__lock:
+            self.__bloom_filter = None
+            self.confirmed.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            'ruled_out': self.num_ruled_out,
+            'lookups': self.num_lookups,
+            'confirmed_size': len(self.confirmed),
+            'bloom_filter_size': self.__bloom_filter.num_items if self.__bloom_filter is not None else 0,
+        }
+
+
+jwt_blacklist_filter = JWTBlacklistFilter(table_name="jwt_blacklist_filter")
+
+
+def collect_filter_metrics() -> list:
+    stats = jwt_blacklist_filter.get_stats()
+    return [
+        (
+            metrics.CONST_METRIC_PREFIX + name, "counter", description,
+            [(metrics.CONST_METRIC_PREFIX + name, {}, stats[key]), ]
+        )
+        for name, description, key in (
+            ("jwt_blacklist_ruled_out_total", "JWT blacklist checks answered by the Bloom filter alone.", 'ruled_out'),
+            ("jwt_blacklist_lookups_total", "JWT blacklist checks that queried the database.", 'lookups'),
+        )
+    ]
+
+
+metrics.register_collector(collect_filter_metrics)
+
+
+def is_request_jwt_blacklisted(request) -> bool:
+    """
+    Give the same answer as JWTBlacklist.check_if_jwt_is_blacklisted_with_request(), but usually without touching
+    the database.
+    """
+    return jwt_blacklist_filter.is_blacklisted(JWTBlacklist.get_jti_from_request(request))
+
+
+# The shared counters are changed once the transaction commits, so other workers never load a JTI before they can see
+# it. A rolled back JTI could only make the Bloom filter answer "maybe", which the database then rules out.
+
+@receiver(post_save, sender=JWTBlacklist)
+def filter_blacklisted_jwt(sender, instance: JWTBlacklist, created: bool, **kwargs):
+    if created:
+        transaction.on_commit(lambda: jwt_blacklist_filter.record_insert(instance.jti))
+
+
+@receiver(post_delete, sender=JWTBlacklist)
+def unfilter_blacklisted_jwt(sender, instance: JWTBlacklist, **kwargs):
+    if instance.expires_at is not None and instance.expires_at <= timezone.now():
+        return  # The token is refused anyway. This keeps compacting old JTIs quick.
+    jwt_blacklist_filter.confirmed.delete(instance.jti)
+    transaction.on_commit(jwt_blacklist_filter.record_delete)
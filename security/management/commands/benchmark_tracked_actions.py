@@ -0,0 +1,78 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory
+
+from api import views as api_views
+from routing import views as routing_views
+from security.middleware import attach_hashed_ip
+from security.models import HashedIP, TrackedAction
+
+# The action types and windows the routing form checks, in minutes.
+CONST_FORM_CHECK_WINDOWS = {
+    routing_views.CONST_ACTION_STR_SUBMIT_ROUTING_FORM: 10,
+    routing_views.CONST_ACTION_STR_LOAD_ROUTING_FORM_PAGE: 10,
+    api_views.CONST_ACTION_STR_USED_BLACLISTED_JWT: 60 * 24,
+}
+
+
+def get_client_ip_string(client_number: int) -> str:
+    return "10.{}.{}.{}".format((client_number >> 16) & 255, (client_number >> 8) & 255, client_number & 255)
+
+
+class Command(BaseCommand):
+    help = "Measures the routing form's database checks against a large TrackedAction table. Every row it adds is " \
+           "rolled back. To compare indexes, run it before and after migrating them."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--num-rows', type=int, default=10_000_000, help="How many TrackedActions to add.")
+        parser.add_argument('--num-clients', type=int, default=100_000, help="How many clients to spread them over.")
+        parser.add_argument('--num-checks', type=int, default=200, help="How many form loads to time.")
+        parser.add_argument('--batch-size', type=int, default=10_000, help="Rows to insert at once.")
+
+    def report(self, name: str, num_items: int, seconds: float):
+        self.stdout.write("{}: {:.3f} ms each ({:.3f} seconds for {})".format(
+            name, 1000 * seconds / num_items if num_items > 0 else 0.0, seconds, num_items
+        ))
+
+    def handle(self, *args, **options):
+        num_rows = options['num_rows']
+        num_clients = max(1, min(options['num_clients'], num_rows, 1 << 24))
+        batch_size = options['batch_size']
+        action_types = list(CONST_FORM_CHECK_WINDOWS.keys())
+
+        with transaction.atomic():
+            start_time = time.perf_counter()
+            clients = HashedIP.objects.bulk_create(
+                [HashedIP(hashed_ip=HashedIP.get_hashed_ip(get_client_ip_string(x))) for x in range(num_clients)],
+                batch_size=batch_size
+            )
+            for first in range(0, num_rows, batch_size):
+                TrackedAction.objects.bulk_create([
+                    TrackedAction(hashed_ip=clients[x % num_clients], action_type=action_types[x % len(action_types)])
+                    for x in range(first, min(first + batch_size, num_rows))
+                ])
+            self.report("Rows added", num_rows, time.perf_counter() - start_time)
+
+            # The counts that a form load falls back to when the shared counter can't answer, for a client who already
+            # has their share of the rows.
+            request = RequestFactory().get("/route/", REMOTE_ADDR=get_client_ip_string(0))
+            attach_hashed_ip(request)
+            start_time = time.perf_counter()
+            for _ in range(options['num_checks']):
+                for action_type, num_minutes in CONST_FORM_CHECK_WINDOWS.items():
+                    TrackedAction.get_actions_within_last_x_minutes(
+                        request, action_type=action_type, num_minutes=num_minutes
+                    ).count()
+            self.report("Form load checks", options['num_checks'], time.perf_counter() - start_time)
+
+            # Each form load also saves an action, which has to update every index.
+            start_time = time.perf_counter()
+            for _ in range(options['num_checks']):
+                TrackedAction.create_action_with_request_and_type(
+                    request, routing_views.CONST_ACTION_STR_LOAD_ROUTING_FORM_PAGE
+                )
+            self.report("Form load actions saved", options['num_checks'], time.perf_counter() - start_time)
+
+            transaction.set_rollback(True)
@@ -0,0 +1,100 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from api.models import APIRequest
+from security import rate_counters
+from security.models import JWTBlacklist, TrackedAction, TrackedActionDailyCount
+
+
+def get_jwt_retention() -> datetime.timedelta:
+    """
+    :return: How long a blacklisted JTI whose expiry wasn't kept is needed. After this, its token has expired and is
+        refused anyway.
+    """
+    return max(settings.SIMPLE_JWT['ACCESS_TOKEN_LIFETIME'], settings.SIMPLE_JWT['REFRESH_TOKEN_LIFETIME'])
+
+
+def compact_tracked_actions(older_than: datetime.datetime, batch_size: int) -> int:
+    """
+    Add the TrackedActions created before older_than to the daily counts, then delete them.
+
+    :return: The number of actions deleted.
+    """
+    num_deleted = 0
+    while True:
+        # Each batch is counted and deleted together, so an interrupted run never counts an action twice.
+        with transaction.atomic():
+            action_ids = list(
+                TrackedAction.objects.filter(created_at__lt=older_than).order_by('created_at').values_list(
+                    'id', flat=True
+                )[:batch_size]
+            )
+            if len(action_ids) == 0:
+                return num_deleted
+
+            daily_counts = TrackedAction.objects.filter(id__in=action_ids).annotate(
+                day=TruncDate('created_at')
+            ).values('day', 'action_type').annotate(num_actions=Count('id')).order_by()
+            for daily_count in daily_counts:
+                found_count, _ = TrackedActionDailyCount.objects.get_or_create(
+                    day=daily_count['day'], action_type=daily_count['action_type']
+                )
+                TrackedActionDailyCount.objects.filter(id=found_count.id).update(
+                    count=F('count') + daily_count['num_actions']
+                )
+
+            TrackedAction.objects.filter(id__in=action_ids).delete()
+        num_deleted += len(action_ids)
+
+
+def delete_in_batches(queryset, batch_size: int) -> int:
+    """
+    :return: The number of rows deleted.
+    """
+    num_deleted = 0
+    while True:
+        ids = list(queryset.order_by().values_list('id', flat=True)[:batch_size])
+        if len(ids) == 0:
+            return num_deleted
+        queryset.model.objects.filter(id__in=ids).delete()
+        num_deleted += len(ids)
+
+
+class Command(BaseCommand):
+    help = "Deletes TrackedActions, blacklisted JWTs and APIRequests that are no longer needed. Deleted actions are " \
+           "kept as daily counts for each action type. Safe to run as often as you like, such as from a daily cron job."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000, help="Rows to delete at once.")
+        parser.add_argument(
+            '--api-request-days', type=int, default=30, help="How many days of APIRequests to keep for auditing."
+        )
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        batch_size = options['batch_size']
+
+        # The rate checks never look further back than this.
+        num_actions = compact_tracked_actions(
+            older_than=now - datetime.timedelta(minutes=rate_counters.CONST_MAX_WINDOW_MINUTES), batch_size=batch_size
+        )
+        num_jtis = delete_in_batches(
+            JWTBlacklist.objects.filter(
+                Q(expires_at__lt=now) | Q(expires_at__isnull=True, created_at__lt=now - get_jwt_retention())
+            ),
+            batch_size=batch_size
+        )
+        num_api_requests = delete_in_batches(
+            APIRequest.objects.filter(time__lt=now - datetime.timedelta(days=options['api_request_days'])),
+            batch_size=batch_size
+        )
+
+        self.stdout.write("Compacted {} tracked actions. Deleted {} blacklisted JWTs and {} API requests.".format(
+            num_actions, num_jtis, num_api_requests
+        ))
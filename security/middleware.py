@@ -0,0 +1,32 @@
+import asyncio
+
+from django.utils.decorators import sync_and_async_middleware
+from django.utils.functional import SimpleLazyObject
+from ipware import get_client_ip
+
+from security.models import HashedIP
+
+
+def attach_hashed_ip(request):
+    """
+    Hash the client's IP address once, and attach it to the request as request.hashed_ip_str. request.hashed_ip is the
+    client's HashedIP model, which is only looked up (or created) the first time it is used.
+    """
+    client_ip, _ = get_client_ip(request)
+    if client_ip is None:
+        return  # The HashedIP helpers raise an exception if they are used for this request.
+    request.hashed_ip_str = HashedIP.get_hashed_ip(client_ip)
+    request.hashed_ip = SimpleLazyObject(lambda: HashedIP.get_or_create_by_hash(request.hashed_ip_str))
+
+
+@sync_and_async_middleware
+def hashed_ip_middleware(get_response):
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            attach_hashed_ip(request)
+            return await get_response(request)
+    else:
+        def middleware(request):
+            attach_hashed_ip(request)
+            return get_response(request)
+    return middleware
@@ -0,0 +1,38 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('security', '0002_jwtblacklist'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrackedActionDailyCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('action_type', models.CharField(max_length=200)),
+                ('count', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='jwtblacklist',
+            index=models.Index(fields=['created_at'], name='jwtblacklist_created_at'),
+        ),
+        migrations.AddIndex(
+            model_name='trackedaction',
+            index=models.Index(fields=['hashed_ip', 'action_type', 'created_at'], name='trackedaction_ip_type_time'),
+        ),
+        migrations.AddIndex(
+            model_name='trackedaction',
+            index=models.Index(fields=['created_at'], name='trackedaction_created_at'),
+        ),
+        migrations.AddConstraint(
+            model_name='trackedactiondailycount',
+            constraint=models.UniqueConstraint(fields=('day', 'action_type'), name='trackedactiondailycount_day_type'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.0.6 on 2026-10-18 16:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('security', '0003_retention_indexes_and_daily_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jwtblacklist',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='jwtblacklist',
+            index=models.Index(fields=['expires_at'], name='jwtblacklist_expires_at'),
+        ),
+    ]
@@ -7,9 +7,17 @@ import jwt
 from django.db.models import QuerySet
 from ipware import get_client_ip
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from rest_framework.authentication import get_authorization_header
 
+from api import metrics
+from api.caching import LRUCache
+
+CONST_HASHED_IP_CACHE_MAX_ENTRIES = 10000
+CONST_HASHED_IP_CACHE_TTL_SECONDS = 60 * 60
+
 
 class HashedIP(models.Model):
     # This string is used to anonymize client IP addresses. Each IP address is concatenated alongside this random,
@@ -49,36 +57,98 @@ class HashedIP(models.Model):
         super().save(*args, **kwargs)
 
     @classmethod
-    def get_or_create_from_request(cls, request):
+    def get_hashed_ip_from_request(cls, request) -> str:
+        # security.middleware hashes the IP address once per request.
+        ip_hash = getattr(request, 'hashed_ip_str', None)
+        if ip_hash is not None:
+            return ip_hash
+
         client_ip, _ = get_client_ip(request)
         if client_ip is None:
             raise Exception("Could not retrieve client IP address from request.")
-        else:
-            ip_hash = cls.get_hashed_ip(client_ip)
-            found_ip = HashedIP.objects.filter(hashed_ip=ip_hash).first()
-
-            if found_ip is None:
-                found_ip = HashedIP(hashed_ip=client_ip)
-                found_ip.save()
+        return cls.get_hashed_ip(client_ip)
 
+    @classmethod
+    def get_or_create_from_request(cls, request):
+        # security.middleware looks up the HashedIP at most once per request.
+        found_ip = getattr(request, 'hashed_ip', None)
+        if found_ip is not None:
             return found_ip
+        return cls.get_or_create_by_hash(cls.get_hashed_ip_from_request(request))
+
+    @classmethod
+    def get_or_create_by_hash(cls, ip_hash: str):
+        found_id = hashed_ip_cache.get(ip_hash)
+        if found_id is not None:
+            # The other fields are loaded if they're ever used.
+            return cls.from_db(None, ['id', 'hashed_ip'], [found_id, ip_hash])
+
+        with metrics.stage_seconds.time("hashed_ip_lookup"):
+            found_ip, _ = cls.objects.get_or_create(hashed_ip=ip_hash)
+        # Wait for the commit, so a HashedIP that is rolled back is never cached.
+        found_id = found_ip.id
+        transaction.on_commit(lambda: hashed_ip_cache.set(ip_hash, found_id))
+        return found_ip
+
+    @classmethod
+    def save_with_hashed_ip(cls, instance: models.Model):
+        """
+        Save a model whose hashed_ip may have come from the cache. If the HashedIP was deleted without this process
+        knowing, for example by another worker, the insert fails, so look the HashedIP up again and save once more.
+
+        Inside a transaction, the foreign key is only checked when the outermost transaction commits, so a deleted
+        HashedIP can't be noticed here. Requests aren't wrapped in transactions, so this only matters to callers that
+        open their own.
+        """
+        try:
+            with transaction.atomic():
+                instance.save()
+        except IntegrityError:
+            if cls.objects.filter(id=instance.hashed_ip_id).exists():
+                raise
+            ip_hash = instance.hashed_ip.hashed_ip
+            hashed_ip_cache.delete(ip_hash)
+            instance.hashed_ip = cls.get_or_create_by_hash(ip_hash)
+            instance.pk = None
+            instance._state.adding = True
+            instance.save()
 
     def __str__(self):
         self.clean()
         return str(self.hashed_ip)
 
 
+# Recent clients' HashedIP IDs, so requests from the same client don't look them up again. Entries for deleted HashedIPs
+# are removed in this process right away. Other processes find out when they expire, or when saving an action with one
+# fails. See HashedIP.save_with_hashed_ip().
+hashed_ip_cache = LRUCache(max_entries=CONST_HASHED_IP_CACHE_MAX_ENTRIES, ttl_seconds=CONST_HASHED_IP_CACHE_TTL_SECONDS)
+metrics.register_cache("hashed_ip", hashed_ip_cache)
+
+
+@receiver(post_delete, sender=HashedIP)
+def invalidate_cached_hashed_ip(sender, instance: HashedIP, **kwargs):
+    hashed_ip_cache.delete(instance.hashed_ip)
+
+
 class TrackedAction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     hashed_ip = models.ForeignKey(HashedIP, on_delete=models.CASCADE)
     action_type = models.CharField(max_length=200)
 
+    class Meta:
+        indexes = [
+            # The rate checks count one client's recent actions of one type.
+            models.Index(fields=['hashed_ip', 'action_type', 'created_at'], name='trackedaction_ip_type_time'),
+            # Old actions are compacted by age. See the compact_security_tables command.
+            models.Index(fields=['created_at'], name='trackedaction_created_at'),
+        ]
+
     @staticmethod
     def create_action_with_request_and_type(request, action_type: str) -> QuerySet:
         found_hashed_ip = HashedIP.get_or_create_from_request(request)
         action = TrackedAction(hashed_ip=found_hashed_ip, action_type=action_type)
-        action.save()
+        HashedIP.save_with_hashed_ip(action)
         return TrackedAction.objects.filter(id=action.id)
 
     @staticmethod
@@ -92,10 +162,34 @@ class TrackedAction(models.Model):
         return found_actions
 
 
+class TrackedActionDailyCount(models.Model):
+    """
+    How many TrackedActions of each type there were on each day (in UTC), kept after the actions themselves are deleted.
+    """
+    day = models.DateField()
+    action_type = models.CharField(max_length=200)
+    count = models.PositiveBigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'action_type'], name='trackedactiondailycount_day_type'),
+        ]
+
+    def __str__(self):
+        return "{}, {}: {}".format(self.day, self.action_type, self.count)
+
+
 class JWTBlacklist(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     jti = models.CharField(max_length=200, unique=True)
+    expires_at = models.DateTimeField(null=True, blank=True)  # The token's "exp". Null for older JTIs.
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='jwtblacklist_created_at'),
+            models.Index(fields=['expires_at'], name='jwtblacklist_expires_at'),
+        ]
 
     @staticmethod
     def __get_jwt_from_request(request) -> str:
@@ -105,13 +199,16 @@ class JWTBlacklist(models.Model):
         return str(jwt_list[0])
 
     @staticmethod
-    def __get_jti_from_jwt(jwt_str: str) -> str:
-        payload_dict = jwt.decode(jwt_str, options={"verify_signature": False})
-        return payload_dict['jti']
+    def __get_payload_from_jwt(jwt_str: str) -> dict:
+        return jwt.decode(jwt_str, options={"verify_signature": False})
+
+    @classmethod
+    def get_jti_from_request(cls, request) -> str:
+        return cls.__get_payload_from_jwt(cls.__get_jwt_from_request(request))['jti']
 
     @classmethod
     def get_by_jwt(cls, jwt_str: str) -> QuerySet:
-        jti_str = cls.__get_jti_from_jwt(jwt_str)
+        jti_str = cls.__get_payload_from_jwt(jwt_str)['jti']
         return JWTBlacklist.objects.filter(jti=jti_str)
 
     @classmethod
@@ -120,25 +217,22 @@ class JWTBlacklist(models.Model):
         return cls.get_by_jwt(jwt_str)
 
     @classmethod
-    def create_by_jwt(cls, jwt_str) -> QuerySet:
-        if cls.get_by_jwt(jwt_str).first() is None:
-            jti_str = cls.__get_jti_from_jwt(jwt_str)
-            blacklisted_token = JWTBlacklist(jti=jti_str)
-            blacklisted_token.save()
-        result = cls.get_by_jwt(jwt_str)
-        print(result)
-        return result
+    def create_by_jwt(cls, jwt_str):
+        payload_dict = cls.__get_payload_from_jwt(jwt_str)
+        expires_at = None
+        if 'exp' in payload_dict:
+            expires_at = datetime.datetime.fromtimestamp(payload_dict['exp'], tz=datetime.timezone.utc)
+        blacklisted_token, _ = JWTBlacklist.objects.get_or_create(
+            jti=payload_dict['jti'], defaults={'expires_at': expires_at}
+        )
+        return blacklisted_token
 
     @classmethod
-    def create_by_request(cls, request) -> QuerySet:
+    def create_by_request(cls, request):
         jwt_str = cls.__get_jwt_from_request(request)
-        result = cls.create_by_jwt(jwt_str)
-        print(result)
-        return result
+        return cls.create_by_jwt(jwt_str)
 
     @classmethod
     def check_if_jwt_is_blacklisted_with_request(cls, request) -> bool:
-        print("\n\n\n", cls.get_by_request(request), "\n\n\n")
-        return len(cls.get_by_request(request)) > 0
-
-
+        # Always queries the database. security.jwt_blacklist_filter.is_request_jwt_blacklisted() usually doesn't.
+        return cls.get_by_request(request).exists()
@@ -0,0 +1,139 @@
+"""
+Sliding-window counts of each client's TrackedActions, kept in the SQLite file shared by every worker on the host.
+
+The abuse checks on the routing form and the route API only need to know how many times a client did something
+recently, so they read these counts instead of querying the database. TrackedAction rows are still saved as an audit
+trail, and signals keep the counts in step with them, including when an action is deleted.
+"""
+import time
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from api.caching import SQLiteStore
+from security.models import HashedIP, TrackedAction
+
+CONST_MAX_WINDOW_MINUTES = 60 * 24  # The longest window any check uses. Older events are dropped.
+CONST_MAX_EVENTS_PER_ACTION = 100  # Only the newest events are kept. Every check's threshold is far below this.
+CONST_STARTED_AT_TTL_SECONDS = 365 * 24 * 60 * 60
+
+
+class SlidingWindowCounter:
+    """
+    Keeps the times of recent events for each key, grouped by event type, so events within any window up to
+    max_window_seconds can be counted.
+
+    Counts are only complete for windows that started after the counter did. Use get_counts(), which reports windows
+    that reach further back than that as unknown.
+    """
+    def __init__(self, table_name: str, max_window_seconds: float, path: str = None):
+        self.max_window_seconds = max_window_seconds
+        self.store = SQLiteStore(table_name=table_name, path=path)
+        self.__started_at = None
+
+    def get_started_at(self) -> float or None:
+        """
+        :return: When the counter started recording on this host, or None if the shared store can't be used.
+        """
+        if self.__started_at is None:
+            self.__started_at = self.store.update(
+                "started_at", lambda x: x or time.time(), ttl_seconds=CONST_STARTED_AT_TTL_SECONDS
+            )
+        return self.__started_at
+
+    def record(self, key: str, event_type: str, timestamp: float):
+        self.get_started_at()
+
+        def add_event(events: dict or None) -> dict:
+            events = self.__prune(events or {})
+            timestamps = sorted(events.get(event_type, []) + [timestamp, ])
+            events[event_type] = timestamps[-CONST_MAX_EVENTS_PER_ACTION:]
+            return events
+        self.store.update("key|{}".format(key), add_event, ttl_seconds=self.max_window_seconds)
+
+    def remove(self, key: str, event_type: str, timestamp: float):
+        def remove_event(events: dict or None) -> dict:
+            events = self.__prune(events or {})
+            timestamps = events.get(event_type, [])
+            if timestamp in timestamps:
+                timestamps.remove(timestamp)
+            return events
+        self.store.update("key|{}".format(key), remove_event, ttl_seconds=self.max_window_seconds)
+
+    def get_counts(self, key: str, windows: dict) -> dict:
+        """
+        :param windows: Maps each event type to count to the length of its window, in seconds.
+        :return: Maps each event type to the number of its events within its window, or None if the count is unknown
+            because the window reaches back before the counter started.
+        """
+        now = time.time()
+        started_at = self.get_started_at()
+        events = self.store.get("key|{}".format(key)) or {}
+        counts = {}
+        for event_type, window_seconds in windows.items():
+            if started_at is None or started_at > now - window_seconds or window_seconds > self.max_window_seconds:
+                counts[event_type] = None
+            else:
+                counts[event_type] = sum(1 for x in events.get(event_type, []) if x >= now - window_seconds)
+        return counts
+
+    def clear(self):
+        self.store.clear()
+        self.__started_at = None
+
+    def __prune(self, events: dict) -> dict:
+        oldest_allowed = time.time() - self.max_window_seconds
+        return {
+            event_type: [x for x in timestamps if x >= oldest_allowed]
+            for event_type, timestamps in events.items()
+        }
+
+
+tracked_action_counter = SlidingWindowCounter(
+    table_name="rate_tracked_actions",
+    max_window_seconds=CONST_MAX_WINDOW_MINUTES * 60
+)
+
+
+def get_action_counts(request, windows: dict) -> dict:
+    """
+    Count the client's recent TrackedActions. This gives the same numbers as
+    TrackedAction.get_actions_within_last_x_minutes(), but usually without touching the database.
+
+    :param windows: Maps each action type to count to the length of its window, in minutes.
+    :return: Maps each action type to the number of times the client did it within its window.
+    """
+    hashed_ip = HashedIP.get_hashed_ip_from_request(request)
+    counts = tracked_action_counter.get_counts(hashed_ip, {x: y * 60 for x, y in windows.items()})
+    for action_type, count in counts.items():
+        if count is None:
+            # The counter is newer than the window, so it may have missed some actions. Ask the database.
+            counts[action_type] = TrackedAction.get_actions_within_last_x_minutes(
+                request, action_type=action_type, num_minutes=windows[action_type]
+            ).count()
+    return counts
+
+
+# Counts are changed once the transaction commits, so rolled back actions are never counted.
+
+@receiver(post_save, sender=TrackedAction)
+def count_tracked_action(sender, instance: TrackedAction, created: bool, **kwargs):
+    if created:
+        hashed_ip = instance.hashed_ip.hashed_ip
+        transaction.on_commit(lambda: tracked_action_counter.record(
+            hashed_ip, instance.action_type, instance.created_at.timestamp()
+        ))
+
+
+@receiver(post_delete, sender=TrackedAction)
+def uncount_tracked_action(sender, instance: TrackedAction, **kwargs):
+    if instance.created_at.timestamp() < time.time() - tracked_action_counter.max_window_seconds:
+        return  # The counter has already dropped it. This keeps compacting old actions quick.
+    try:
+        hashed_ip = instance.hashed_ip.hashed_ip
+    except HashedIP.DoesNotExist:
+        return  # The client's HashedIP was deleted too, so nothing will look up their counts again.
+    transaction.on_commit(lambda: tracked_action_counter.remove(
+        hashed_ip, instance.action_type, instance.created_at.timestamp()
+    ))
@@ -1,3 +1,283 @@
-from django.test import TestCase
+import datetime
+import os
+import tempfile
+import time
 
-# Create your tests here.
+import jwt
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api import manual_tokens
+from api.caching import BloomFilter
+from api.models import API, APIRequest, RouteJob
+from routing import views as routing_views
+from security import jwt_blacklist_filter, rate_counters
+from security.middleware import attach_hashed_ip
+from security.models import HashedIP, JWTBlacklist, TrackedAction, TrackedActionDailyCount, hashed_ip_cache
+
+
+class TestSlidingWindowCounter(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.counter = rate_counters.SlidingWindowCounter(
+            table_name="test_counter", max_window_seconds=60 * 60, path=os.path.join(self.temp_dir.name, "cache.db")
+        )
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_counts_within_window(self):
+        now = time.time()
+        self.counter.store.set("started_at", now - 2 * 60 * 60, ttl_seconds=60)
+        for seconds_ago in (10, 20, 200, 2000, 4000):
+            self.counter.record("client", "load", now - seconds_ago)
+        self.counter.record("client", "submit", now)
+        self.counter.record("other client", "load", now)
+
+        self.assertEqual(
+            self.counter.get_counts("client", {'load': 100, 'submit': 100, 'blacklisted': 100}),
+            {'load': 2, 'submit': 1, 'blacklisted': 0}
+        )
+        self.assertEqual(self.counter.get_counts("client", {'load': 3000})['load'], 4)
+
+        self.counter.remove("client", "load", now - 10)
+        self.assertEqual(self.counter.get_counts("client", {'load': 100})['load'], 1)
+
+    def test_windows_older_than_counter_are_unknown(self):
+        self.counter.record("client", "load", time.time())
+        self.assertEqual(self.counter.get_counts("client", {'load': 100}), {'load': None})
+
+
+class TestRoutingFormChecks(TestCase):
+    def setUp(self):
+        rate_counters.tracked_action_counter.clear()
+        rate_counters.tracked_action_counter.store.set(
+            "started_at", time.time() - 2 * 24 * 60 * 60, ttl_seconds=60 * 60
+        )
+        manual_tokens.token_generator_user_cache.clear()
+        hashed_ip_cache.clear()
+
+    def get_form(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.get("/route/")
+
+    def test_checks_do_not_query_database(self):
+        self.assertEqual(self.get_form().status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.get_form().status_code, 200)
+        sql = [x['sql'] for x in queries]
+        # Only the audit trail is written.
+        self.assertFalse(any('"security_trackedaction"' in x and x.startswith("SELECT") for x in sql))
+        self.assertFalse(any('"auth_user"' in x for x in sql))
+
+    def test_too_many_form_loads(self):
+        for _ in range(5):
+            self.assertEqual(self.get_form().status_code, 200)
+        self.assertEqual(self.get_form().status_code, 302)
+
+        # Deleted actions stop counting.
+        with self.captureOnCommitCallbacks(execute=True):
+            TrackedAction.objects.filter(action_type=routing_views.CONST_ACTION_STR_LOAD_ROUTING_FORM_PAGE).first() \
+                .delete()
+        self.assertEqual(self.get_form().status_code, 200)
+
+    def test_recent_submission(self):
+        hashed_ip = HashedIP(hashed_ip="127.0.0.1")
+        hashed_ip.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            TrackedAction.objects.create(
+                hashed_ip=hashed_ip, action_type=routing_views.CONST_ACTION_STR_SUBMIT_ROUTING_FORM
+            )
+        response = self.get_form()
+        self.assertTemplateUsed(response, 'waiting_page.html')
+
+    def test_new_counter_falls_back_to_database(self):
+        rate_counters.tracked_action_counter.clear()
+        hashed_ip = HashedIP(hashed_ip="127.0.0.1")
+        hashed_ip.save()
+        TrackedAction.objects.create(
+            hashed_ip=hashed_ip, action_type=routing_views.CONST_ACTION_STR_SUBMIT_ROUTING_FORM
+        )
+        # The counter missed this action, but it just started, so it isn't trusted yet.
+        self.assertTemplateUsed(self.get_form(), 'waiting_page.html')
+
+
+class TestHashedIPMiddleware(TestCase):
+    def setUp(self):
+        hashed_ip_cache.clear()
+
+    def get_request(self):
+        request = RequestFactory().get("/", REMOTE_ADDR="203.0.113.7")
+        attach_hashed_ip(request)
+        return request
+
+    def test_hashed_once_per_request(self):
+        request = self.get_request()
+        self.assertEqual(request.hashed_ip_str, HashedIP.get_hashed_ip("203.0.113.7"))
+        self.assertEqual(HashedIP.get_hashed_ip_from_request(request), request.hashed_ip_str)
+
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(4):
+            # The HashedIP is created with the first use, then reused for the rest of the request.
+            found_ip = HashedIP.get_or_create_from_request(request)
+            self.assertEqual(HashedIP.get_or_create_from_request(request).pk, found_ip.pk)
+        self.assertEqual(found_ip.hashed_ip, request.hashed_ip_str)
+
+        # Later requests from the same client don't look it up at all.
+        with self.assertNumQueries(0):
+            self.assertEqual(HashedIP.get_or_create_from_request(self.get_request()).pk, found_ip.pk)
+
+        # Unless it was deleted.
+        HashedIP.objects.filter(pk=found_ip.pk).first().delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertNotEqual(HashedIP.get_or_create_from_request(self.get_request()).pk, found_ip.pk)
+
+    def test_unused_hashed_ip_is_not_looked_up(self):
+        with self.assertNumQueries(0):
+            self.get_request()
+        self.assertFalse(HashedIP.objects.exists())
+
+
+class TestStaleCachedHashedIP(TransactionTestCase):
+    def setUp(self):
+        hashed_ip_cache.clear()
+        rate_counters.tracked_action_counter.clear()
+
+    def test_deleted_hashed_ip_is_created_again(self):
+        request = RequestFactory().get("/", REMOTE_ADDR="203.0.113.7")
+        attach_hashed_ip(request)
+        found_ip = HashedIP.get_or_create_by_hash(request.hashed_ip_str)
+
+        # Deleted without the post_delete signal, like another worker would.
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM {}".format(HashedIP._meta.db_table))
+
+        action = TrackedAction.create_action_with_request_and_type(request, "submit").get()
+        self.assertNotEqual(action.hashed_ip_id, found_ip.id)
+        self.assertEqual(action.hashed_ip.hashed_ip, request.hashed_ip_str)
+        self.assertEqual(hashed_ip_cache.get(request.hashed_ip_str), action.hashed_ip_id)
+
+
+class TestCompactSecurityTables(TestCase):
+    def setUp(self):
+        self.hashed_ip = HashedIP(hashed_ip="127.0.0.1")
+        self.hashed_ip.save()
+        self.now = timezone.now()
+        self.two_days_ago = self.now - datetime.timedelta(days=2)
+
+    def create_action(self, action_type: str, created_at: datetime.datetime) -> TrackedAction:
+        action = TrackedAction.objects.create(hashed_ip=self.hashed_ip, action_type=action_type)
+        TrackedAction.objects.filter(id=action.id).update(created_at=created_at)  # Skip auto_now_add.
+        return action
+
+    def compact(self):
+        call_command('compact_security_tables', batch_size=2, stdout=open(os.devnull, 'w'))
+
+    def test_old_actions_are_counted_and_deleted(self):
+        for _ in range(3):
+            self.create_action("load", self.two_days_ago)
+        self.create_action("submit", self.two_days_ago)
+        old_action = self.create_action("submit", self.now - datetime.timedelta(days=3))
+        recent_action = self.create_action("load", self.now - datetime.timedelta(hours=1))
+        job = RouteJob.objects.create(payload={}, tracked_action=old_action)
+
+        self.compact()
+        self.assertEqual(list(TrackedAction.objects.values_list('id', flat=True)), [recent_action.id, ])
+        self.assertEqual(
+            set(TrackedActionDailyCount.objects.values_list('day', 'action_type', 'count')),
+            {
+                (self.two_days_ago.date(), "load", 3),
+                (self.two_days_ago.date(), "submit", 1),
+                ((self.now - datetime.timedelta(days=3)).date(), "submit", 1),
+            }
+        )
+        job.refresh_from_db()
+        self.assertIsNone(job.tracked_action)
+
+        # Counts from later runs are added to the same days.
+        self.create_action("load", self.two_days_ago)
+        self.compact()
+        self.assertEqual(TrackedActionDailyCount.objects.get(day=self.two_days_ago.date(), action_type="load").count, 4)
+
+    def test_expired_jtis_and_api_requests_are_deleted(self):
+        old_jti = JWTBlacklist.objects.create(jti="old")
+        JWTBlacklist.objects.filter(id=old_jti.id).update(created_at=self.two_days_ago)
+        JWTBlacklist.objects.create(jti="recent")
+        api = API.objects.create(name="Geolocate", api_url="https://example.com", api_key="test")
+        APIRequest.objects.create(api=api, time=self.now - datetime.timedelta(days=31))
+        recent_request = APIRequest.objects.create(api=api)
+
+        self.compact()
+        self.assertEqual(list(JWTBlacklist.objects.values_list('jti', flat=True)), ["recent", ])
+        self.assertEqual(list(APIRequest.objects.values_list('id', flat=True)), [recent_request.id, ])
+
+    def test_benchmark_command(self):
+        call_command(
+            'benchmark_tracked_actions', num_rows=100, num_clients=10, num_checks=5, stdout=open(os.devnull, 'w')
+        )
+        self.assertFalse(TrackedAction.objects.exists())
+
+
+class TestJWTBlacklistFilter(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        # Two workers sharing one store.
+        path = os.path.join(self.temp_dir.name, "cache.db")
+        self.worker_a = jwt_blacklist_filter.JWTBlacklistFilter(table_name="test_filter", path=path)
+        self.worker_b = jwt_blacklist_filter.JWTBlacklistFilter(table_name="test_filter", path=path)
+        self.expires_at = timezone.now() + datetime.timedelta(hours=1)
+        JWTBlacklist.objects.create(jti="blacklisted", expires_at=self.expires_at)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_bloom_filter(self):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+        for x in range(1000):
+            bloom_filter.add("added {}".format(x))
+        self.assertTrue(bloom_filter.is_full())
+        self.assertTrue(all("added {}".format(x) in bloom_filter for x in range(1000)))
+        self.assertLess(sum("other {}".format(x) in bloom_filter for x in range(10000)), 300)
+
+    def test_only_possible_matches_are_looked_up(self):
+        self.assertFalse(self.worker_a.is_blacklisted("not blacklisted"))  # Loads the filter.
+        with self.assertNumQueries(0):
+            for x in range(100):
+                self.assertFalse(self.worker_a.is_blacklisted("not blacklisted {}".format(x)))
+
+        with self.assertNumQueries(1):
+            self.assertTrue(self.worker_a.is_blacklisted("blacklisted"))
+        with self.assertNumQueries(0):
+            self.assertTrue(self.worker_a.is_blacklisted("blacklisted"))
+
+    def test_workers_see_each_others_changes(self):
+        self.assertTrue(self.worker_a.is_blacklisted("blacklisted"))
+        self.assertFalse(self.worker_a.is_blacklisted("new"))
+
+        JWTBlacklist.objects.create(jti="new", expires_at=self.expires_at)
+        self.worker_b.record_insert("new")
+        self.assertTrue(self.worker_a.is_blacklisted("new"))
+
+        JWTBlacklist.objects.filter(jti="blacklisted").delete()
+        self.worker_b.record_delete()
+        self.assertFalse(self.worker_a.is_blacklisted("blacklisted"))
+
+    def test_expired_jtis_are_dropped(self):
+        JWTBlacklist.objects.create(jti="expired", expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        with self.assertNumQueries(1):
+            self.assertFalse(self.worker_a.is_blacklisted("expired"))
+
+    def test_request(self):
+        jwt_blacklist_filter.jwt_blacklist_filter.clear()
+        token = jwt.encode({'jti': "from request", 'exp': int(self.expires_at.timestamp())}, "secret")
+        request = RequestFactory().post("/", HTTP_AUTHORIZATION="Bearer {}".format(token))
+        self.assertFalse(jwt_blacklist_filter.is_request_jwt_blacklisted(request))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            blacklisted_jwt = JWTBlacklist.create_by_request(request)
+        self.assertEqual(blacklisted_jwt.expires_at, self.expires_at.replace(microsecond=0))
+        self.assertEqual(JWTBlacklist.create_by_request(request).id, blacklisted_jwt.id)
+        self.assertTrue(jwt_blacklist_filter.is_request_jwt_blacklisted(request))
+        self.assertTrue(JWTBlacklist.check_if_jwt_is_blacklisted_with_request(request))
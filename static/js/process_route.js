@@ -18,6 +18,33 @@ function parse_place_card(place_card) {
     return input_data;
 }
 
+const ROUTE_JOB_POLL_MILLISECONDS = 1000;
+const ROUTE_JOB_DONE_STATUSES = ['finished', 'not_routable', 'error'];
+
+function sleep(milliseconds) {
+    return new Promise(resolve => setTimeout(resolve, milliseconds));
+}
+
+async function wait_for_route_job(status_url, jwt) {
+    while (true) {
+        await sleep(ROUTE_JOB_POLL_MILLISECONDS);
+        var job_status = await fetch(
+            status_url,
+            {
+                method: 'GET',
+                headers: get_ajax_headers(jwt)
+            }
+        ).then(response => response.json());
+
+        if (!('status' in job_status) || ROUTE_JOB_DONE_STATUSES.includes(job_status['status'])) {
+            return job_status;
+        }
+        if (job_status['progress']) {
+            $("#route_job_progress").html(job_status['progress'] + "...");
+        }
+    }
+}
+
 async function process_route() {
     $("input, button").each(function() {
         $(this).prop('disabled', true);
@@ -49,6 +76,7 @@ async function process_route() {
         $("#alert_modal .modal-body").html(`
             <p class="lead fw-normal">Your request has been sent to the server for processing. When finished, you should automatically be redirected to see the results.</p>
             <p class="lead fw-normal">This may take up to a few minutes.</p>
+            <p class="fw-normal text-center" id="route_job_progress"></p>
             <div class="mt-3 row justify-content-center">
                 <div class="col-auto">
                     <div class="spinner-border text-success" role="status">
@@ -71,6 +99,11 @@ async function process_route() {
         ).then(response => response.json())
         .catch(error => console.log(error));
 
+        // The server queues the route and replies right away. Check on it until it's done.
+        if ('status_url' in server_result) {
+            server_result = await wait_for_route_job(server_result['status_url'], jwt);
+        }
+
         if ('notRoutableException' in server_result) {
             // alert("The server could not route those addresses. This may be because they cannot be connected via roads.")
             // $("#alert_modal.modal").modal("hide");
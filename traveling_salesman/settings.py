@@ -54,6 +54,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'security.middleware.hashed_ip_middleware',  # Hashes the client's IP address once per request.
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -148,6 +149,29 @@ if DEBUG:
 else:
     STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
+# Local SQLite file shared by every worker process on the host. Used as the second tier of the in-process caches in
+# api/caching.py. It only holds cached copies of data, so it can be deleted at any time.
+SHARED_CACHE_PATH = os.path.join(BASE_DIR, 'shared_cache', 'cache.sqlite3')
+
+# Runs the tests against a temporary SHARED_CACHE_PATH.
+TEST_RUNNER = 'traveling_salesman.test_runner.TestRunner'
+
+# Number of worker processes (such as gunicorn workers) serving requests on this host. Each process schedules its own
+# external API requests, so the rate limits on each API record are divided between them.
+API_RATE_LIMIT_NUM_PROCESSES = 1
+
+# Addresses older than api.utils.CONST_NUM_DAYS_ADDRESS_OUTDATED are still used while they are re-geocoded in the
+# background. Past this many days, they are re-geocoded before the request continues.
+ADDRESS_HARD_MAX_AGE_DAYS = 180
+
+# Route requests are queued as api.models.RouteJob records. When True, each web worker process runs them in a small
+# thread pool. Set to False to leave them for "python manage.py run_route_worker" processes instead.
+ROUTE_JOBS_IN_PROCESS = True
+
+# Serve the geolocate and generate_route endpoints with async views. Turn this on when deploying with an ASGI server
+# (traveling_salesman/asgi.py), so requests waiting on the geolocation API don't each hold a thread.
+API_ASYNC_VIEWS = False
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -202,3 +226,6 @@ token_generator_user = {
 }
 
 GMAPS_API_KEY = "api_key"
+
+# Clients allowed to read /api/metrics/, such as a Prometheus server scraping each host.
+METRICS_ALLOWED_IPS = ["127.0.0.1", "::1"]
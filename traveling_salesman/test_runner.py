@@ -0,0 +1,27 @@
+"""
+Test runner that keeps the tests away from the deployment's host-wide cache.
+"""
+import os
+import tempfile
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Point settings.SHARED_CACHE_PATH at a temporary file while the tests run. The tests clear the shared caches, which
+    would otherwise wipe the real file at BASE_DIR/shared_cache.
+    """
+    def setup_test_environment(self, **kwargs):
+        self.__shared_cache_dir = tempfile.TemporaryDirectory()
+        self.__shared_cache_settings = override_settings(
+            SHARED_CACHE_PATH=os.path.join(self.__shared_cache_dir.name, 'cache.sqlite3')
+        )
+        self.__shared_cache_settings.enable()
+        super().setup_test_environment(**kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        super().teardown_test_environment(**kwargs)
+        self.__shared_cache_settings.disable()
+        self.__shared_cache_dir.cleanup()